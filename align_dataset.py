@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+#
+#
+#  Copyright (C) URJC DeepRacer
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+#  Author : Roberto Calvo Palomino <roberto.calvo at urjc dot es
+#           Sergio Robledo <s.robledo.2021 at alumnos dot urjc dot es>
+
+# Aligns recorded telemetry (telemetry.bin or a CSV such as data.csv) with
+# the samples of a dataset.csv. Only the telemetry columns are loaded in
+# memory, the dataset is read and written chunk by chunk to a temporary file
+# that replaces the original at the end, so huge datasets fit in memory.
+#
+#   python3 align_dataset.py --dataset /tmp/1763718805717_dataset/dataset.csv \
+#       --source logs/1763717922_Town04/telemetry.bin --mode linear --columns speed vx:speed_x
+
+import os
+import sys
+import argparse
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from telemetry import load_telemetry, role_records
+from dataset_manager import update_sidecar_column
+
+
+MODES = ["nearest", "linear", "previous"]
+
+
+def load_source (filename, src_time_col, src_columns, role="ego"):
+
+    # Returns (times, {column: values}) sorted by time, rows with NaN dropped
+    if filename.endswith(".bin"):
+        header, records = load_telemetry(filename)
+        records = role_records(header, records, role)
+        for col in [src_time_col] + list(src_columns):
+            if col not in records.dtype.names:
+                raise ValueError(f"telemetry has no column '{col}'")
+        times = np.asarray(records[src_time_col], dtype=np.float64)
+        # float32 values rounded as they were written in the CSV
+        values = {col: np.round(np.asarray(records[col], dtype=np.float64), 6) for col in src_columns}
+    else:
+        df = pd.read_csv(filename, usecols=[src_time_col] + list(src_columns))
+        df = df.apply(pd.to_numeric, errors="coerce").dropna()
+        times = df[src_time_col].to_numpy(dtype=np.float64)
+        values = {col: df[col].to_numpy(dtype=np.float64) for col in src_columns}
+
+    if len(times) > 1 and np.any(np.diff(times) < 0):
+        order = np.argsort(times, kind="stable")
+        times = times[order]
+        values = {col: v[order] for col, v in values.items()}
+    return times, values
+
+
+def align_indices (times, t, mode="nearest"):
+
+    # Index of the source sample used for each time of t (for "linear", the
+    # closest one, to measure the time difference). Times out of the source
+    # range use the first or last sample.
+    if mode == "previous":
+        idx = np.searchsorted(times, t, side="right") - 1
+        return np.clip(idx, 0, len(times) - 1)
+
+    right = np.clip(np.searchsorted(times, t, side="left"), 0, len(times) - 1)
+    left = np.clip(right - 1, 0, len(times) - 1)
+    return np.where(np.abs(times[left] - t) <= np.abs(times[right] - t), left, right)
+
+
+def align_values (times, values, t, mode="nearest"):
+
+    # Vectorized alignment of one chunk. Returns ({column: aligned}, time diff)
+    idx = align_indices(times, t, mode)
+    if mode == "linear":
+        aligned = {col: np.interp(t, times, v) for col, v in values.items()}
+    else:
+        aligned = {col: v[idx] for col, v in values.items()}
+    return aligned, np.abs(times[idx] - t)
+
+
+def align_csv (dataset_csv, source, columns, mode="nearest", time_col="timestamp",
+               src_time_col="sim_time", output=None, chunksize=100000, role="ego"):
+
+    # columns: [(source column, dataset column)]. Returns the alignment stats,
+    # or None if nothing was done.
+    if mode not in MODES:
+        raise ValueError(f"Unknown alignment mode '{mode}'")
+
+    if not os.path.isfile(dataset_csv):
+        print(f"[ERROR] Dataset {dataset_csv} does not exist")
+        return None
+    if not os.path.isfile(source):
+        print(f"[ERROR] Telemetry does not exist: {source}")
+        return None
+
+    try:
+        times, values = load_source(source, src_time_col, [src for src, _ in columns], role)
+    except ValueError as e:
+        print(f"[ERROR] {source}: {e}")
+        return None
+    if len(times) == 0:
+        print("[WARN] Empty telemetry")
+        return None
+
+    output = output or dataset_csv
+    out_dir = os.path.dirname(os.path.abspath(output))
+    fd, tmp_filename = tempfile.mkstemp(prefix=".align_", suffix=".csv", dir=out_dir)
+    os.close(fd)
+
+    rows = 0
+    aligned_rows = 0
+    diff_sum = 0.0
+    diff_max = 0.0
+
+    # Aligned columns are only kept to update the typed sidecar of the
+    # dataset, when there is one
+    sidecar_filename = os.path.splitext(dataset_csv)[0] + ".npz"
+    update_sidecar = output == dataset_csv and os.path.isfile(sidecar_filename)
+    dst_values = {dst: [] for _, dst in columns}
+
+    try:
+        first = True
+        for chunk in pd.read_csv(dataset_csv, chunksize=chunksize):
+            if first and time_col not in chunk.columns:
+                print(f"[ERROR] Dataset does not have col '{time_col}'.")
+                return None
+
+            t = pd.to_numeric(chunk[time_col], errors="coerce").to_numpy(dtype=np.float64)
+            valid = ~np.isnan(t)
+            aligned, diff = align_values(times, values, t[valid], mode)
+
+            # Rows without a valid time keep their values
+            for src, dst in columns:
+                column = (chunk[dst].to_numpy(dtype=np.float64, copy=True) if dst in chunk.columns
+                          else np.full(len(chunk), np.nan))
+                column[valid] = aligned[src]
+                chunk[dst] = column
+                if update_sidecar:
+                    dst_values[dst].append(column)
+
+            chunk.to_csv(tmp_filename, mode="w" if first else "a", header=first, index=False)
+            first = False
+
+            rows += len(chunk)
+            aligned_rows += int(valid.sum())
+            if len(diff):
+                diff_sum += float(diff.sum())
+                diff_max = max(diff_max, float(diff.max()))
+
+        if first:
+            print("[WARN] Empty Dataset")
+            return None
+
+        # mkstemp creates the file readable by its owner only: keep the
+        # permissions of the dataset
+        shutil.copymode(output if os.path.exists(output) else dataset_csv, tmp_filename)
+        os.replace(tmp_filename, output)
+
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+    # Keep the typed sidecar of the dataset (if any) up to date
+    if update_sidecar:
+        for dst, chunks in dst_values.items():
+            update_sidecar_column(sidecar_filename, dst, np.concatenate(chunks))
+
+    stats = {"rows": rows, "aligned": aligned_rows, "source_rows": len(times),
+             "avg_time_diff": diff_sum / aligned_rows if aligned_rows else 0.0,
+             "max_time_diff": diff_max}
+
+    print(f"[INFO] Alignment ({mode})")
+    print(f"  - Nº rows dataset:   {stats['rows']} ({stats['aligned']} aligned)")
+    print(f"  - Nº rows telemetry: {stats['source_rows']}")
+    print(f"  - Avg time diff:     {stats['avg_time_diff']:.4f} s")
+    print(f"  - Max time diff:     {stats['max_time_diff']:.4f} s")
+    return stats
+
+
+def parse_columns (specs):
+
+    # "src" or "src:dst"
+    columns = []
+    for spec in specs:
+        src, _, dst = spec.partition(":")
+        columns.append((src, dst or src))
+    return columns
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Align recorded telemetry with a dataset, chunk by chunk")
+
+    parser.add_argument("--dataset", type=str, required=True,
+                        help="dataset.csv to align")
+
+    parser.add_argument("--source", type=str, required=True,
+                        help="telemetry.bin or a CSV (e.g. data.csv) written by recorder.py")
+
+    parser.add_argument("--columns", type=str, nargs="+", default=None,
+                        help="Columns to align, SRC or SRC:DST (default: speed:speed for "
+                             "telemetry.bin, speed_m_s:speed for a CSV)")
+
+    parser.add_argument("--mode", type=str, choices=MODES, default="nearest",
+                        help="nearest sample, linear interpolation or previous sample")
+
+    parser.add_argument("--time_col", type=str, default="timestamp",
+                        help="Time column of the dataset")
+
+    parser.add_argument("--src_time_col", type=str, default="sim_time",
+                        help="Time column of the telemetry")
+
+    parser.add_argument("--role", type=str, default="ego",
+                        help="Actor of telemetry.bin (ego, bike)")
+
+    parser.add_argument("--chunksize", type=int, default=100000,
+                        help="Dataset rows processed at a time")
+
+    parser.add_argument("--output", type=str, default=None,
+                        help="Write the result here instead of replacing the dataset")
+
+    args = parser.parse_args()
+
+    if args.columns:
+        columns = parse_columns(args.columns)
+    elif args.source.endswith(".bin"):
+        columns = [("speed", "speed")]
+    else:
+        columns = [("speed_m_s", "speed")]
+
+    stats = align_csv(args.dataset, args.source, columns, mode=args.mode,
+                      time_col=args.time_col, src_time_col=args.src_time_col,
+                      output=args.output, chunksize=args.chunksize, role=args.role)
+    sys.exit(0 if stats is not None else 1)
@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+#
+#
+#  Copyright (C) URJC DeepRacer
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+#  Author : Roberto Calvo Palomino <roberto.calvo at urjc dot es
+#           Sergio Robledo <s.robledo.2021 at alumnos dot urjc dot es>
+
+# Replays every log found under a directory (the <timestamp>_<town> layout
+# written by recorder.py), dispatching them to a pool of CARLA servers.
+# Each replay runs replay.py in its own process; failed jobs are retried,
+# and finished logs are written to a manifest so a rerun skips them.
+# Long logs can be split in segments replayed on different servers at the
+# same time, whose datasets are merged at the end (see replay_segments.py).
+
+import os
+import re
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import shutil
+import subprocess
+from pathlib import Path
+
+from carla_log import index_directory, match_log
+from replay_segments import (DEFAULT_WARMUP, Segment, plan_segments, segment_key, segment_args,
+                             find_datasets, merge_segments)
+
+
+MANIFEST_FILENAME = "batch_manifest.jsonl"
+SUMMARY_FILENAME = "batch_summary.json"
+REPLAY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "replay.py")
+
+
+def discover_logs(root):
+
+    # Directories with a CARLA .log file, sorted by name (= by timestamp)
+    root = Path(root)
+    dirs = {p.parent.resolve() for p in root.rglob("*.log")}
+    return sorted(str(d) for d in dirs)
+
+
+def select_logs(log_dirs, actors=None, town=None, min_duration=None, longest_first=False):
+
+    # Filters the log directories with the info of their logs (read offline,
+    # see carla_log.py). Directories whose log cannot be parsed are kept when
+    # there is no filter, so the server can still tell.
+    selected = []
+    for log_dir in log_dirs:
+        infos = list(index_directory(log_dir).values())
+        if actors or town or min_duration is not None:
+            if not any(match_log(info, actors, town, min_duration) for info in infos):
+                continue
+        duration = max((info["duration"] for info in infos), default=0.0)
+        selected.append((duration, log_dir))
+
+    # Longest replays first, so the last ones to finish are the short ones
+    if longest_first:
+        selected.sort(key=lambda item: -item[0])
+    return [log_dir for _, log_dir in selected]
+
+
+def load_manifest(filename):
+
+    # Logs already replayed, from previous runs
+    done = set()
+    if not os.path.isfile(filename):
+        return done
+    with open(filename) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue   # last line of an interrupted run
+            if entry.get("status") == "done":
+                done.add(entry["log"])
+    return done
+
+
+def log_duration(log_dir):
+
+    # Duration of the log of a directory, None if it cannot be read offline
+    durations = [info["duration"] for info in index_directory(log_dir).values()]
+    return max(durations) if durations else None
+
+
+def plan_jobs(logs, segment_length=0.0, warmup=DEFAULT_WARMUP, done=()):
+
+    # Jobs (log directories, or Segments of the logs longer than
+    # segment_length) and {log: segments} of the logs split in segments
+    jobs = []
+    segmented = {}
+    for log in logs:
+        duration = log_duration(log) if segment_length > 0 and log not in done else None
+        if duration is not None and duration > segment_length:
+            segmented[log] = plan_segments(log, duration, segment_length, warmup)
+            jobs.extend(segmented[log])
+        else:
+            jobs.append(log)
+    return jobs, segmented
+
+
+def job_name(job):
+
+    # Name of a job in the manifest: the log directory, "<log>#<n>" for segments
+    return segment_key(job) if isinstance(job, Segment) else job
+
+
+def job_output_path(output_path, job):
+
+    # DatasetSaver appends "<ms>_dataset" to the path, keep the trailing separator
+    log_dir = job.log if isinstance(job, Segment) else job
+    path = os.path.join(output_path, os.path.basename(log_dir.rstrip(os.sep)))
+    if isinstance(job, Segment):
+        path = os.path.join(path, f"segment_{job.index:03d}")
+    return path + os.sep
+
+
+def _is_replay_output(name):
+    return name.endswith("_dataset") or re.fullmatch(r"segment_\d{3}", name) is not None
+
+
+def clear_output(output_path):
+
+    # Removes what a previous attempt of a job left in its output: datasets
+    # (<ms>_dataset, also in the directory of each view) and segments.
+    # Anything else is left alone. Its replay.log is kept as replay.<n>.log.
+    if not os.path.isdir(output_path):
+        return
+    entries = os.listdir(output_path)
+    previous = sum(1 for e in entries if re.fullmatch(r"replay\.\d+\.log", e))
+    for entry in entries:
+        path = os.path.join(output_path, entry)
+        if entry == "replay.log":
+            os.replace(path, os.path.join(output_path, f"replay.{previous + 1}.log"))
+        elif not os.path.isdir(path):
+            continue
+        elif _is_replay_output(entry):
+            shutil.rmtree(path)
+        else:
+            # Directory of a view
+            for name in os.listdir(path):
+                if name.endswith("_dataset") and os.path.isdir(os.path.join(path, name)):
+                    shutil.rmtree(os.path.join(path, name))
+
+
+def output_conflict(output_path, log_dirs):
+
+    # First log directory that is the output root or inside it (the outputs
+    # of the jobs would be mixed with the logs), None if there is none
+    root = os.path.realpath(output_path)
+    for log_dir in log_dirs:
+        log_dir = os.path.realpath(log_dir)
+        if os.path.commonpath([root, log_dir]) == root:
+            return log_dir
+    return None
+
+
+def subprocess_runner(replay_args=(), env=None, timeout=None):
+
+    # Runs replay.py for one log (or segment) on one server. Returns True on success.
+    def run(job, port, output_path):
+        log_dir = job.log if isinstance(job, Segment) else job
+        cmd = [sys.executable, REPLAY_SCRIPT,
+               "--log_path", log_dir,
+               "--port", str(port)]
+        if output_path is not None:
+            cmd += ["--generate_dataset_path", output_path]
+        if isinstance(job, Segment):
+            cmd += segment_args(job)
+        cmd += list(replay_args)
+
+        # Output of each replay goes to replay.log next to its dataset
+        out = subprocess.DEVNULL
+        if output_path is not None:
+            os.makedirs(output_path, exist_ok=True)
+            out = open(os.path.join(output_path, "replay.log"), "a")
+
+        try:
+            result = subprocess.run(cmd, env=env, timeout=timeout,
+                                    stdout=out, stderr=subprocess.STDOUT)
+        except subprocess.TimeoutExpired:
+            print(f"[ERROR] Replay of {job_name(job)} on port {port} timed out")
+            return False
+        finally:
+            if out is not subprocess.DEVNULL:
+                out.close()
+        return result.returncode == 0
+
+    return run
+
+
+class BatchReplay:
+
+    def __init__(self, logs, ports, runner, output_path=None, retries=2,
+                 manifest_filename=None, segmented=None, keep_segments=False):
+
+        # logs: log directories or Segments. segmented: {log: segments}, merged
+        # when all of them are done
+        self.ports = list(ports)
+        self.runner = runner
+        self.output_path = output_path
+        self.retries = retries
+        self.manifest_filename = manifest_filename
+        self.segmented = segmented or {}
+        self.keep_segments = keep_segments
+
+        done = load_manifest(manifest_filename) if manifest_filename else set()
+        self.skipped = [log for log in logs if job_name(log) in done]
+
+        self.jobs = queue.Queue()
+        self.total = 0
+        for log in logs:
+            if job_name(log) not in done:
+                self.jobs.put((log, 1))
+                self.total += 1
+
+        self.lock = threading.Lock()
+        self.remaining = self.total
+        self.failed = []
+        self.stats = {port: {"done": 0, "failed": 0, "busy_s": 0.0} for port in self.ports}
+
+    def _record(self, entry):
+
+        if self.manifest_filename is None:
+            return
+        with self.lock:
+            with open(self.manifest_filename, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def _server_worker(self, port):
+
+        while True:
+            with self.lock:
+                if self.remaining == 0:
+                    return
+            try:
+                log, attempt = self.jobs.get(timeout=0.5)
+            except queue.Empty:
+                continue   # another server may still re-queue a failed job
+
+            output = job_output_path(self.output_path, log) if self.output_path else None
+            print(f"[INFO] Port {port}: replaying {job_name(log)} (attempt {attempt})")
+            if output is not None:
+                clear_output(output)
+
+            t0 = time.monotonic()
+            try:
+                ok = self.runner(log, port, output)
+            except Exception as e:
+                print(f"[ERROR] Port {port}: {e}")
+                ok = False
+            elapsed = time.monotonic() - t0
+
+            with self.lock:
+                self.stats[port]["busy_s"] += elapsed
+                self.stats[port]["done" if ok else "failed"] += 1
+
+            if ok:
+                # The dataset directory of each view, e.g. {".": ".../1763718805717_dataset"}
+                try:
+                    datasets = find_datasets(output) if output is not None else {}
+                except ValueError as e:
+                    print(f"[WARN] Port {port}: {job_name(log)}: {e}")
+                    datasets = None
+                self._record({"log": job_name(log), "status": "done", "port": port,
+                              "attempts": attempt, "seconds": round(elapsed, 3),
+                              "output": output, "datasets": datasets})
+            elif attempt <= self.retries:
+                print(f"[WARN] Port {port}: {job_name(log)} failed, retrying")
+                self.jobs.put((log, attempt + 1))
+                continue
+            else:
+                print(f"[ERROR] Port {port}: {job_name(log)} failed {attempt} times, giving up")
+                self._record({"log": job_name(log), "status": "failed", "port": port,
+                              "attempts": attempt, "seconds": round(elapsed, 3),
+                              "output": output})
+                with self.lock:
+                    self.failed.append(job_name(log))
+
+            with self.lock:
+                self.remaining -= 1
+
+    def run(self):
+
+        t0 = time.monotonic()
+        threads = [threading.Thread(target=self._server_worker, args=(port,),
+                                    name=f"Server-{port}", daemon=True)
+                   for port in self.ports]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self._merge_segments()
+        wall = time.monotonic() - t0
+
+        return self.summary(wall)
+
+    def _merge_segments(self):
+
+        # One dataset per log split in segments, once all of them are done
+        for log, segments in self.segmented.items():
+            if any(segment_key(s) in self.failed for s in segments):
+                print(f"[WARN] {log}: some segments failed, datasets not merged")
+                continue
+            if self.output_path is None:
+                continue
+
+            paths = [job_output_path(self.output_path, s) for s in segments]
+            output = job_output_path(self.output_path, log)
+            try:
+                merged = merge_segments(paths, output, move=not self.keep_segments)
+            except Exception as e:
+                print(f"[ERROR] Unable to merge the segments of {log}: {e}")
+                self.failed.append(log)
+                continue
+
+            self._record({"log": log, "status": "done", "segments": len(segments),
+                          "output": output, "datasets": merged})
+            if not self.keep_segments:
+                for path in paths:
+                    shutil.rmtree(path, ignore_errors=True)
+
+    def summary(self, wall):
+
+        servers = {}
+        for port, st in self.stats.items():
+            hours = st["busy_s"] / 3600.0
+            servers[str(port)] = {
+                "done": st["done"],
+                "failed_attempts": st["failed"],
+                "busy_s": round(st["busy_s"], 3),
+                "logs_per_hour": round(st["done"] / hours, 2) if hours > 0 else 0.0,
+            }
+
+        return {"logs": self.total + len(self.skipped),
+                "skipped": len(self.skipped),
+                "done": self.total - len(self.failed),
+                "failed": self.failed,
+                "wall_s": round(wall, 3),
+                "servers": servers}
+
+
+def print_summary(summary):
+
+    print(f"[INFO] Batch replay")
+    print(f"  - Nº logs:      {summary['logs']} ({summary['skipped']} already done)")
+    print(f"  - Replayed:     {summary['done']}")
+    print(f"  - Failed:       {len(summary['failed'])}")
+    print(f"  - Wall time:    {summary['wall_s']:.1f} s")
+    for port, st in summary["servers"].items():
+        print(f"  - Port {port}: {st['done']} logs, {st['failed_attempts']} failed attempts, "
+              f"busy {st['busy_s']:.1f} s, {st['logs_per_hour']:.1f} logs/h")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Replay all the logs of a directory on several CARLA servers",
+        epilog="Arguments after -- are passed to replay.py (e.g. -- --sync --dataset_types rgb)")
+
+    parser.add_argument("--logs_root", type=str, required=True,
+                        help="Directory with the log directories written by recorder.py")
+
+    parser.add_argument("--ports", "--carla-ports", type=int, nargs="+", default=[3010],
+                        help="Ports of the CARLA servers, one replay runs on each at a time")
+
+    parser.add_argument("--generate_dataset_path", type=str, default=None,
+                        help="Generate a dataset per log under this directory")
+
+    parser.add_argument("--retries", type=int, default=2,
+                        help="Number of times a failed replay is retried")
+
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="Maximum time (s) for one replay")
+
+    parser.add_argument("--pythonpath", type=str, nargs="+", default=[],
+                        help="Directories added to PYTHONPATH of the replays (e.g. a carla module stand-in)")
+
+    parser.add_argument("--with_actor", type=str, nargs="+", default=None,
+                        help="Only logs with actors of these type ids (e.g. 'vehicle.diamondback.*')")
+
+    parser.add_argument("--town", type=str, default=None,
+                        help="Only logs of this map (e.g. Town04)")
+
+    parser.add_argument("--min_duration", type=float, default=None,
+                        help="Only logs of at least this duration (s)")
+
+    parser.add_argument("--longest_first", action="store_true",
+                        help="Replay the longest logs first (shorter total time with several servers)")
+
+    parser.add_argument("--segment_length", type=float, default=0.0,
+                        help=("Split the logs longer than this (s) in segments replayed in parallel, "
+                              "whose datasets are merged (0 = whole logs)"))
+
+    parser.add_argument("--warmup", type=float, default=DEFAULT_WARMUP,
+                        help="Seconds replayed before each segment and discarded")
+
+    parser.add_argument("--keep_segments", action="store_true",
+                        help="Keep the datasets of the segments after merging them")
+
+    parser.add_argument("--manifest", type=str, default=None,
+                        help=f"Manifest of finished logs (default: {MANIFEST_FILENAME} in the dataset or logs directory)")
+
+    argv = sys.argv[1:]
+    replay_args = []
+    if "--" in argv:
+        replay_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    args = parser.parse_args(argv)
+    if args.segment_length > 0 and args.generate_dataset_path is None:
+        parser.error("--segment_length needs --generate_dataset_path")
+
+    state_dir = args.generate_dataset_path or args.logs_root
+    os.makedirs(state_dir, exist_ok=True)
+    manifest = args.manifest or os.path.join(state_dir, MANIFEST_FILENAME)
+
+    logs = discover_logs(args.logs_root)
+    if not logs:
+        print(f"Error, no log file found in {args.logs_root}")
+        sys.exit(-1)
+
+    if args.generate_dataset_path is not None:
+        conflict = output_conflict(args.generate_dataset_path, logs)
+        if conflict is not None:
+            print(f"Error, the log directory {conflict} is inside --generate_dataset_path, "
+                  f"use a directory out of {args.logs_root}")
+            sys.exit(-1)
+
+    logs = select_logs(logs, args.with_actor, args.town, args.min_duration, args.longest_first)
+    if not logs:
+        print(f"Error, no log in {args.logs_root} matches the filters")
+        sys.exit(-1)
+
+    env = None
+    if args.pythonpath:
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(args.pythonpath + [env.get("PYTHONPATH", "")])
+
+    jobs, segmented = plan_jobs(logs, args.segment_length, args.warmup, load_manifest(manifest))
+    if segmented:
+        print(f"[INFO] {len(segmented)} logs split in {sum(len(s) for s in segmented.values())} segments")
+
+    batch = BatchReplay(jobs, args.ports,
+                        subprocess_runner(replay_args, env=env, timeout=args.timeout),
+                        output_path=args.generate_dataset_path,
+                        retries=args.retries,
+                        manifest_filename=manifest,
+                        segmented=segmented,
+                        keep_segments=args.keep_segments)
+
+    try:
+        summary = batch.run()
+    except KeyboardInterrupt:
+        print("Exit...")
+        sys.exit(1)
+
+    print_summary(summary)
+    with open(os.path.join(state_dir, SUMMARY_FILENAME), "w") as f:
+        json.dump(summary, f, indent=2)
+
+    sys.exit(0 if not summary["failed"] else 1)
@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+#
+#
+#  Copyright (C) URJC DeepRacer
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+#  Author : Roberto Calvo Palomino <roberto.calvo at urjc dot es
+#           Sergio Robledo <s.robledo.2021 at alumnos dot urjc dot es>
+
+# Stand-in of the CARLA 0.9.15 Python API, only the part used by recorder.py
+# and replay.py. There is no server: the world advances in a thread at a
+# fixed rate (asynchronous mode) or on world.tick() (synchronous mode), the
+# actors drive along a straight road and the cameras send synthetic BGRA
+# frames (road, white and yellow lanes, noise) from their own thread, as the
+# real client does. Frames are generated once, so the stand-in itself costs
+# almost nothing per frame.
+#
+# Put this directory first in the path, before the real carla module:
+#   PYTHONPATH=benchmarks/fake_carla python3 replay.py --log_path ... --headless
+#
+# Settings (environment variables, or configure() in the same process):
+#   FAKE_CARLA_FPS        simulation steps per second in asynchronous mode (30)
+#   FAKE_CARLA_DURATION   duration of the replayed logs in seconds (10)
+#   FAKE_CARLA_STOPPED    part of the time the vehicles are stopped (0): every
+#                         STOP_CYCLE seconds they brake and the cameras send
+#                         the same frame, as at a traffic light
+
+import os
+import queue
+import fnmatch
+import itertools
+import threading
+import time
+import math
+
+import numpy as np
+
+
+_config = {"fps": float(os.environ.get("FAKE_CARLA_FPS", 30)),
+           "duration": float(os.environ.get("FAKE_CARLA_DURATION", 10)),
+           "stopped": float(os.environ.get("FAKE_CARLA_STOPPED", 0))}
+
+# Distinct frames generated for each camera, sent in turn
+FRAME_BANK_SIZE = 8
+
+# Seconds of a drive and stop cycle (FAKE_CARLA_STOPPED)
+STOP_CYCLE = 2.0
+
+_world = None
+_world_lock = threading.Lock()
+_frame_banks = {}
+_actor_ids = itertools.count(100)
+
+
+def configure (fps=None, duration=None, stopped=None):
+
+    # Settings of the next world (see reset())
+    if fps is not None:
+        _config["fps"] = float(fps)
+    if duration is not None:
+        _config["duration"] = float(duration)
+    if stopped is not None:
+        _config["stopped"] = float(stopped)
+
+
+def _stopped (t):
+    return t % STOP_CYCLE < STOP_CYCLE * _config["stopped"]
+
+
+def reset ():
+
+    # Stops the current world, the next Client gets a new one
+    global _world
+    with _world_lock:
+        if _world is not None:
+            _world.shutdown()
+        _world = None
+
+
+class Vector3D:
+
+    def __init__ (self, x=0.0, y=0.0, z=0.0):
+        self.x, self.y, self.z = x, y, z
+
+    def __add__ (self, other):
+        return Vector3D(self.x + other.x, self.y + other.y, self.z + other.z)
+
+    def __mul__ (self, k):
+        return Vector3D(self.x * k, self.y * k, self.z * k)
+
+
+class Location(Vector3D):
+    pass
+
+
+class Rotation:
+
+    def __init__ (self, pitch=0.0, yaw=0.0, roll=0.0):
+        self.pitch, self.yaw, self.roll = pitch, yaw, roll
+
+
+class Transform:
+
+    def __init__ (self, location=None, rotation=None):
+        self.location = location or Location()
+        self.rotation = rotation or Rotation()
+
+    def get_forward_vector (self):
+        yaw = math.radians(self.rotation.yaw)
+        return Vector3D(math.cos(yaw), math.sin(yaw), 0.0)
+
+
+class VehicleControl:
+
+    def __init__ (self, throttle=0.0, steer=0.0, brake=0.0):
+        self.throttle, self.steer, self.brake = throttle, steer, brake
+
+
+class WorldSettings:
+
+    def __init__ (self, synchronous_mode=False, fixed_delta_seconds=None):
+        self.synchronous_mode = synchronous_mode
+        self.fixed_delta_seconds = fixed_delta_seconds
+
+
+class Timestamp:
+
+    def __init__ (self, frame, elapsed_seconds, delta_seconds):
+        self.frame = frame
+        self.elapsed_seconds = elapsed_seconds
+        self.delta_seconds = delta_seconds
+        self.platform_timestamp = time.time()
+
+
+def _speed (t):
+    # Speed of the actors (m/s) at simulation time t
+    return 8.0 + 2.0 * math.sin(0.2 * t)
+
+
+def _position (t):
+    return 8.0 * t - 10.0 * math.cos(0.2 * t)
+
+
+class ActorSnapshot:
+
+    def __init__ (self, actor, t):
+        self.id = actor.id
+        self.offset = actor.offset
+        self.t = t
+
+    def get_transform (self):
+        return Transform(Location(_position(self.t) + self.offset, 0.0, 0.0))
+
+    def get_velocity (self):
+        return Vector3D(_speed(self.t), 0.0, 0.0)
+
+    def get_acceleration (self):
+        return Vector3D(0.4 * math.cos(0.2 * self.t), 0.0, 0.0)
+
+
+class WorldSnapshot:
+
+    def __init__ (self, world, frame, elapsed_seconds, delta_seconds):
+        self.world = world
+        self.frame = frame
+        self.timestamp = Timestamp(frame, elapsed_seconds, delta_seconds)
+
+    def find (self, actor_id):
+        actor = self.world.actors.get(actor_id)
+        if actor is None:
+            return None
+        return ActorSnapshot(actor, self.timestamp.elapsed_seconds)
+
+
+def _road_frame (width, height, seed):
+
+    # BGRA road with lanes: sky, noisy asphalt, white side lines and a yellow
+    # centre line, shifted with seed so consecutive frames differ
+    rng = np.random.default_rng(seed)
+    bgra = np.empty((height, width, 4), dtype=np.uint8)
+    bgra[..., 3] = 255
+    horizon = height // 2
+    bgra[:horizon, :, :3] = (200, 160, 120)
+    bgra[horizon:, :, :3] = rng.integers(60, 100, (height - horizon, width, 1), dtype=np.uint8)
+
+    rows = np.arange(horizon, height)
+    depth = (rows - horizon + 1) / float(height - horizon)
+    centre = width / 2 + 20 * math.sin(seed)
+    thickness = np.maximum(1, (6 * depth).astype(int))
+    for lane, color in ((-0.45, (255, 255, 255)), (0.0, (0, 210, 230)), (0.45, (255, 255, 255))):
+        x = (centre + lane * width * depth).astype(int)
+        for row, x0, th in zip(rows, x, thickness):
+            bgra[row, max(0, x0 - th):max(0, x0 + th), :3] = color
+    return bgra
+
+
+def _semantic_frame (width, height, seed):
+
+    # Semantic tags in the red channel: sky (11), road (1), road lines (24)
+    bgra = np.zeros((height, width, 4), dtype=np.uint8)
+    bgra[..., 3] = 255
+    horizon = height // 2
+    bgra[:horizon, :, 2] = 11
+    bgra[horizon:, :, 2] = 1
+    road = _road_frame(width, height, seed)
+    bgra[(road[..., 0] > 150) & (road[..., 1] > 150) & (np.arange(height)[:, None] >= horizon), 2] = 24
+    return bgra
+
+
+def _frame_bank (kind, width, height):
+
+    key = (kind, width, height)
+    with _world_lock:
+        bank = _frame_banks.get(key)
+        if bank is None:
+            make = _semantic_frame if kind == "semantic" else _road_frame
+            bank = _frame_banks[key] = [make(width, height, i).tobytes() for i in range(FRAME_BANK_SIZE)]
+    return bank
+
+
+class Image:
+
+    def __init__ (self, frame, timestamp, width, height, raw_data):
+        self.frame = frame
+        self.timestamp = timestamp
+        self.width = width
+        self.height = height
+        self.fov = 90.0
+        self.raw_data = raw_data
+
+
+class ActorBlueprint:
+
+    def __init__ (self, id):
+        self.id = id
+        self.attributes = {}
+
+    def set_attribute (self, key, value):
+        self.attributes[key] = value
+
+
+class BlueprintLibrary:
+
+    IDS = ["vehicle.tesla.model3", "vehicle.diamondback.century",
+           "sensor.camera.rgb", "sensor.camera.semantic_segmentation"]
+
+    def find (self, id):
+        return ActorBlueprint(id)
+
+    def filter (self, pattern):
+        # As CARLA, the pattern is matched against the id and the tags (e.g. "model3")
+        return [ActorBlueprint(id) for id in self.IDS
+                if fnmatch.fnmatch(id, pattern) or any(fnmatch.fnmatch(tag, pattern) for tag in id.split("."))]
+
+
+class ActorList(list):
+
+    def filter (self, pattern):
+        return ActorList(a for a in self if fnmatch.fnmatch(a.type_id, pattern))
+
+
+class Actor:
+
+    def __init__ (self, world, blueprint, transform, parent=None):
+        self.id = next(_actor_ids)
+        self.type_id = blueprint.id
+        self.attributes = dict(blueprint.attributes)
+        self.world = world
+        self.parent = parent
+        self.offset = transform.location.x if transform is not None else 0.0
+        self.autopilot = False
+
+    def get_control (self):
+        # Smooth synthetic driving, a function of the simulation time
+        t = self.world.elapsed
+        if _stopped(t):
+            return VehicleControl(throttle=0.0, steer=0.0, brake=1.0)
+        return VehicleControl(throttle=0.5 + 0.3 * math.sin(0.5 * t),
+                              steer=0.2 * math.sin(0.3 * t),
+                              brake=max(0.0, -math.sin(0.5 * t)) * 0.2)
+
+    def get_velocity (self):
+        return Vector3D(_speed(self.world.elapsed), 0.0, 0.0)
+
+    def get_transform (self):
+        return Transform(Location(_position(self.world.elapsed) + self.offset, 0.0, 0.0))
+
+    def set_autopilot (self, enabled=True, tm_port=8000):
+        self.autopilot = enabled
+
+    def destroy (self):
+        self.world.destroy_actor(self)
+        return True
+
+
+class Sensor(Actor):
+
+    # Frames are delivered from a thread of the sensor, like the callbacks of
+    # the real client
+
+    def __init__ (self, world, blueprint, transform, parent=None):
+        super().__init__(world, blueprint, transform, parent)
+        self.width = int(self.attributes.get("image_size_x", 800))
+        self.height = int(self.attributes.get("image_size_y", 600))
+        kind = "semantic" if "semantic" in self.type_id else "rgb"
+        self.bank = _frame_bank(kind, self.width, self.height)
+        self.q = queue.Queue()
+        self.callback = None
+        self.thread = None
+
+    def listen (self, callback):
+        self.callback = callback
+        self.thread = threading.Thread(target=self._deliver, name=f"Sensor-{self.id}", daemon=True)
+        self.thread.start()
+
+    def is_listening (self):
+        return self.callback is not None
+
+    def _emit (self, frame, timestamp):
+        if self.callback is not None:
+            self.q.put(Image(frame, timestamp, self.width, self.height,
+                             self.bank[0 if _stopped(timestamp) else frame % len(self.bank)]))
+
+    def _deliver (self):
+        while True:
+            image = self.q.get()
+            callback = self.callback
+            if image is None or callback is None:
+                return
+            callback(image)
+
+    def stop (self):
+        self.callback = None
+        if self.thread is not None:
+            self.q.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+class Map:
+
+    def __init__ (self, name):
+        self.name = name
+
+    def get_spawn_points (self):
+        return [Transform(Location(0.0, 0.0, 0.5))]
+
+
+class World:
+
+    def __init__ (self, fps):
+
+        self.frame = 1
+        self.elapsed = 10.0
+        self.period = 1.0 / fps
+        self.settings = WorldSettings()
+        self.map = Map("Town04")
+        self.actors = {}
+        self.callbacks = {}
+        self.callback_ids = itertools.count(1)
+        self.lock = threading.RLock()
+
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="FakeCarlaWorld", daemon=True)
+        self.thread.start()
+
+    def _run (self):
+
+        # Asynchronous mode: one step every period of wall time
+        next_step = time.perf_counter()
+        while self.running:
+            next_step += self.period
+            delay = next_step - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_step = time.perf_counter()   # late, do not try to catch up
+            if not self.settings.synchronous_mode:
+                self._step(self.period)
+
+    def _step (self, dt):
+
+        with self.lock:
+            self.frame += 1
+            self.elapsed += dt
+            snapshot = WorldSnapshot(self, self.frame, self.elapsed, dt)
+            for actor in list(self.actors.values()):
+                if isinstance(actor, Sensor):
+                    actor._emit(self.frame, self.elapsed)
+            for callback in list(self.callbacks.values()):
+                callback(snapshot)
+            return self.frame
+
+    def shutdown (self):
+        self.running = False
+        for actor in list(self.actors.values()):
+            if isinstance(actor, Sensor):
+                actor.stop()
+        self.actors.clear()
+        self.callbacks.clear()
+
+    def tick (self, seconds=10.0):
+        return self._step(self.settings.fixed_delta_seconds or self.period)
+
+    def wait_for_tick (self, seconds=10.0):
+        frame = self.frame
+        while self.frame == frame:
+            time.sleep(self.period / 10)
+        return self.get_snapshot()
+
+    def get_snapshot (self):
+        with self.lock:
+            return WorldSnapshot(self, self.frame, self.elapsed, self.period)
+
+    def get_settings (self):
+        return WorldSettings(self.settings.synchronous_mode, self.settings.fixed_delta_seconds)
+
+    def apply_settings (self, settings):
+        self.settings = WorldSettings(settings.synchronous_mode, settings.fixed_delta_seconds)
+        return self.frame
+
+    def on_tick (self, callback):
+        callback_id = next(self.callback_ids)
+        self.callbacks[callback_id] = callback
+        return callback_id
+
+    def remove_on_tick (self, callback_id):
+        self.callbacks.pop(callback_id, None)
+
+    def get_blueprint_library (self):
+        return BlueprintLibrary()
+
+    def get_map (self):
+        return self.map
+
+    def get_actors (self):
+        return ActorList(self.actors.values())
+
+    def spawn_actor (self, blueprint, transform, attach_to=None):
+        cls = Sensor if blueprint.id.startswith("sensor.") else Actor
+        actor = cls(self, blueprint, transform, attach_to)
+        with self.lock:
+            self.actors[actor.id] = actor
+        return actor
+
+    def try_spawn_actor (self, blueprint, transform, attach_to=None):
+        return self.spawn_actor(blueprint, transform, attach_to)
+
+    def destroy_actor (self, actor):
+        if isinstance(actor, Sensor):
+            actor.stop()
+        with self.lock:
+            self.actors.pop(actor.id, None)
+
+
+class TrafficManager:
+
+    def __init__ (self, port):
+        self.port = port
+
+    def get_port (self):
+        return self.port
+
+
+class Client:
+
+    def __init__ (self, host="localhost", port=2000, worker_threads=0):
+        global _world
+        with _world_lock:
+            if _world is None:
+                _world = World(_config["fps"])
+        self.world = _world
+
+    def set_timeout (self, seconds):
+        pass
+
+    def get_world (self):
+        return self.world
+
+    def load_world (self, map_name):
+        self.world.map = Map(map_name)
+        return self.world
+
+    def get_trafficmanager (self, port=8000):
+        return TrafficManager(port)
+
+    def start_recorder (self, filename, additional_data=False):
+        # An empty file, only its name is used by replay.py
+        open(filename, "w").close()
+        return filename
+
+    def stop_recorder (self):
+        pass
+
+    def show_recorder_file_info (self, filename, show_all=False):
+        return (f"Version: 1\nMap: {self.world.map.name}\nDate: 01/01/25 00:00:00\n\n"
+                f"Frames: {int(_config['duration'] * _config['fps'])}\n"
+                f"Duration: {_config['duration']} seconds\n")
+
+    def replay_file (self, filename, start, duration, follow_id, replay_sensors=False):
+        # The actors of recorder.py --extra_actor
+        self.world.spawn_actor(ActorBlueprint("vehicle.tesla.model3"), Transform())
+        self.world.spawn_actor(ActorBlueprint("vehicle.diamondback.century"),
+                               Transform(Location(10.0, 0.0, 0.0)))
+        return f"Replaying file '{filename}'"
@@ -0,0 +1,570 @@
+#!/usr/bin/env python3
+#
+#
+#  Copyright (C) URJC DeepRacer
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+#  Author : Roberto Calvo Palomino <roberto.calvo at urjc dot es
+#           Sergio Robledo <s.robledo.2021 at alumnos dot urjc dot es>
+
+# Runs the real replay_loop and recorder.game_loop against the CARLA
+# stand-in of fake_carla/ (headless), and micro benchmarks of the mask, the
+# dataset writer, the speed alignment and the plots of visualize_dataset.py.
+# Results go to a JSON file that can be compared with a previous one:
+#
+#   python3 -m benchmarks.run --output before.json
+#   python3 -m benchmarks.run --output after.json --compare before.json
+#   python3 -m benchmarks.run --only "mask*" "save_sample_*" --quick
+
+import os
+import sys
+import json
+import time
+import shutil
+import fnmatch
+import platform
+import argparse
+import tempfile
+import threading
+import contextlib
+import subprocess
+import signal
+from types import SimpleNamespace
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.dirname(BENCHMARKS_PATH)
+FAKE_CARLA_PATH = os.path.join(BENCHMARKS_PATH, "fake_carla")
+
+# The stand-in goes before any installed carla module
+sys.path.insert(0, REPO_PATH)
+sys.path.insert(0, FAKE_CARLA_PATH)
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import numpy as np
+import pandas as pd
+
+import carla
+import metrics
+
+RESULTS_VERSION = 1
+
+# Dataset rows of the load_speed_from_csv benchmarks
+ALIGN_SIZES = {"1k": 1000, "100k": 100000, "1M": 1000000}
+
+
+def summarize (times, items=1, **extra):
+
+    # Timing of the repetitions of one benchmark, per item from the median
+    times = sorted(times)
+    median = times[len(times) // 2]
+    result = {"repeat": len(times), "items": items,
+              "min_s": times[0], "median_s": median, "mean_s": sum(times) / len(times), "max_s": times[-1],
+              "per_item_s": median / items if items else 0.0,
+              "items_per_s": items / median if median > 0 else 0.0}
+    result.update(extra)
+    return result
+
+
+def measure (run, repeat, items=1, setup=None, **extra):
+
+    # run(state) is timed, setup() is not
+    times = []
+    for _ in range(repeat):
+        state = setup() if setup is not None else None
+        t0 = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - t0)
+    return summarize(times, items, **extra)
+
+
+def road_frame (width, height, seed=0):
+
+    # BGR frame of the CARLA stand-in cameras
+    return np.ascontiguousarray(carla._road_frame(width, height, seed)[:, :, :3])
+
+
+def write_speed_source (filename, rows, fps=30.0):
+
+    # data.csv as written by recorder.py --telemetry_csv
+    t = np.arange(rows) / fps
+    pd.DataFrame({"frame": np.arange(rows), "sim_time": np.round(t, 6),
+                  "speed_m_s": np.round(8.0 + 2.0 * np.sin(0.2 * t), 6)}).to_csv(filename, index=False)
+
+
+def write_dataset_csv (filename, rows, fps=30.0):
+
+    # dataset.csv with the columns of DatasetSaver and sample times between
+    # the telemetry samples
+    t = (np.arange(rows) + 0.37) / fps
+    names = [f"{i}.png" for i in range(rows)]
+    pd.DataFrame({"rgb": [f"/rgb/{n}" for n in names], "mask": [f"/mask/{n}" for n in names],
+                  "timestamp": np.round(t, 6), "throttle": 0.5, "steer": 0.0, "brake": 0.0,
+                  "speed": 0.0}).to_csv(filename, index=False)
+
+
+def make_log (path, duration, fps, town="Town04"):
+
+    # Log directory of recorder.py --extra_actor: the (empty) CARLA log,
+    # replayed by the stand-in, and telemetry.bin
+    from telemetry import TelemetryFile, TELEMETRY_BIN_FILENAME
+
+    os.makedirs(path, exist_ok=True)
+    open(os.path.join(path, town + ".log"), "w").close()
+    telemetry = TelemetryFile(os.path.join(path, TELEMETRY_BIN_FILENAME), ["ego", "bike"])
+    for frame in range(int(duration * fps) + int(fps)):
+        t = frame / fps
+        speed = 8.0 + 2.0 * np.sin(0.2 * t)
+        for role, actor_id in (("ego", 100), ("bike", 101)):
+            telemetry.append(frame, t, role, actor_id, (0.0,) * 6 + (speed, 0.0, 0.0, 0.0, 0.0, 0.0, speed))
+    telemetry.close()
+    return path
+
+
+def read_metrics (path):
+
+    # Mean and p99 of each stage (ms), counters and gauges of a run
+    with open(os.path.join(path, metrics.JSON_FILENAME)) as f:
+        data = json.load(f)
+    stages = {name: {"count": s["count"], "mean_ms": s["mean"] * 1000.0, "p99_ms": s["p99"] * 1000.0}
+              for name, s in data["stages"].items()}
+    return {"stages": stages, "counters": data["counters"], "gauges": data["gauges"]}
+
+
+@contextlib.contextmanager
+def quiet (log_filename):
+
+    # The output of the scripts goes to a log file, not to the results
+    with open(log_filename, "w") as f, contextlib.redirect_stdout(f):
+        yield
+
+
+@contextlib.contextmanager
+def stop_after (seconds):
+
+    # SIGTERM to this process after seconds, as a batch scheduler would do:
+    # the scripts turn it into KeyboardInterrupt and stop cleanly
+    previous = signal.getsignal(signal.SIGTERM)
+    timer = threading.Timer(seconds, os.kill, (os.getpid(), signal.SIGTERM))
+    timer.start()
+    try:
+        yield
+    finally:
+        timer.cancel()
+        signal.signal(signal.SIGTERM, previous)
+
+
+def call_script (main, args):
+
+    # Runs the main function of a script, which ends with sys.exit()
+    try:
+        main(args)
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            raise RuntimeError(f"exit code {e.code}")
+
+
+# Benchmarks: name -> function(opts, tmp) returning a result dict
+
+def bench_mask_lut_build (opts, tmp):
+
+    from mask_engine import build_class_lut, _lut_cache
+
+    def setup():
+        _lut_cache.clear()
+
+    return measure(lambda _: build_class_lut(), 1 if opts.quick else 3, setup=setup)
+
+
+def bench_mask (opts, tmp):
+
+    from mask_engine import MaskEngine
+
+    engine = MaskEngine()
+    frames = [road_frame(opts.width, opts.height, i) for i in range(4)]
+    n = opts.frames
+
+    def run(_):
+        for i in range(n):
+            engine(frames[i % len(frames)], order="bgr")
+
+    return measure(run, opts.repeat, items=n, resolution=[opts.width, opts.height])
+
+
+def _bench_save_sample (opts, tmp, storage, writer_threads=0, mask_format="palette"):
+
+    from dataset_manager import DatasetSaver
+    from mask_engine import MaskEngine
+
+    # The engine reuses its buffers, each class map is copied
+    engine = MaskEngine()
+    frames = [road_frame(opts.width, opts.height, i) for i in range(4)]
+    masks = [engine.classify(bgr, order="bgr").copy() for bgr in frames]
+    n = opts.frames
+
+    def setup():
+        path = os.path.join(tmp, f"save_{storage}_{writer_threads}_{mask_format}")
+        shutil.rmtree(path, ignore_errors=True)
+        with quiet(os.path.join(tmp, "save_sample.log")):
+            return DatasetSaver(path + os.sep, writer_threads=writer_threads, storage=storage,
+                                mask_format=mask_format)
+
+    def run(dataset):
+        with quiet(os.path.join(tmp, "save_sample.log")):
+            for i in range(n):
+                dataset.save_sample(i / 30.0, frames[i % len(frames)], masks[i % len(masks)],
+                                    0.5, 0.0, 0.0, 8.0)
+            # Pending writes are part of the cost
+            dataset.close()
+
+    return measure(run, opts.repeat, items=n, setup=setup, resolution=[opts.width, opts.height])
+
+
+def bench_save_sample_png (opts, tmp):
+    return _bench_save_sample(opts, tmp, "png")
+
+
+def bench_save_sample_png_rgb_mask (opts, tmp):
+    return _bench_save_sample(opts, tmp, "png", mask_format="rgb")
+
+
+def bench_save_sample_png_threads (opts, tmp):
+    return _bench_save_sample(opts, tmp, "png", writer_threads=4)
+
+
+def bench_save_sample_tar (opts, tmp):
+    return _bench_save_sample(opts, tmp, "tar")
+
+
+def bench_save_sample_raw (opts, tmp):
+    return _bench_save_sample(opts, tmp, "raw")
+
+
+def _bench_read_batches (opts, tmp, storage, workers=4):
+
+    from dataset_manager import DatasetSaver, DatasetReader
+    from mask_engine import MaskEngine
+
+    # A dataset of opts.frames samples, read shuffled in batches of 32
+    engine = MaskEngine()
+    frames = [road_frame(opts.width, opts.height, i) for i in range(4)]
+    path = os.path.join(tmp, f"read_{storage}")
+    shutil.rmtree(path, ignore_errors=True)
+    with quiet(os.path.join(tmp, "read.log")):
+        dataset = DatasetSaver(path + os.sep, storage=storage, sidecar=True)
+        for i in range(opts.frames):
+            bgr = frames[i % len(frames)]
+            dataset.save_sample(i / 30.0, bgr, engine.classify(bgr, order="bgr"), 0.5, 0.0, 0.0, 8.0)
+        dataset.close()
+
+    def run(_):
+        reader = DatasetReader(dataset.dataset_path, workers=workers)
+        for _ in reader.batches(32, shuffle=True, seed=0):
+            pass
+        reader.close()
+
+    result = measure(run, opts.repeat, items=opts.frames, workers=workers)
+    shutil.rmtree(path, ignore_errors=True)
+    return result
+
+
+def bench_read_batches_png (opts, tmp):
+    return _bench_read_batches(opts, tmp, "png")
+
+
+def bench_read_batches_tar (opts, tmp):
+    return _bench_read_batches(opts, tmp, "tar")
+
+
+def bench_read_batches_raw (opts, tmp):
+    return _bench_read_batches(opts, tmp, "raw")
+
+
+def _bench_load_speed (opts, tmp, size):
+
+    from dataset_manager import DatasetSaver
+
+    rows = ALIGN_SIZES[size]
+    path = os.path.join(tmp, f"align_{size}")
+    shutil.rmtree(path, ignore_errors=True)
+    with quiet(os.path.join(tmp, "align.log")):
+        dataset = DatasetSaver(path + os.sep)
+        dataset.close()
+    source = os.path.join(path, "data.csv")
+    write_speed_source(source, rows)
+    write_dataset_csv(dataset.csv_filename, rows)
+
+    # The dataset is rewritten in place, every repetition does the same work
+    def run(_):
+        with quiet(os.path.join(tmp, "align.log")):
+            if dataset.load_speed_from_csv(dataset.csv_filename, source) is None:
+                raise RuntimeError("alignment failed")
+
+    repeat = 1 if rows >= 1000000 or opts.quick else opts.repeat
+    result = measure(run, repeat, items=rows)
+    shutil.rmtree(path, ignore_errors=True)
+    return result
+
+
+def bench_load_speed_from_csv_1k (opts, tmp):
+    return _bench_load_speed(opts, tmp, "1k")
+
+
+def bench_load_speed_from_csv_100k (opts, tmp):
+    return _bench_load_speed(opts, tmp, "100k")
+
+
+def bench_load_speed_from_csv_1M (opts, tmp):
+    return _bench_load_speed(opts, tmp, "1M")
+
+
+def bench_render_plot (opts, tmp):
+
+    import visualize_dataset
+
+    rows = 5000
+    t = np.arange(rows) / 30.0
+    df = pd.DataFrame({"timestamp": t, "throttle": 0.5 + 0.3 * np.sin(t), "steer": 0.2 * np.sin(0.3 * t),
+                       "brake": 0.0, "speed": 8.0 + 2.0 * np.sin(0.2 * t)})
+    panel = visualize_dataset.PlotPanel(df)
+    n = opts.frames * 4
+
+    def run(_):
+        for i in range(n):
+            panel.render(100 + i)
+
+    return measure(run, opts.repeat, items=n)
+
+
+def replay_args (log_path, dataset_path, metrics_path, **overrides):
+
+    # The defaults of the replay.py command line
+    args = dict(log_path=log_path, port=3010, tport=3020, generate_dataset_path=dataset_path,
+                dataset_types=["rgb", "mask"], sync=True, sync_fps=30.0, writer_threads=0,
+                writer_queue=32, metadata_flush_rows=256, metadata_sidecar=False, storage="png",
+                shard_size=1000, views=["car"], start=0.0, duration=0.0, warmup=0.0, ring_slots=8, ring_policy="drop_oldest",
+                headless=True, preview_every=1, metrics=metrics_path, metrics_interval=3600.0,
+                workers=0, mask_format="palette", skip_redundant=0.0, skip_redundant_interval=1.0)
+    args.update(overrides)
+    return SimpleNamespace(**args)
+
+
+def _bench_replay (opts, tmp, name, duration, stopped=0.0, **overrides):
+
+    import replay
+
+    log_path = make_log(os.path.join(tmp, "log"), duration, opts.fps)
+    times = []
+    for _ in range(1 if opts.quick else max(1, opts.repeat // 2)):
+        dataset_path = os.path.join(tmp, name) + os.sep
+        metrics_path = os.path.join(tmp, name + "_metrics")
+        shutil.rmtree(dataset_path, ignore_errors=True)
+
+        carla.configure(fps=opts.fps, duration=duration, stopped=stopped)
+        carla.reset()
+        metrics.reset()
+        args = replay_args(log_path, dataset_path, metrics_path, **overrides)
+        t0 = time.perf_counter()
+        with quiet(os.path.join(tmp, name + ".log")):
+            call_script(lambda a: replay.replay_loop(a, a.views), args)
+        times.append(time.perf_counter() - t0)
+
+    run = read_metrics(metrics_path)
+    metrics.reset()
+    carla.configure(stopped=0.0)
+    carla.reset()
+    samples = run["counters"].get("samples_written", 0)
+    if samples == 0:
+        raise RuntimeError(f"no sample written, see {os.path.join(tmp, name + '.log')}")
+
+    # Samples skipped by --skip_redundant were handled too
+    items = samples + run["counters"].get("redundant_samples", 0)
+    return summarize(times, items=items, sim_seconds=duration, **run)
+
+
+def bench_replay_sync (opts, tmp):
+    return _bench_replay(opts, tmp, "replay_sync", opts.duration)
+
+
+def bench_replay_sync_threads (opts, tmp):
+    return _bench_replay(opts, tmp, "replay_sync_threads", opts.duration, writer_threads=4)
+
+
+def bench_replay_sync_skip_redundant (opts, tmp):
+    # Stopped half of the time, the redundant samples are not saved
+    return _bench_replay(opts, tmp, "replay_sync_skip_redundant", opts.duration, stopped=0.5,
+                         skip_redundant=2.0)
+
+
+def bench_replay_async (opts, tmp):
+    # Real time at the stand-in rate, the frames lost are the interesting part
+    return _bench_replay(opts, tmp, "replay_async", opts.realtime, sync=False)
+
+
+def bench_recorder (opts, tmp):
+
+    import recorder
+
+    carla.configure(fps=opts.fps)
+    carla.reset()
+    metrics.reset()
+    metrics_path = os.path.join(tmp, "recorder_metrics")
+    args = SimpleNamespace(log_path=os.path.join(tmp, "recorder_logs"), town="Town04", port=3010,
+                           tport=3020, extra_actor=True, telemetry_csv=False, metrics=metrics_path,
+                           metrics_interval=3600.0, headless=True, preview_every=1)
+
+    t0 = time.perf_counter()
+    with quiet(os.path.join(tmp, "recorder.log")), stop_after(opts.realtime):
+        call_script(recorder.game_loop, args)
+    elapsed = time.perf_counter() - t0
+
+    run = read_metrics(metrics_path)
+    metrics.reset()
+    carla.reset()
+    frames = run["counters"].get("telemetry_frames", 0)
+    return summarize([elapsed], items=frames, expected_frames=int(opts.realtime * opts.fps), **run)
+
+
+BENCHMARKS = {name[len("bench_"):]: fn for name, fn in globals().items() if name.startswith("bench_")}
+
+
+def environment (opts):
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_PATH,
+                                capture_output=True, text=True, timeout=10).stdout.strip()
+    except Exception:
+        commit = ""
+
+    import cv2
+    return {"date": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit,
+            "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(), "numpy": np.__version__, "opencv": cv2.__version__,
+            "pandas": pd.__version__,
+            "options": {"frames": opts.frames, "repeat": opts.repeat, "fps": opts.fps,
+                        "duration": opts.duration, "realtime": opts.realtime,
+                        "resolution": [opts.width, opts.height], "quick": opts.quick}}
+
+
+def compare (results, baseline):
+
+    # Time per item against a previous run (< 1.0 is faster)
+    print(f"\n{'benchmark':32s} {'before':>12s} {'after':>12s} {'ratio':>8s}")
+    for name, result in results["benchmarks"].items():
+        old = baseline.get("benchmarks", {}).get(name)
+        if not old or "per_item_s" not in old or "per_item_s" not in result:
+            continue
+        before, after = old["per_item_s"], result["per_item_s"]
+        ratio = after / before if before > 0 else float("nan")
+        print(f"{name:32s} {before * 1000:10.3f}ms {after * 1000:10.3f}ms {ratio:8.2f}")
+
+
+def parse_args ():
+
+    parser = argparse.ArgumentParser(description="Offline benchmarks with a CARLA stand-in")
+
+    parser.add_argument("--only", type=str, nargs="+", default=None, metavar="PATTERN",
+                        help=f"Benchmarks to run (shell patterns): {', '.join(BENCHMARKS)}")
+
+    parser.add_argument("--output", type=str, default="benchmark_results.json",
+                        help="JSON file with the results")
+
+    parser.add_argument("--compare", type=str, default=None,
+                        help="Results of a previous run to compare with")
+
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Repetitions of each micro benchmark (the median is reported)")
+
+    parser.add_argument("--frames", type=int, default=50,
+                        help="Frames of each repetition of the micro benchmarks")
+
+    parser.add_argument("--width", type=int, default=800,
+                        help="Frame width of the micro benchmarks")
+
+    parser.add_argument("--height", type=int, default=600,
+                        help="Frame height of the micro benchmarks")
+
+    parser.add_argument("--fps", type=float, default=30.0,
+                        help="Simulation steps per second of the stand-in")
+
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="Simulated seconds of the synchronous replays")
+
+    parser.add_argument("--realtime", type=float, default=5.0,
+                        help="Wall seconds of the real time runs (recorder, asynchronous replay)")
+
+    parser.add_argument("--quick", action="store_true",
+                        help="One repetition and fewer frames, to check that everything runs")
+
+    parser.add_argument("--tmp", type=str, default=None,
+                        help="Directory for the datasets and logs (default: a temporary one, removed)")
+
+    opts = parser.parse_args()
+    if opts.quick:
+        opts.repeat = 1
+        opts.frames = min(opts.frames, 10)
+        opts.duration = min(opts.duration, 3.0)
+        opts.realtime = min(opts.realtime, 2.0)
+    return opts
+
+
+def main ():
+
+    opts = parse_args()
+
+    names = list(BENCHMARKS)
+    if opts.only:
+        names = [n for n in names if any(fnmatch.fnmatch(n, p) for p in opts.only)]
+        if not names:
+            print(f"[ERROR] No benchmark matches {opts.only}")
+            return 1
+
+    tmp = opts.tmp or tempfile.mkdtemp(prefix="carla_bench_")
+    os.makedirs(tmp, exist_ok=True)
+    results = {"version": RESULTS_VERSION, "environment": environment(opts), "benchmarks": {}}
+
+    failed = 0
+    try:
+        for name in names:
+            print(f"[INFO] {name} ...", end=" ", flush=True)
+            try:
+                result = BENCHMARKS[name](opts, tmp)
+                print(f"{result['per_item_s'] * 1000:.3f} ms/item ({result['items_per_s']:.1f} items/s)")
+            except ImportError as e:
+                result = {"skipped": str(e)}
+                print(f"skipped ({e})")
+            except Exception as e:
+                result = {"error": f"{type(e).__name__}: {e}"}
+                failed += 1
+                print(f"[ERROR] {e}")
+            results["benchmarks"][name] = result
+    finally:
+        if opts.tmp is None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    with open(opts.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"[INFO] Results written to {opts.output}")
+
+    if opts.compare:
+        with open(opts.compare) as f:
+            compare(results, json.load(f))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
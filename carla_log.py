@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+#
+#
+#  Copyright (C) URJC DeepRacer
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+#  Author : Roberto Calvo Palomino <roberto.calvo at urjc dot es
+#           Sergio Robledo <s.robledo.2021 at alumnos dot urjc dot es>
+
+# Reads the CARLA 0.9.15 recorder files (.log) without a simulator: map,
+# date, number of frames, duration, frame times and the actors spawned
+# (type id, role name, when they appear and disappear). The file is read
+# packet by packet through mmap, only frame starts and actor events are
+# decoded, everything else is skipped.
+#
+# Results are cached in log_index.json, in the directory of each log, and
+# refreshed when the log changes (size or modification time):
+#
+#   from carla_log import log_info
+#   info = log_info("logs/1763717922_Town04/Town04.log")
+#   info["duration"], info["map"], [a["type_id"] for a in info["actors"]]
+#
+#   python3 carla_log.py logs/ --actor "vehicle.diamondback.*" --min_duration 60
+
+import os
+import sys
+import json
+import mmap
+import struct
+import fnmatch
+import argparse
+
+import numpy as np
+
+
+LOG_INDEX_FILENAME = "log_index.json"
+LOG_INDEX_VERSION = 1
+
+RECORDER_MAGIC = "CARLA_RECORDER"
+
+# Packet ids of the recorder (CarlaRecorder.h)
+PACKET_FRAME_START = 0
+PACKET_EVENT_ADD = 2
+PACKET_EVENT_DEL = 3
+
+_PACKET_HEADER = struct.Struct("<BI")      # id, size
+_FRAME_START = struct.Struct("<Qdd")        # frame id, duration, elapsed
+_EVENT_ADD = struct.Struct("<IB6fI")        # database id, type, location, rotation, uid
+_UINT16 = struct.Struct("<H")
+_UINT32 = struct.Struct("<I")
+_INT64 = struct.Struct("<q")
+
+
+def _read_fstring (buf, offset):
+
+    # uint16 length + UTF-8 bytes. Returns (string, next offset)
+    (length,) = _UINT16.unpack_from(buf, offset)
+    offset += _UINT16.size
+    end = offset + length
+    if end > len(buf):
+        raise ValueError("string out of the file")
+    return bytes(buf[offset:end]).decode("utf-8", errors="replace").rstrip("\0"), end
+
+
+def _read_header (buf):
+
+    # version, magic, date, map. Returns (header, offset of the first packet)
+    (version,) = _UINT16.unpack_from(buf, 0)
+    magic, offset = _read_fstring(buf, _UINT16.size)
+    if magic != RECORDER_MAGIC:
+        raise ValueError("not a CARLA recorder file")
+    (date,) = _INT64.unpack_from(buf, offset)
+    offset += _INT64.size
+    map_name, offset = _read_fstring(buf, offset)
+    return {"version": version, "date": date, "map": map_name.split("/")[-1]}, offset
+
+
+def _read_event_add (buf, offset, end, elapsed, actors):
+
+    # uint16 count, then per actor: id, type, location, rotation, uid,
+    # type id and the attributes (type, id, value)
+    (count,) = _UINT16.unpack_from(buf, offset)
+    offset += _UINT16.size
+    for _ in range(count):
+        fields = _EVENT_ADD.unpack_from(buf, offset)
+        offset += _EVENT_ADD.size
+        type_id, offset = _read_fstring(buf, offset)
+        (n_attributes,) = _UINT16.unpack_from(buf, offset)
+        offset += _UINT16.size
+        role_name = ""
+        for _ in range(n_attributes):
+            offset += 1
+            key, offset = _read_fstring(buf, offset)
+            value, offset = _read_fstring(buf, offset)
+            if key == "role_name":
+                role_name = value
+        if offset > end:
+            raise ValueError("actor event out of its packet")
+
+        actors[fields[0]] = {"id": fields[0], "type": fields[1], "type_id": type_id,
+                             "role_name": role_name, "location": [round(v, 3) for v in fields[2:5]],
+                             "spawned": elapsed, "destroyed": None}
+
+
+def _read_event_del (buf, offset, end, elapsed, actors):
+
+    (count,) = _UINT16.unpack_from(buf, offset)
+    offset += _UINT16.size
+    if offset + count * _UINT32.size > end:
+        raise ValueError("actor event out of its packet")
+    for i in range(count):
+        (actor_id,) = _UINT32.unpack_from(buf, offset + i * _UINT32.size)
+        if actor_id in actors and actors[actor_id]["destroyed"] is None:
+            actors[actor_id]["destroyed"] = elapsed
+
+
+def read_log (filename, frame_times=False):
+
+    # Parses a recorder file. Returns a dict with the header (version, date,
+    # map), frames, duration (elapsed time of the last frame, as the
+    # "Duration" of show_recorder_file_info), frame_dt (mean, min, max), the
+    # actors and, if frame_times, the elapsed time of every frame (array).
+    # A log cut by a crash is read up to its last whole packet (truncated).
+    size = os.path.getsize(filename)
+    if size == 0:
+        raise ValueError("empty file")
+
+    with open(filename, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        try:
+            info, offset = _read_header(buf)
+        except struct.error:
+            raise ValueError("truncated header")
+
+        actors = {}
+        times = []
+        frames = 0
+        first_elapsed = None
+        elapsed = 0.0
+        dt_min, dt_max = float("inf"), 0.0
+        truncated = False
+
+        header_size = _PACKET_HEADER.size
+        while offset < size:
+            if offset + header_size > size:
+                truncated = True
+                break
+            packet_id, packet_size = _PACKET_HEADER.unpack_from(buf, offset)
+            start = offset + header_size
+            end = start + packet_size
+            if end > size:
+                truncated = True
+                break
+
+            if packet_id == PACKET_FRAME_START:
+                if start + _FRAME_START.size > end:
+                    raise ValueError(f"bad frame start at byte {offset}: packet too small")
+                _, dt, elapsed = _FRAME_START.unpack_from(buf, start)
+                frames += 1
+                if first_elapsed is None:
+                    first_elapsed = elapsed
+                elif dt > 0:
+                    dt_min = min(dt_min, dt)
+                    dt_max = max(dt_max, dt)
+                if frame_times:
+                    times.append(elapsed)
+            elif packet_id == PACKET_EVENT_ADD:
+                try:
+                    _read_event_add(buf, start, end, elapsed, actors)
+                except (struct.error, ValueError) as e:
+                    raise ValueError(f"bad actor event at byte {offset}: {e}")
+            elif packet_id == PACKET_EVENT_DEL:
+                try:
+                    _read_event_del(buf, start, end, elapsed, actors)
+                except (struct.error, ValueError) as e:
+                    raise ValueError(f"bad actor event at byte {offset}: {e}")
+
+            offset = end
+
+    info.update({
+        "frames": frames,
+        "duration": elapsed,
+        "frame_dt": {"mean": (elapsed - first_elapsed) / (frames - 1) if frames > 1 else 0.0,
+                     "min": dt_min if frames > 1 and dt_min != float("inf") else 0.0,
+                     "max": dt_max},
+        "truncated": truncated,
+        "actors": list(actors.values()),
+    })
+    if frame_times:
+        info["frame_times"] = np.array(times, dtype=np.float64)
+    return info
+
+
+def _load_index (path):
+
+    filename = os.path.join(path, LOG_INDEX_FILENAME)
+    try:
+        with open(filename) as f:
+            index = json.load(f)
+        if index.get("version") == LOG_INDEX_VERSION:
+            return index
+    except (OSError, ValueError):
+        pass
+    return {"version": LOG_INDEX_VERSION, "logs": {}}
+
+
+def _save_index (path, index):
+
+    # Replaced atomically, a read-only directory only loses the cache
+    filename = os.path.join(path, LOG_INDEX_FILENAME)
+    tmp = os.path.join(path, f".{LOG_INDEX_FILENAME}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, filename)
+    except OSError as e:
+        print(f"[WARN] Unable to write {filename}: {e}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def index_directory (path, refresh=False):
+
+    # {log filename: info} of the .log files of a directory, from its index
+    # (parsing only new or modified logs). Unreadable logs are left out.
+    index = _load_index(path)
+    logs = {}
+    changed = False
+    names = sorted(n for n in os.listdir(path) if n.endswith(".log"))
+
+    for name in names:
+        filename = os.path.join(path, name)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            continue
+        entry = index["logs"].get(name)
+        if refresh or entry is None or entry["size"] != st.st_size or entry["mtime"] != st.st_mtime:
+            try:
+                info = read_log(filename)
+            except (OSError, ValueError, struct.error) as e:
+                print(f"[WARN] {filename}: {e}")
+                if name in index["logs"]:
+                    del index["logs"][name]
+                    changed = True
+                continue
+            entry = {"size": st.st_size, "mtime": st.st_mtime, "info": info}
+            index["logs"][name] = entry
+            changed = True
+        logs[filename] = entry["info"]
+
+    # Logs that do not exist anymore
+    for name in [n for n in index["logs"] if n not in names]:
+        del index["logs"][name]
+        changed = True
+
+    if changed:
+        _save_index(path, index)
+    return logs
+
+
+def log_info (filename):
+
+    # Info of one log, through the index of its directory. None if the file
+    # cannot be read as a recorder file.
+    filename = os.path.abspath(filename)
+    return index_directory(os.path.dirname(filename)).get(filename)
+
+
+def match_log (info, actors=None, town=None, min_duration=None):
+
+    # actors: type id patterns (e.g. "vehicle.diamondback.*"), all of them
+    # must be spawned in the log
+    if town is not None and info["map"] != town:
+        return False
+    if min_duration is not None and info["duration"] < min_duration:
+        return False
+    for pattern in actors or []:
+        if not any(fnmatch.fnmatch(a["type_id"], pattern) for a in info["actors"]):
+            return False
+    return True
+
+
+def find_logs (root, actors=None, town=None, min_duration=None, refresh=False):
+
+    # {log filename: info} of the logs under root matching the filters
+    logs = {}
+    for path, dirs, files in os.walk(root):
+        dirs.sort()
+        if any(f.endswith(".log") for f in files):
+            for filename, info in index_directory(path, refresh).items():
+                if match_log(info, actors, town, min_duration):
+                    logs[filename] = info
+    return logs
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="List the CARLA logs of a directory without a simulator")
+
+    parser.add_argument("path", type=str,
+                        help="A .log file or a directory, searched recursively")
+
+    parser.add_argument("--actor", type=str, nargs="+", default=None,
+                        help="Only logs with actors of these type ids (e.g. 'vehicle.diamondback.*')")
+
+    parser.add_argument("--town", type=str, default=None,
+                        help="Only logs of this map (e.g. Town04)")
+
+    parser.add_argument("--min_duration", type=float, default=None,
+                        help="Only logs of at least this duration (s)")
+
+    parser.add_argument("--refresh", action="store_true",
+                        help="Parse the logs again, ignoring the index")
+
+    parser.add_argument("--actors", action="store_true",
+                        help="Print the actors of each log")
+
+    parser.add_argument("--json", action="store_true",
+                        help="Print the information as JSON")
+
+    args = parser.parse_args()
+
+    if os.path.isfile(args.path):
+        try:
+            info = read_log(args.path)
+        except (OSError, ValueError) as e:
+            print(f"[ERROR] {args.path}: {e}")
+            sys.exit(1)
+        logs = {args.path: info} if match_log(info, args.actor, args.town, args.min_duration) else {}
+    else:
+        logs = find_logs(args.path, args.actor, args.town, args.min_duration, args.refresh)
+
+    if args.json:
+        print(json.dumps(logs, indent=2))
+        sys.exit(0 if logs else 1)
+
+    for filename, info in logs.items():
+        vehicles = sorted({a["type_id"] for a in info["actors"] if a["type_id"].startswith("vehicle.")})
+        print(f"{filename}: {info['map']}, {info['duration']:.2f} s, {info['frames']} frames"
+              f"{' (truncated)' if info['truncated'] else ''}, {', '.join(vehicles)}")
+        if args.actors:
+            for a in info["actors"]:
+                destroyed = f"{a['destroyed']:.2f}" if a["destroyed"] is not None else "-"
+                print(f"  - {a['id']:6d} {a['type_id']:40s} {a['role_name']:12s} "
+                      f"{a['spawned']:8.2f} {destroyed:>8s}")
+
+    print(f"[INFO] {len(logs)} logs")
+    sys.exit(0 if logs else 1)
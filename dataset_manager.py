@@ -22,14 +22,197 @@
 import os
 import time
 import csv
+import json
+import queue
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 
 import numpy as np
-import pandas as pd
+
+import metrics
+from dataset_storage import (SHARDS_FOLDERNAME, RAW_FOLDERNAME, ShardReader, RawFrameReader,
+                             open_storage, encode_class_png, decode_class_png)
+from mask_engine import LANE_CLASSES, SEMANTIC_PALETTE, SEMANTIC_TAGS, class_colors
+
+
+# Image types a dataset can contain, in column order
+IMAGE_TYPES = ["rgb", "mask", "segmented"]
+
+# How lane masks are stored: palettized PNG of class ids (viewers show the
+# colours), plain single channel class ids, or BGR colour images (old format)
+MASK_FORMATS = ["palette", "class", "rgb"]
+
+# Class ids and colours of the masks of a dataset
+CLASSES_FILENAME = "classes.json"
+
+DATA_COLUMNS = [("timestamp", np.float64), ("throttle", np.float64), ("steer", np.float64),
+                ("brake", np.float64), ("speed", np.float64)]
+
+
+def dataset_columns (image_types=("rgb", "mask")):
+
+    # One path column per image type, then the sample data
+    return [(f"{t}_path", str) for t in IMAGE_TYPES if t in image_types] + DATA_COLUMNS
+
+
+def _colors_to_classes (mask_rgb, colors):
+
+    # Class id of each pixel of a colour mask, 0 for unknown colours
+    packed = ((mask_rgb[:, :, 0].astype(np.uint32) << 16) |
+              (mask_rgb[:, :, 1].astype(np.uint32) << 8) | mask_rgb[:, :, 2])
+    codes = (colors[:, 0].astype(np.uint32) << 16) | (colors[:, 1].astype(np.uint32) << 8) | colors[:, 2]
+    order = np.argsort(codes)
+    pos = np.minimum(np.searchsorted(codes[order], packed), len(codes) - 1)
+    return np.where(codes[order][pos] == packed, order[pos], 0).astype(np.uint8)
+
+
+def encode_mask (mask, mask_format, colors):
+
+    # Lane mask as it is stored, from class ids (H, W) or an RGB colour mask
+    # (H, W, 3): palettized PNG (bytes), class ids or BGR colours for cv2.
+    # colors: RGB colour of each class id, see mask_engine.class_colors
+    if mask_format == "rgb":
+        if mask.ndim == 3:
+            return cv2.cvtColor(mask, cv2.COLOR_RGB2BGR)
+        lut = np.zeros((256, 1, 3), dtype=np.uint8)
+        lut[:len(colors), 0] = colors[:, ::-1]
+        return cv2.LUT(cv2.merge((mask, mask, mask)), lut)
+
+    class_map = _colors_to_classes(mask, colors) if mask.ndim == 3 else mask
+    if mask_format == "palette":
+        return encode_class_png(class_map, colors)
+    return class_map
+
+
+def write_class_table (dataset_path, mask_format, classes=LANE_CLASSES):
+
+    # Classes of the lane masks and of the semantic tags (segmented)
+    colors = class_colors(classes)
+    names = {class_id: name for class_id, name, _, _, _ in classes}
+    table = {
+        "mask": {"format": mask_format,
+                 "classes": [{"id": i, "name": names.get(i, "background"), "color": c.tolist()}
+                             for i, c in enumerate(colors)]},
+        "segmented": {"format": "class",
+                      "classes": [{"id": i, "name": name, "color": list(color)}
+                                  for i, (name, color) in enumerate(zip(SEMANTIC_TAGS, SEMANTIC_PALETTE))]},
+    }
+    with open(os.path.join(dataset_path, CLASSES_FILENAME), "w") as f:
+        json.dump(table, f, indent=2)
+
+
+def read_class_table (dataset_path):
+
+    # None for datasets without classes.json (RGB masks)
+    filename = os.path.join(dataset_path, CLASSES_FILENAME)
+    if not os.path.isfile(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+
+class MetadataSink:
+
+    # Keeps the CSV open and buffers rows in numpy columns, writing them in
+    # batches when flush_rows rows are pending or flush_interval seconds have
+    # passed. Optionally keeps every row to save a typed .npz sidecar on close.
+
+    def __init__ (self, csv_filename, columns, flush_rows=256, flush_interval=1.0,
+                  sidecar_filename=None):
+
+        self.csv_filename = csv_filename
+        self.columns = columns
+        self.flush_rows = max(1, flush_rows)
+        self.flush_interval = flush_interval
+        self.sidecar_filename = sidecar_filename
+
+        self.buffers = {name: np.empty(self.flush_rows, dtype=object if dtype is str else dtype)
+                        for name, dtype in columns}
+        self.pending = 0
+        self.rows = 0
+        self.chunks = {name: [] for name, _ in columns}
+        self.last_flush = time.monotonic()
+
+        new_file = not os.path.exists(csv_filename)
+        self.fh = open(csv_filename, "a", newline="")
+        self.writer = csv.writer(self.fh)
+        if new_file:
+            self.writer.writerow([name for name, _ in columns])
+            self.fh.flush()
+
+    def append (self, *values):
+
+        for (name, _), value in zip(self.columns, values):
+            self.buffers[name][self.pending] = value
+        self.pending += 1
+
+        if (self.pending >= self.flush_rows or
+                time.monotonic() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush (self):
+
+        self.last_flush = time.monotonic()
+        if self.pending == 0:
+            return
+
+        cols = [self.buffers[name][:self.pending] for name, _ in self.columns]
+        with metrics.timer("csv_write"):
+            self.writer.writerows(zip(*[c.tolist() for c in cols]))
+            self.fh.flush()
+
+        if self.sidecar_filename is not None:
+            for (name, dtype), c in zip(self.columns, cols):
+                self.chunks[name].append(c.astype(np.str_) if dtype is str else c.copy())
+
+        self.rows += self.pending
+        self.pending = 0
+
+    def close (self):
+
+        if self.fh is None:
+            return
+
+        self.flush()
+        self.fh.close()
+        self.fh = None
+
+        if self.sidecar_filename is not None:
+            arrays = {}
+            for name, dtype in self.columns:
+                chunks = self.chunks[name]
+                if chunks:
+                    arrays[name] = np.concatenate(chunks)
+                else:
+                    arrays[name] = np.empty(0, dtype=np.str_ if dtype is str else dtype)
+            np.savez(self.sidecar_filename, **arrays)
+
+
+def update_sidecar_column (sidecar_filename, column, values):
+
+    # Replace one column of a .npz sidecar written by MetadataSink
+    if not os.path.isfile(sidecar_filename):
+        return
+
+    with np.load(sidecar_filename) as data:
+        arrays = {name: data[name] for name in data.files}
+
+    if len(arrays.get(column, [])) != len(values):
+        print(f"[WARN] Sidecar {sidecar_filename} not updated, row count mismatch")
+        return
+
+    arrays[column] = np.asarray(values, dtype=arrays[column].dtype)
+    np.savez(sidecar_filename, **arrays)
+
 
 class DatasetSaver:
 
-    def __init__ (self, path):
+    def __init__ (self, path, writer_threads=0, max_pending=32,
+                  flush_rows=256, flush_interval=1.0, sidecar=False,
+                  storage="png", shard_size=1000, dataset_types=("rgb", "mask"),
+                  mask_format="palette", classes=LANE_CLASSES):
 
         self.path = path
         current_time   = str(int(time.time() * 1000))
@@ -37,55 +220,178 @@ class DatasetSaver:
         self.dataset_id = current_time + "_dataset"  
         self.dataset_path = self.path + self.dataset_id
 
+        # Image types saved for each sample, each one in its own folder
+        self.image_types = [t for t in IMAGE_TYPES if t in dataset_types]
+        if not self.image_types:
+            raise ValueError(f"No image type to save in {dataset_types}")
+
         self.rgb_foldername = "rgb"
         self.mask_foldername = "mask"
+        self.segmented_foldername = "segmented"
 
         self.rgb_path = os.path.join(self.dataset_path, self.rgb_foldername)
         self.mask_path = os.path.join(self.dataset_path, self.mask_foldername)
+        self.segmented_path = os.path.join(self.dataset_path, self.segmented_foldername)
         self.csv_filename = os.path.join(self.dataset_path, "dataset.csv")
+        self.sidecar_filename = os.path.join(self.dataset_path, "dataset.npz")
 
         self.counter = 0
 
-        os.makedirs(self.rgb_path, exist_ok=True)
-        os.makedirs(self.mask_path, exist_ok=True)
+        os.makedirs(self.dataset_path, exist_ok=True)
+        if storage == "png":
+            for image_type in self.image_types:
+                os.makedirs(os.path.join(self.dataset_path, image_type), exist_ok=True)
+
+        # Where images go: PNG files (rgb/, mask/) or tar shards (shards/)
+        self.storage = open_storage(self.dataset_path, storage, shard_size)
+
+        # Raw frames keep the class ids as they are
+        if mask_format not in MASK_FORMATS:
+            raise ValueError(f"Unknown mask format {mask_format}")
+        self.mask_format = "class" if storage == "raw" else mask_format
+        self.mask_colors = class_colors(classes)
+        write_class_table(self.dataset_path, self.mask_format, classes)
+
+        # Asynchronous writer: samples are queued and encoded by a pool of
+        # threads (cv2 releases the GIL while encoding). A bounded queue gives
+        # backpressure, so save_sample blocks instead of growing memory.
+        self.write_q = None
+        self.writers = []
+        self.write_errors = 0
+        self.write_lock = threading.Lock()
+
+        # Rows of the samples written out of order (index -> row, None if the
+        # sample failed), until the previous ones are done
+        self.done = {}
+        self.next_row = 0
+
+        if writer_threads > 0:
+            self.write_q = queue.Queue(maxsize=max_pending)
+            for i in range(writer_threads):
+                t = threading.Thread(target=self._writer_worker,
+                                     name=f"DatasetWriter-{i}", daemon=True)
+                t.start()
+                self.writers.append(t)
 
         print (f"DatasetSaver loaded for {self.dataset_path}")
 
-        if not os.path.exists(self.csv_filename):
-            os.makedirs(os.path.dirname(self.csv_filename), exist_ok=True)
-            with open(self.csv_filename, "w", newline="") as f:
-                csv.writer(f).writerow(["rgb_path","mask_path","timestamp",
-                                        "throttle","steer","brake","speed"])
+        self.metadata = MetadataSink(self.csv_filename, dataset_columns(self.image_types),
+                                     flush_rows=flush_rows,
+                                     flush_interval=flush_interval,
+                                     sidecar_filename=self.sidecar_filename if sidecar else None)
 
-    def save_sample (self, timestamp, bgr, mask_rgb, throttle, steer, brake, speed):
-        
-        rgb_filename  = f"rgb_{self.counter:08d}.png"
-        mask_filename = f"mask_{self.counter:08d}.png"
+    def save_sample (self, timestamp, bgr, mask, throttle, steer, brake, speed,
+                     segmented=None):
+
+        # mask: class ids (H, W) or RGB colours (H, W, 3), stored in the
+        # format of the dataset. Images of the types not saved by this dataset
+        # are ignored (can be None).
+        index = self.counter
+        images = {"rgb": bgr, "mask": mask, "segmented": segmented}
+        filenames = self.sample_filenames(index)
         
+        # Numbering is assigned here, in call order, so it stays deterministic
+        # whatever the order in which the writer threads finish
         self.counter = self.counter + 1
 
-        cv2.imwrite(os.path.join(self.rgb_path,  rgb_filename),  bgr)
-        cv2.imwrite(os.path.join(self.mask_path, mask_filename),
-                    cv2.cvtColor(mask_rgb, cv2.COLOR_RGB2BGR))
+        row = [*[f"/{f}" for f in filenames], timestamp, throttle, steer, brake, speed]
 
-        with open(self.csv_filename, "a", newline="") as f:
-            csv.writer(f).writerow([
-                f"/{self.rgb_foldername}/{rgb_filename}",
-                f"/{self.mask_foldername}/{mask_filename}",
-                timestamp, throttle, steer, brake, speed
-            ])        
+        if self.write_q is None:
+            self._write_images(index, filenames, [images[t] for t in self.image_types], row)
+        else:
+            # Copy the frames, the caller is free to reuse its buffers
+            job = (index, filenames, [images[t].copy() for t in self.image_types], row)
+            with metrics.timer("write_queue_wait"):
+                self.write_q.put(job)
+
+    def sample_filenames (self, index):
+
+        # Image paths of a sample, relative to the dataset directory
+        return [f"{t}/{t}_{index:08d}.png" for t in self.image_types]
+
+    def _write_images (self, index, filenames, images, row):
+
+        try:
+            # Masks in the format of the dataset. Segmentation tags are stored
+            # as they are.
+            images = [encode_mask(image, self.mask_format, self.mask_colors) if t == "mask" else image
+                      for t, image in zip(self.image_types, images)]
+
+            with metrics.timer("encode_write"):
+                self.storage.write_sample(index, list(zip(filenames, images)))
+        except Exception as e:
+            with self.write_lock:
+                self.write_errors += 1
+            metrics.inc("write_errors")
+            print(f"[ERROR] Unable to write sample {index}: {e}")
+            row = None
+
+        self._complete(index, row)
+
+    def _complete (self, index, row):
+
+        # Only samples on disk get a row, written in index order whatever the
+        # order in which the writer threads finish
+        with self.write_lock:
+            self.done[index] = row
+            while self.next_row in self.done:
+                row = self.done.pop(self.next_row)
+                self.next_row += 1
+                if row is not None:
+                    self.metadata.append(*row)
+                    metrics.inc("samples_written")
+
+    def _writer_worker (self):
+
+        while True:
+            job = self.write_q.get()
+            try:
+                if job is None:
+                    return
+                self._write_images(*job)
+            except Exception as e:
+                with self.write_lock:
+                    self.write_errors += 1
+                print(f"[ERROR] Dataset writer: {e}")
+            finally:
+                self.write_q.task_done()
+
+    def flush (self):
+
+        # Wait until every queued sample is on disk
+        if self.write_q is not None:
+            self.write_q.join()
+
+    def close (self):
+
+        self.flush()
+
+        if self.write_q is not None:
+            for _ in self.writers:
+                self.write_q.put(None)
+            for t in self.writers:
+                t.join()
+            self.write_q = None
+            self.writers = []
+
+        self.storage.close()
+        self.metadata.close()
+
+        if self.write_errors > 0:
+            print(f"[WARN] {self.write_errors} samples could not be written")
      
-    def adjust_speed (self, csv_data_filename):
+    def adjust_speed (self, speed_filename):
 
+        # speed_filename: telemetry.bin or data.csv of the recorded log
         try:
             self.load_speed_from_csv(
                 self.csv_filename,
-                csv_data_filename,
+                speed_filename,
                 dst_speed_col="speed",
                 src_speed_col="speed_m_s"
             )
         except Exception as e:
-            print(f"[ERROR] speed align (merge_asof): {e}")
+            print(f"[ERROR] speed align: {e}")
 
     def load_speed_from_csv(self,
                             dataset_csv: str,
@@ -94,69 +400,219 @@ class DatasetSaver:
                             src_speed_col: str = "speed_m_s",
                             src_time_col: str = "sim_time"):
 
-        # 1) Check files
-        if not os.path.isfile(dataset_csv):
-            print(f"[ERROR] Dataset {dataset_csv} does not exist")
-            return
-        if not os.path.isfile(speed_csv):
-            print(f"[ERROR] Speed CSV does not exist: {speed_csv}")
-            return
+        # Nearest recorded speed for each sample. speed_csv may also be the
+        # binary telemetry.bin. The dataset is processed in chunks, see
+        # align_dataset.py
+        from align_dataset import align_csv
 
-        # 2) Loading
-        df_dst = pd.read_csv(dataset_csv)
-        df_src = pd.read_csv(speed_csv)
-
-        # 3) Check necessary columns
-        for col in ["timestamp", dst_speed_col]:
-            if col not in df_dst.columns:
-                print(f"[ERROR] Dataset does not have col '{col}'.")
-                return
-        for col in [src_time_col, src_speed_col]:
-            if col not in df_src.columns:
-                print(f"[ERROR] Speed CSV not containing col '{col}'.")
-                return
-        if df_dst.empty or df_src.empty:
-            print("[WARN] Empty Dataset or speed CSV")
-            return
+        if speed_csv.endswith(".bin") and src_speed_col == "speed_m_s":
+            src_speed_col = "speed"
 
-        # 4) Number conversion
-        df_dst = df_dst.copy()
-        df_src = df_src.copy()
+        return align_csv(dataset_csv, speed_csv, [(src_speed_col, dst_speed_col)],
+                         mode="nearest", src_time_col=src_time_col)
 
-        df_dst["timestamp"]      = pd.to_numeric(df_dst["timestamp"], errors="coerce")
-        df_src[src_time_col]     = pd.to_numeric(df_src[src_time_col], errors="coerce")
-        df_src[src_speed_col]    = pd.to_numeric(df_src[src_speed_col], errors="coerce")
 
-        df_dst = df_dst.dropna(subset=["timestamp"])
-        df_src = df_src.dropna(subset=[src_time_col, src_speed_col])
+class DatasetReader:
 
-        if df_dst.empty or df_src.empty:
-            print("[WARN] NaN data filtered and no data left.")
-            return
+    # Random access to a dataset saved by DatasetSaver (png, tar or raw
+    # storage), e.g. for training:
+    #   reader = DatasetReader("/tmp/1763718805717_dataset", workers=8, cache_size=1024)
+    #   reader[100]    -> {"rgb": (H, W, 3) BGR, "mask": (H, W) class ids, "speed": 8.1, ...}
+    #   reader[0:64]   -> the same, stacked: {"rgb": (64, H, W, 3), "speed": (64,), ...}
+    #   for batch in reader.batches(64, shuffle=True): ...
+    # Images are decoded by a pool of threads (cv2 and zlib release the GIL)
+    # into arrays allocated once per batch. Masks are always class ids,
+    # whatever the mask format of the dataset. Images of single samples
+    # may come from the cache (cache_size samples): do not modify them.
+
+    def __init__ (self, dataset_path, image_types=None, workers=4, cache_size=0, prefetch=2):
+
+        self.dataset_path = dataset_path
+        self.columns = self._load_columns()
+        self.length = len(self.columns["timestamp"])
+
+        available = [t for t in IMAGE_TYPES if f"{t}_path" in self.columns]
+        self.image_types = [t for t in available if image_types is None or t in image_types]
+
+        # Datasets without class table have RGB masks of the lane classes
+        table = read_class_table(dataset_path)
+        self.mask_format = table["mask"]["format"] if table is not None else "rgb"
+        self.mask_colors = (np.array([c["color"] for c in table["mask"]["classes"]], dtype=np.uint8)
+                            if table is not None else class_colors(LANE_CLASSES))
+
+        self.raw = None
+        self.shards = None
+        if os.path.isdir(os.path.join(dataset_path, RAW_FOLDERNAME)):
+            self.raw = RawFrameReader(dataset_path)
+        elif os.path.isdir(os.path.join(dataset_path, SHARDS_FOLDERNAME)):
+            self.shards = ShardReader(dataset_path)
+
+        self.shapes = {}
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.prefetch = max(1, prefetch)
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+
+    def _load_columns (self):
+
+        # Typed columns from the .npz sidecar when there is one, else from dataset.csv
+        sidecar_filename = os.path.join(self.dataset_path, "dataset.npz")
+        if os.path.isfile(sidecar_filename):
+            with np.load(sidecar_filename) as data:
+                return {name: data[name] for name in data.files}
+
+        with open(os.path.join(self.dataset_path, "dataset.csv"), newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            rows = list(reader)
+        values = list(zip(*rows)) if rows else [()] * len(header)
+        dtypes = dict(DATA_COLUMNS)
+        return {name: np.array(v, dtype=dtypes.get(name, np.str_)) for name, v in zip(header, values)}
+
+    def __len__ (self):
+        return self.length
+
+    def _read (self, image_type, index):
+
+        path = str(self.columns[f"{image_type}_path"][index])
+        if self.raw is not None:
+            image = self.raw.read(path)
+        else:
+            if self.shards is not None:
+                data = self.shards.read_bytes(path)
+            else:
+                try:
+                    with open(os.path.join(self.dataset_path, path.lstrip("/")), "rb") as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    data = None
+            if data is None:
+                raise FileNotFoundError(f"{path} not found in {self.dataset_path}")
+
+            image = None
+            if image_type == "mask" and self.mask_format == "palette":
+                image, _ = decode_class_png(data)
+            if image is None:
+                image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+            if image is None:
+                raise ValueError(f"Unable to decode {path}")
+
+        if image is None:
+            raise FileNotFoundError(f"{path} not found in {self.dataset_path}")
+        if image_type == "mask" and image.ndim == 3:
+            image = _colors_to_classes(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), self.mask_colors)
+        return image
+
+    def image (self, image_type, index):
+
+        # Decoded image of a sample, through the cache
+        if self.cache_size <= 0:
+            with metrics.timer("reader_decode"):
+                return self._read(image_type, index)
+
+        key = (image_type, index)
+        with self.cache_lock:
+            image = self.cache.get(key)
+            if image is not None:
+                self.cache.move_to_end(key)
+                metrics.inc("reader_cache_hits")
+                return image
+
+        with metrics.timer("reader_decode"):
+            image = self._read(image_type, index)
+        with self.cache_lock:
+            self.cache[key] = image
+            while len(self.cache) > self.cache_size * len(self.image_types):
+                self.cache.popitem(last=False)
+        return image
+
+    def _indices (self, indices):
+
+        if isinstance(indices, slice):
+            return np.arange(self.length)[indices]
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        indices = np.where(indices < 0, indices + self.length, indices)
+        if len(indices) and (indices.min() < 0 or indices.max() >= self.length):
+            raise IndexError(f"sample index out of range (0-{self.length - 1})")
+        return indices
+
+    def __getitem__ (self, key):
+
+        # reader[i]: one sample. reader[a:b] or reader[[i, j, ...]]: a batch
+        if not isinstance(key, (int, np.integer)):
+            return self.batch(key)
+        index = int(key) + self.length if key < 0 else int(key)
+        if not 0 <= index < self.length:
+            raise IndexError(f"sample index {key} out of range (0-{self.length - 1})")
+
+        sample = {name: column[index] for name, column in self.columns.items()}
+        for image_type in self.image_types:
+            sample[image_type] = self.image(image_type, index)
+        return sample
+
+    def batch (self, indices):
+
+        indices = self._indices(indices)
+        batch = {name: column[indices] for name, column in self.columns.items()}
+
+        # The shape of each image type is taken from its first image
+        for image_type in self.image_types:
+            if image_type not in self.shapes and len(indices):
+                self.shapes[image_type] = self.image(image_type, indices[0]).shape
+            batch[image_type] = np.empty((len(indices),) + self.shapes.get(image_type, ()), dtype=np.uint8)
+
+        def fill (job):
+            image_type, slot, index = job
+            image = self.image(image_type, index)
+            if image.shape != self.shapes[image_type]:
+                raise ValueError(f"{image_type} {index}: shape {image.shape} != {self.shapes[image_type]}")
+            batch[image_type][slot] = image
+
+        jobs = [(t, slot, index) for slot, index in enumerate(indices) for t in self.image_types]
+        with metrics.timer("reader_batch"):
+            if self.executor is None or self.raw is not None:
+                for job in jobs:
+                    fill(job)
+            else:
+                list(self.executor.map(fill, jobs))
+        return batch
+
+    def batches (self, batch_size, shuffle=False, seed=None, drop_last=False):
+
+        # Batches in order (or shuffled), the next prefetch ones are read
+        # while the current one is used
+        order = np.random.default_rng(seed).permutation(self.length) if shuffle else np.arange(self.length)
+        chunks = [order[i:i + batch_size] for i in range(0, self.length, batch_size)]
+        if drop_last and chunks and len(chunks[-1]) < batch_size:
+            chunks.pop()
+
+        loader = ThreadPoolExecutor(max_workers=self.prefetch)
+        pending = collections.deque()
+        try:
+            for chunk in chunks:
+                pending.append(loader.submit(self.batch, chunk))
+                if len(pending) > self.prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            loader.shutdown(wait=True, cancel_futures=True)
+
+    def __iter__ (self):
+
+        # Samples in order, read in batches of 32 ahead of the current one
+        for batch in self.batches(32):
+            for i in range(len(batch["timestamp"])):
+                yield {name: values[i] for name, values in batch.items()}
+
+    def close (self):
 
-        # 5) Order by time
-        df_dst_sorted = df_dst.sort_values("timestamp").reset_index(drop=False)
-        df_src_sorted = df_src.sort_values(src_time_col).reset_index(drop=True)
-
-        # 6) Align using merge_asof
-        merged = pd.merge_asof(
-            df_dst_sorted,
-            df_src_sorted[[src_time_col, src_speed_col]],
-            left_on="timestamp",
-            right_on=src_time_col,
-            direction="nearest"
-        )
-
-        # 7) Set aligned speed in the original DataFrame
-        df_dst.loc[merged["index"], dst_speed_col] = merged[src_speed_col].values
-
-        # 8) Keep updated data
-        df_dst.to_csv(dataset_csv, index=False)
-
-        # 9) Info
-        time_diff = np.abs(merged["timestamp"] - merged[src_time_col])
-        print(f"[INFO] Speed alignment")
-        print(f"  - Nº rows dataset:   {len(df_dst)}")
-        print(f"  - Nº rows speed_csv: {len(df_src)}")
-        print(f"  - Avg time diff:     {time_diff.mean():.4f} s")
-        print(f"  - Max time diff:     {time_diff.max():.4f} s")
\ No newline at end of file
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if self.shards is not None:
+            self.shards.close()
+        if self.raw is not None:
+            self.raw.close()
+        self.cache.clear()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+#
+#
+#  Copyright (C) URJC DeepRacer
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+#  Author : Roberto Calvo Palomino <roberto.calvo at urjc dot es
+#           Sergio Robledo <s.robledo.2021 at alumnos dot urjc dot es>
+
+# Dataset generation on several processes. The replay process copies each
+# frame into a slot of shared memory and sends the slot to a pool of worker
+# processes, which compute the lane mask and encode the images, out of the
+# GIL of the replay. Samples are completed in submission order, so numbering
+# and dataset.csv are the same as with DatasetSaver alone.
+#
+# With png storage the workers write the files. With tar storage they send
+# the encoded PNG back and the replay process appends it to the shards.
+
+import time
+import queue
+import signal
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+import metrics
+from dataset_manager import encode_mask
+from mask_engine import MaskEngine, LANE_CLASSES, build_class_lut
+from dataset_storage import PngFolderStorage, TarShardStorage, encode_png
+
+
+class SharedFrames:
+
+    # slots frames of each kind in one shared memory block per kind
+
+    def __init__ (self, shapes, slots=0, names=None):
+
+        # Creates the blocks (names=None) or attaches to existing ones
+        self.shapes = {kind: tuple(shape) for kind, shape in shapes.items()}
+        self.blocks = {}
+        self.arrays = {}
+        self.owner = names is None
+
+        for kind, shape in self.shapes.items():
+            if self.owner:
+                size = max(1, slots * int(np.prod(shape)))
+                block = shared_memory.SharedMemory(create=True, size=size)
+            else:
+                block = shared_memory.SharedMemory(name=names[kind])
+            self.blocks[kind] = block
+            n = block.size // int(np.prod(shape)) if not self.owner else slots
+            self.arrays[kind] = np.ndarray((n,) + shape, dtype=np.uint8, buffer=block.buf)
+
+    def names (self):
+        return {kind: block.name for kind, block in self.blocks.items()}
+
+    def close (self):
+
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            if self.owner:
+                block.unlink()
+        self.blocks = {}
+
+
+def _process_task (frames, engine, storage, image_types, mask_format, mask_colors, task):
+
+    # Returns (seq, slot, ok, payload, seconds)
+    t0 = time.perf_counter()
+    seq, slot, index, filenames = task
+    bgr = frames.arrays["rgb"][slot]
+    images = {"rgb": bgr}
+    if engine is not None:
+        images["mask"] = encode_mask(engine.classify(bgr, order="bgr"), mask_format, mask_colors)
+    if "segmented" in frames.arrays:
+        images["segmented"] = frames.arrays["segmented"][slot]
+
+    sample = list(zip(filenames, [images[t] for t in image_types]))
+    if storage is None:
+        payload = [(f, image if isinstance(image, bytes) else encode_png(image)) for f, image in sample]
+        return (seq, slot, True, payload, time.perf_counter() - t0)
+    storage.write_sample(index, sample)
+    return (seq, slot, True, None, time.perf_counter() - t0)
+
+
+def _worker_main (frame_names, frame_shapes, lut_name, task_q, result_q,
+                  dataset_path, image_types, mask_format, mask_colors, return_bytes):
+
+    # Ctrl+C reaches the whole process group: the replay process decides
+    # when the workers stop (None task)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    frames = SharedFrames(frame_shapes, names=frame_names)
+    lut = None
+    engine = None
+    if lut_name is not None:
+        lut = shared_memory.SharedMemory(name=lut_name)
+        engine = MaskEngine(lut=np.ndarray((1 << 24,), dtype=np.uint8, buffer=lut.buf))
+    storage = None if return_bytes else PngFolderStorage(dataset_path)
+
+    try:
+        while True:
+            task = task_q.get()
+            if task is None:
+                break
+
+            try:
+                result_q.put(_process_task(frames, engine, storage, image_types,
+                                           mask_format, mask_colors, task))
+            except Exception as e:
+                result_q.put((task[0], task[1], False, str(e), 0.0))
+    finally:
+        # The views must go before the shared memory is closed
+        engine = None
+        frames.close()
+        if lut is not None:
+            lut.close()
+
+
+class DatasetPipeline:
+
+    # Saves the samples of a DatasetSaver with worker processes, e.g.
+    #   pipeline = DatasetPipeline(dataset, (600, 800), workers=8)
+    #   pipeline.submit(timestamp, bgr, throttle, steer, brake, speed, segmented)
+    #   pipeline.close(); dataset.close()
+
+    def __init__ (self, dataset, frame_size, workers=4, slots=None, classes=LANE_CLASSES):
+
+        if not isinstance(dataset.storage, (PngFolderStorage, TarShardStorage)):
+            raise ValueError("worker processes need png or tar storage")
+
+        self.dataset = dataset
+        self.return_bytes = isinstance(dataset.storage, TarShardStorage)
+        self.slots = slots or 4 * workers
+
+        height, width = frame_size
+        shapes = {"rgb": (height, width, 3)}
+        if "segmented" in dataset.image_types:
+            shapes["segmented"] = (height, width)
+        self.frames = SharedFrames(shapes, self.slots)
+
+        # The mask lookup table (16 MB) is built once and shared by the workers
+        self.lut = None
+        if "mask" in dataset.image_types:
+            table = build_class_lut(classes)
+            self.lut = shared_memory.SharedMemory(create=True, size=table.nbytes)
+            np.ndarray(table.shape, dtype=table.dtype, buffer=self.lut.buf)[:] = table
+
+        # spawn: the workers do not inherit the CARLA client and its threads
+        ctx = mp.get_context("spawn")
+        self.task_q = ctx.Queue()
+        self.result_q = ctx.Queue()
+        self.workers = [ctx.Process(target=_worker_main, name=f"DatasetWorker-{i}", daemon=True,
+                                    args=(self.frames.names(), shapes,
+                                          self.lut.name if self.lut is not None else None,
+                                          self.task_q, self.result_q, dataset.dataset_path,
+                                          dataset.image_types, dataset.mask_format,
+                                          dataset.mask_colors, self.return_bytes))
+                        for i in range(workers)]
+        for p in self.workers:
+            p.start()
+
+        self.free = list(range(self.slots))
+        self.seq = 0
+        self.next_seq = 0
+        self.pending = {}    # seq -> sample data, until it is completed
+        self.done = {}       # seq -> (ok, payload), completed out of order
+        self.errors = 0
+
+    def _handle_result (self, result):
+
+        seq, slot, ok, payload, seconds = result
+        self.free.append(slot)
+        metrics.observe("worker_mask_encode", seconds)
+        self.done[seq] = (ok, payload)
+
+        # Samples are completed in submission order
+        while self.next_seq in self.done:
+            ok, payload = self.done.pop(self.next_seq)
+            index, filenames, row = self.pending.pop(self.next_seq)
+            self.next_seq += 1
+
+            if ok and self.return_bytes:
+                try:
+                    with metrics.timer("shard_write"):
+                        self.dataset.storage.write_sample(index, payload)
+                except Exception as e:
+                    ok, payload = False, str(e)
+            if not ok:
+                self.errors += 1
+                metrics.inc("write_errors")
+                print(f"[ERROR] Unable to write sample {index}: {payload}")
+                continue
+
+            # Only samples on disk get a row
+            self.dataset.metadata.append(*[f"/{f}" for f in filenames], *row)
+            metrics.inc("samples_written")
+
+    def _collect (self, block):
+
+        while True:
+            try:
+                result = self.result_q.get(timeout=1.0) if block else self.result_q.get_nowait()
+            except queue.Empty:
+                if not block:
+                    return
+                if not any(p.is_alive() for p in self.workers):
+                    raise RuntimeError("dataset workers died")
+                continue
+            self._handle_result(result)
+            if not block or self.free:
+                return
+
+    def submit (self, timestamp, bgr, throttle, steer, brake, speed, segmented=None):
+
+        # Results ready so far, then wait for a free slot if there is none
+        self._collect(block=False)
+        if not self.free:
+            with metrics.timer("worker_wait"):
+                while not self.free:
+                    self._collect(block=True)
+
+        slot = self.free.pop()
+        self.frames.arrays["rgb"][slot] = bgr
+        if segmented is not None and "segmented" in self.frames.arrays:
+            self.frames.arrays["segmented"][slot] = segmented
+
+        index = self.dataset.counter
+        self.dataset.counter += 1
+        filenames = self.dataset.sample_filenames(index)
+
+        self.pending[self.seq] = (index, filenames, (timestamp, throttle, steer, brake, speed))
+        self.task_q.put((self.seq, slot, index, filenames))
+        self.seq += 1
+
+    def close (self):
+
+        # Waits for the samples already submitted, then stops the workers
+        try:
+            while self.pending and any(p.is_alive() for p in self.workers):
+                self._collect(block=True)
+        finally:
+            for _ in self.workers:
+                self.task_q.put(None)
+            for p in self.workers:
+                p.join(timeout=10.0)
+                if p.is_alive():
+                    p.terminate()
+
+            self.frames.close()
+            if self.lut is not None:
+                self.lut.close()
+                self.lut.unlink()
+                self.lut = None
+
+        if self.pending:
+            print(f"[WARN] {len(self.pending)} samples were not written")
+        self.dataset.write_errors += self.errors
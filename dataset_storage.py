@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+#
+#
+#  Copyright (C) URJC DeepRacer
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+#  Author : Roberto Calvo Palomino <roberto.calvo at urjc dot es
+#           Sergio Robledo <s.robledo.2021 at alumnos dot urjc dot es>
+
+# Storage backends used by DatasetSaver. Every image is identified by its
+# path relative to the dataset directory (e.g. "rgb/rgb_00000000.png"), which
+# is the same path stored in dataset.csv, so the CSV stays valid whatever the
+# backend.
+
+import os
+import io
+import re
+import csv
+import json
+import time
+import zlib
+import struct
+import tarfile
+import threading
+import cv2
+
+import numpy as np
+
+
+SHARDS_FOLDERNAME = "shards"
+SHARDS_INDEX = "index.csv"
+RAW_FOLDERNAME = "raw"
+RAW_HEADER = "header.json"
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def encode_png (image):
+
+    ok, data = cv2.imencode(".png", image)
+    if not ok:
+        raise RuntimeError("PNG encoding failed")
+    return data.tobytes()
+
+
+def _png_chunk (kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def encode_class_png (class_map, palette=None, level=1):
+
+    # Single channel uint8 image (class ids) as an 8 bit PNG, palettized when
+    # palette (RGB colour of each id) is given, so image viewers show the
+    # colours, or grayscale. Written directly: rows are not filtered and the
+    # data is compressed with run length encoding, which suits masks.
+    h, w = class_map.shape
+    rows = np.empty((h, w + 1), dtype=np.uint8)
+    rows[:, 0] = 0
+    rows[:, 1:] = class_map
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9, zlib.Z_RLE)
+    data = compressor.compress(rows) + compressor.flush()
+
+    chunks = [_png_chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 0 if palette is None else 3, 0, 0, 0))]
+    if palette is not None:
+        chunks.append(_png_chunk(b"PLTE", np.asarray(palette, dtype=np.uint8).tobytes()))
+    chunks.append(_png_chunk(b"IDAT", data))
+    chunks.append(_png_chunk(b"IEND", b""))
+    return PNG_SIGNATURE + b"".join(chunks)
+
+
+def _unfilter_row (kind, row, prev):
+
+    # PNG row filters with 1 byte per pixel
+    if kind == 0:
+        return row
+    if kind == 1:
+        return np.cumsum(row, dtype=np.uint8)
+    if kind == 2:
+        return row + prev
+    out = row.copy()
+    left = 0
+    for x in range(len(row)):
+        up = int(prev[x])
+        if kind == 3:
+            value = (left + up) // 2
+        else:
+            up_left = int(prev[x - 1]) if x > 0 else 0
+            p = left + up - up_left
+            pa, pb, pc = abs(p - left), abs(p - up), abs(p - up_left)
+            value = left if pa <= pb and pa <= pc else up if pb <= pc else up_left
+        left = out[x] = (int(row[x]) + value) & 0xFF
+    return out
+
+
+def decode_class_png (data):
+
+    # Class ids (and palette, None if grayscale) of an 8 bit grayscale or
+    # palettized PNG, as written by encode_class_png. cv2 always expands the
+    # palette to colours. Returns (None, None) for other PNG images.
+    if not data.startswith(PNG_SIGNATURE):
+        return None, None
+
+    offset = len(PNG_SIGNATURE)
+    header = None
+    palette = None
+    idat = []
+    while offset + 8 <= len(data):
+        length, kind = struct.unpack_from(">I4s", data, offset)
+        chunk = data[offset + 8:offset + 8 + length]
+        offset += 12 + length
+        if kind == b"IHDR":
+            header = struct.unpack(">IIBBBBB", chunk)
+        elif kind == b"PLTE":
+            palette = np.frombuffer(chunk, dtype=np.uint8).reshape(-1, 3)
+        elif kind == b"IDAT":
+            idat.append(chunk)
+        elif kind == b"IEND":
+            break
+
+    if header is None:
+        return None, None
+    w, h, depth, color_type, _, _, interlace = header
+    if depth != 8 or color_type not in (0, 3) or interlace != 0:
+        return None, None
+
+    rows = np.frombuffer(zlib.decompress(b"".join(idat)), dtype=np.uint8).reshape(h, w + 1)
+    filters = rows[:, 0]
+    if not filters.any():
+        return rows[:, 1:].copy(), palette
+
+    class_map = np.empty((h, w), dtype=np.uint8)
+    prev = np.zeros(w, dtype=np.uint8)
+    for y in range(h):
+        prev = class_map[y] = _unfilter_row(int(filters[y]), rows[y, 1:], prev)
+    return class_map, palette
+
+
+class PngFolderStorage:
+
+    # One PNG file per image (the original dataset layout)
+
+    def __init__ (self, dataset_path):
+
+        self.dataset_path = dataset_path
+
+    def write_sample (self, index, images):
+
+        # Images already encoded (bytes) are written as they are
+        for rel_path, image in images:
+            filename = os.path.join(self.dataset_path, rel_path)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            if isinstance(image, bytes):
+                with open(filename, "wb") as f:
+                    f.write(image)
+            elif not cv2.imwrite(filename, image):
+                raise RuntimeError(f"Unable to write {filename}")
+
+    def close (self):
+        pass
+
+
+class TarShardStorage:
+
+    # Packs the images of shard_size samples in each tar file, so a dataset is
+    # a few big files instead of thousands of small ones. The shards are plain
+    # tar files, and shards/index.csv records where each image is
+    # (name, shard, offset, length) for random access.
+
+    def __init__ (self, dataset_path, shard_size=1000):
+
+        self.shards_path = os.path.join(dataset_path, SHARDS_FOLDERNAME)
+        self.shard_size = shard_size
+        os.makedirs(self.shards_path, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.shard_id = -1
+        self.shard_samples = 0
+        self.tar = None
+
+        self.index_fh = open(os.path.join(self.shards_path, SHARDS_INDEX), "w", newline="")
+        self.index_writer = csv.writer(self.index_fh)
+        self.index_writer.writerow(["name", "shard", "offset", "length"])
+
+    def _next_shard (self):
+
+        if self.tar is not None:
+            self.tar.close()
+            self.index_fh.flush()
+
+        self.shard_id += 1
+        self.shard_samples = 0
+        shard_filename = os.path.join(self.shards_path, f"shard_{self.shard_id:06d}.tar")
+        self.tar = tarfile.open(shard_filename, "w", format=tarfile.USTAR_FORMAT)
+
+    def write_sample (self, index, images):
+
+        # Encode outside the lock, so writer threads still encode in parallel
+        encoded = [(rel_path, image if isinstance(image, bytes) else encode_png(image))
+                   for rel_path, image in images]
+
+        with self.lock:
+            if self.tar is None or self.shard_samples >= self.shard_size:
+                self._next_shard()
+
+            for rel_path, data in encoded:
+                info = tarfile.TarInfo(rel_path)
+                info.size = len(data)
+                info.mtime = int(time.time())
+                self.tar.addfile(info, io.BytesIO(data))
+
+                # Data is padded to 512 byte blocks after the member header
+                offset = self.tar.offset - ((len(data) + 511) // 512) * 512
+                self.index_writer.writerow([rel_path, f"shard_{self.shard_id:06d}.tar",
+                                            offset, len(data)])
+
+            self.shard_samples += 1
+
+    def close (self):
+
+        with self.lock:
+            if self.tar is not None:
+                self.tar.close()
+                self.tar = None
+            if self.index_fh is not None:
+                self.index_fh.close()
+                self.index_fh = None
+
+
+class ShardReader:
+
+    # Reads the images stored by TarShardStorage, by name (random access) or
+    # shard after shard (sequential streaming)
+
+    def __init__ (self, dataset_path):
+
+        self.shards_path = os.path.join(dataset_path, SHARDS_FOLDERNAME)
+        self.index = {}
+        self.handles = {}
+        self.lock = threading.Lock()
+
+        index_filename = os.path.join(self.shards_path, SHARDS_INDEX)
+        if os.path.isfile(index_filename):
+            with open(index_filename, newline="") as f:
+                for row in csv.DictReader(f):
+                    self.index[row["name"]] = (row["shard"], int(row["offset"]), int(row["length"]))
+        else:
+            print(f"[WARN] {index_filename} not found, scanning shards")
+
+        # The index is flushed when a shard is completed, so after a crash
+        # the last shard may be missing from it: scan it to be safe
+        indexed = {shard for shard, _, _ in self.index.values()}
+        shards = self.shards()
+        for shard in shards:
+            if shard not in indexed or shard == shards[-1]:
+                self._scan_shard(shard)
+
+    def shards (self):
+
+        return sorted(f for f in os.listdir(self.shards_path) if f.endswith(".tar"))
+
+    def _scan_shard (self, shard):
+
+        try:
+            with tarfile.open(os.path.join(self.shards_path, shard), "r") as tar:
+                for info in tar:
+                    if info.isfile():
+                        self.index[info.name] = (shard, info.offset_data, info.size)
+        except tarfile.ReadError as e:
+            print(f"[WARN] Shard {shard} truncated: {e}")
+
+    def __len__ (self):
+        return len(self.index)
+
+    def __contains__ (self, name):
+        return name.lstrip("/") in self.index
+
+    def read_bytes (self, name):
+
+        entry = self.index.get(name.lstrip("/"))
+        if entry is None:
+            return None
+
+        shard, offset, length = entry
+        with self.lock:
+            fh = self.handles.get(shard)
+            if fh is None:
+                fh = open(os.path.join(self.shards_path, shard), "rb")
+                self.handles[shard] = fh
+            fh.seek(offset)
+            return fh.read(length)
+
+    def read (self, name, flags=cv2.IMREAD_UNCHANGED):
+
+        data = self.read_bytes(name)
+        if data is None:
+            return None
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+
+    def __iter__ (self):
+
+        # Stream (name, bytes) in storage order, one shard opened at a time
+        for shard in self.shards():
+            try:
+                with tarfile.open(os.path.join(self.shards_path, shard), "r|") as tar:
+                    for info in tar:
+                        if info.isfile():
+                            yield info.name, tar.extractfile(info).read()
+            except tarfile.ReadError as e:
+                print(f"[WARN] Shard {shard} truncated: {e}")
+
+    def close (self):
+
+        with self.lock:
+            for fh in self.handles.values():
+                fh.close()
+            self.handles = {}
+
+
+class RawFrameStorage:
+
+    # Uncompressed frames appended to one memory-mapped uint8 file per image
+    # kind (raw/rgb.u8 with shape (N, H, W, 3), raw/mask.u8 with (N, H, W)),
+    # so readers get numpy views without decoding anything. Files are
+    # preallocated and doubled when full, then trimmed on close.
+    # raw/header.json describes shape, dtype and number of frames.
+
+    def __init__ (self, dataset_path, capacity=1024):
+
+        self.raw_path = os.path.join(dataset_path, RAW_FOLDERNAME)
+        self.capacity = capacity
+        os.makedirs(self.raw_path, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.arrays = {}
+        self.shapes = {}
+        self.count = 0
+
+    def _filename (self, name):
+        return os.path.join(self.raw_path, f"{name}.u8")
+
+    def _resize (self, name, frames):
+
+        # Keeps the frames already written, the file is only extended
+        frame_bytes = int(np.prod(self.shapes[name]))
+        with open(self._filename(name), "r+b" if name in self.arrays else "w+b") as f:
+            f.truncate(frames * frame_bytes)
+
+        if name in self.arrays:
+            self.arrays[name].flush()
+        self.arrays[name] = np.memmap(self._filename(name), dtype=np.uint8, mode="r+",
+                                      shape=(frames,) + self.shapes[name])
+
+    def _write_header (self):
+
+        header = {"count": self.count,
+                  "arrays": {name: {"file": os.path.basename(self._filename(name)),
+                                    "dtype": "uint8",
+                                    "shape": list(shape)}
+                             for name, shape in self.shapes.items()}}
+        with open(os.path.join(self.raw_path, RAW_HEADER), "w") as f:
+            json.dump(header, f, indent=2)
+
+    def write_sample (self, index, images):
+
+        with self.lock:
+            for rel_path, image in images:
+                name = rel_path.split("/")[0]
+
+                if name not in self.shapes:
+                    self.shapes[name] = tuple(image.shape)
+                    self._resize(name, max(self.capacity, index + 1))
+                elif self.shapes[name] != image.shape:
+                    raise ValueError(f"{rel_path}: shape {image.shape} != {self.shapes[name]}")
+                elif index >= self.arrays[name].shape[0]:
+                    self._resize(name, max(2 * self.arrays[name].shape[0], index + 1))
+                    self._write_header()
+
+                self.arrays[name][index] = image
+
+            if index >= self.count:
+                self.count = index + 1
+                if self.count == 1:
+                    self._write_header()
+
+    def close (self):
+
+        with self.lock:
+            for name in list(self.arrays):
+                self.arrays.pop(name).flush()
+                with open(self._filename(name), "r+b") as f:
+                    f.truncate(self.count * int(np.prod(self.shapes[name])))
+            self._write_header()
+
+
+class RawFrameReader:
+
+    # Zero-copy access to the frames saved by RawFrameStorage:
+    #   reader["rgb"][i], reader["mask"][a:b] or reader.read("rgb/rgb_00000012.png")
+
+    def __init__ (self, dataset_path):
+
+        self.raw_path = os.path.join(dataset_path, RAW_FOLDERNAME)
+        with open(os.path.join(self.raw_path, RAW_HEADER)) as f:
+            self.header = json.load(f)
+
+        self.count = self.header["count"]
+        self.arrays = {}
+        for name, info in self.header["arrays"].items():
+            shape = (self.count,) + tuple(info["shape"])
+            if self.count == 0:
+                self.arrays[name] = np.empty(shape, dtype=info["dtype"])
+            else:
+                self.arrays[name] = np.memmap(os.path.join(self.raw_path, info["file"]),
+                                              dtype=info["dtype"], mode="r", shape=shape)
+
+    def __len__ (self):
+        return self.count
+
+    def __getitem__ (self, name):
+        return self.arrays[name]
+
+    def read (self, name):
+
+        # Dataset CSV path -> frame, e.g. "/rgb/rgb_00000012.png" -> rgb[12]
+        match = re.match(r"/?([^/]+)/.*?(\d+)\.\w+$", name)
+        if match is None or match.group(1) not in self.arrays:
+            return None
+        index = int(match.group(2))
+        if index >= self.count:
+            return None
+        return self.arrays[match.group(1)][index]
+
+    def close (self):
+        self.arrays = {}
+
+
+def open_storage (dataset_path, storage="png", shard_size=1000):
+
+    if storage == "png":
+        return PngFolderStorage(dataset_path)
+    if storage == "tar":
+        return TarShardStorage(dataset_path, shard_size)
+    if storage == "raw":
+        return RawFrameStorage(dataset_path)
+    raise ValueError(f"Unknown dataset storage '{storage}'")
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+#
+#
+#  Copyright (C) URJC DeepRacer
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+#  Author : Roberto Calvo Palomino <roberto.calvo at urjc dot es
+#           Sergio Robledo <s.robledo.2021 at alumnos dot urjc dot es>
+
+# Hands frames from the sensor callbacks to the replay loop through a fixed
+# number of preallocated slots. The callbacks copy the image data straight
+# into a slot, so nothing is allocated per frame, and every frame is counted:
+# received, consumed or dropped.
+#
+# A slot holds every image kind of one simulation frame (e.g. rgb and
+# segmented) and is ready when all of them have been written. The consumer
+# gets a slot with numpy views of its buffers and releases it when done.
+#
+# Policies when every slot is in use:
+#   drop_oldest: the oldest ready frame is overwritten (the loop gets the newest)
+#   block:       the sensor callback waits for the loop (lossless)
+
+import collections
+import threading
+
+import numpy as np
+
+
+POLICIES = ["drop_oldest", "block"]
+
+_FREE, _WRITING, _READY, _HELD = range(4)
+
+# Frame handed to the consumer: slot index, simulation frame id, timestamp
+# and {kind: array view}
+RingFrame = collections.namedtuple("RingFrame", ["slot", "frame", "timestamp", "images"])
+
+
+class FrameRing:
+
+    def __init__ (self, kinds, slots=8, policy="drop_oldest"):
+
+        # kinds: {kind: shape}, e.g. {"rgb": (600, 800, 3), "segmented": (600, 800)}
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown ring policy '{policy}'")
+        if slots < 2:
+            raise ValueError("A frame ring needs at least 2 slots")
+
+        self.kinds = dict(kinds)
+        self.slots = slots
+        self.policy = policy
+
+        self.buffers = {kind: np.empty((slots,) + tuple(shape), dtype=np.uint8)
+                        for kind, shape in self.kinds.items()}
+        self.state = [_FREE] * slots
+        self.frame = [-1] * slots
+        self.timestamp = [0.0] * slots
+        self.written = [0] * slots
+
+        self.free = collections.deque(range(slots))
+        self.ready = collections.deque()
+        self.open = {}        # frame id -> slot being written
+        self.cond = threading.Condition()
+        self.closed = False
+
+        self.received = 0     # frames with every image kind written
+        self.consumed = 0     # frames handed to the consumer
+        self.dropped = 0      # frames lost in the ring (overwritten, incomplete or skipped)
+        self.gaps = 0         # frame ids never received (e.g. 7 after 5)
+        self.last_frame = None    # last complete frame
+        self.last_seen = None     # last frame with any image
+        self.dropped_frames = collections.deque(maxlen=1000)
+
+    def _drop (self, slot):
+
+        # Called with the lock held
+        self.dropped += 1
+        self.dropped_frames.append(self.frame[slot])
+        self.state[slot] = _FREE
+        self.free.append(slot)
+
+    def _acquire (self, frame):
+
+        # Slot where the images of frame are written, or None to drop them
+        while True:
+            if self.free:
+                return self.free.popleft()
+            if self.policy == "drop_oldest" and self.ready:
+                self._drop(self.ready.popleft())
+                continue
+            if self.policy == "drop_oldest" or self.closed:
+                # Every slot is held by the consumer or being written
+                self.dropped += 1
+                self.dropped_frames.append(frame)
+                return None
+            self.cond.wait()
+
+    def write (self, frame, timestamp, kind, image):
+
+        # Runs in the sensor callback thread. image is copied into the slot.
+        with self.cond:
+            slot = self.open.get(frame)
+            if slot is None:
+                if self.last_frame is not None and frame <= self.last_frame:
+                    return   # late image of a frame already dropped or handed over
+                if self.last_seen is not None and frame > self.last_seen + 1:
+                    self.gaps += frame - self.last_seen - 1
+                if self.last_seen is None or frame > self.last_seen:
+                    self.last_seen = frame
+                slot = self._acquire(frame)
+                if slot is None:
+                    return
+                self.open[frame] = slot
+                self.state[slot] = _WRITING
+                self.frame[slot] = frame
+                self.timestamp[slot] = timestamp
+                self.written[slot] = 0
+
+            # Copied with the lock held, so a slot is never reused while written
+            np.copyto(self.buffers[kind][slot], image)
+
+            self.written[slot] += 1
+            if self.written[slot] < len(self.kinds):
+                return
+
+            del self.open[frame]
+
+            # Older frames still waiting for an image will not be completed
+            for old in [f for f in self.open if f < frame]:
+                self._drop(self.open.pop(old))
+
+            self.last_frame = frame
+
+            self.state[slot] = _READY
+            self.ready.append(slot)
+            self.received += 1
+            self.cond.notify_all()
+
+    def _take (self):
+
+        slot = self.ready.popleft()
+        self.state[slot] = _HELD
+        self.consumed += 1
+        return RingFrame(slot, self.frame[slot], self.timestamp[slot],
+                         {kind: buf[slot] for kind, buf in self.buffers.items()})
+
+    def get (self, timeout=None):
+
+        # Oldest ready frame, None on timeout. Call release() when done with it.
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.ready or self.closed, timeout):
+                return None
+            if not self.ready:
+                return None
+            return self._take()
+
+    def get_nowait (self):
+
+        with self.cond:
+            if not self.ready:
+                return None
+            return self._take()
+
+    def wait_frame (self, frame_id, timeout=5.0):
+
+        # First frame >= frame_id (sync mode). Older ready frames are dropped.
+        with self.cond:
+            def available():
+                while self.ready and self.frame[self.ready[0]] < frame_id:
+                    self._drop(self.ready.popleft())
+                return bool(self.ready) or self.closed
+
+            if not self.cond.wait_for(available, timeout) or not self.ready:
+                return None
+            return self._take()
+
+    def release (self, item):
+
+        with self.cond:
+            slot = item.slot
+            if self.state[slot] == _HELD:
+                self.state[slot] = _FREE
+                self.free.append(slot)
+                self.cond.notify_all()
+
+    def close (self):
+
+        # Wakes up blocked writers and readers
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def stats (self):
+
+        with self.cond:
+            return {"received": self.received, "consumed": self.consumed,
+                    "dropped": self.dropped, "gaps": self.gaps,
+                    "pending": len(self.ready)}
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+#
+#
+#  Copyright (C) URJC DeepRacer
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+#  Author : Roberto Calvo Palomino <roberto.calvo at urjc dot es
+#           Sergio Robledo <s.robledo.2021 at alumnos dot urjc dot es>
+
+import sys
+import time
+import cv2
+
+import numpy as np
+
+
+# Lane classes: (class id, name, HSV lower, HSV upper, RGB colour).
+# When thresholds overlap, the last class of the list wins.
+LANE_CLASSES = [
+    (1, "white",  (0, 0, 200),   (180, 30, 255), (255, 255, 255)),
+    (2, "yellow", (18, 50, 150), (40, 255, 255), (255, 255, 0)),
+]
+
+# CityScapes palette of the CARLA 0.9.15 semantic tags (sensor.camera.semantic_segmentation)
+SEMANTIC_PALETTE = [
+    (0, 0, 0),       (128, 64, 128),  (244, 35, 232),  (70, 70, 70),    (102, 102, 156),
+    (190, 153, 153), (153, 153, 153), (250, 170, 30),  (220, 220, 0),   (107, 142, 35),
+    (152, 251, 152), (70, 130, 180),  (220, 20, 60),   (255, 0, 0),     (0, 0, 142),
+    (0, 0, 70),      (0, 60, 100),    (0, 80, 100),    (0, 0, 230),     (119, 11, 32),
+    (110, 190, 160), (170, 120, 50),  (55, 90, 80),    (45, 60, 150),   (157, 234, 50),
+    (81, 0, 81),     (150, 100, 100), (230, 150, 140), (180, 165, 180),
+]
+
+# Names of the semantic tags, same order as SEMANTIC_PALETTE
+SEMANTIC_TAGS = [
+    "unlabeled", "road", "sidewalk", "building", "wall", "fence", "pole", "traffic_light",
+    "traffic_sign", "vegetation", "terrain", "sky", "pedestrian", "rider", "car", "truck",
+    "bus", "train", "motorcycle", "bicycle", "static", "dynamic", "other", "water",
+    "road_line", "ground", "bridge", "rail_track", "guard_rail",
+]
+
+
+def class_colors(classes=LANE_CLASSES):
+
+    # RGB colour of each class id, from 0 (background, black) to the largest id
+    colors = np.zeros((max(c[0] for c in classes) + 1, 3), dtype=np.uint8)
+    for class_id, _, _, _, color in classes:
+        colors[class_id] = color
+    return colors
+
+_lut_cache = {}
+
+
+def build_class_lut(classes=LANE_CLASSES):
+
+    # One class id for each 24 bit colour, indexed by (R << 16) | (G << 8) | B.
+    # The HSV conversion and thresholds are the same used per frame before,
+    # so the result is exactly the same. It takes 16 MB and is built once.
+    key = tuple((c[0], tuple(c[2]), tuple(c[3])) for c in classes)
+    if key in _lut_cache:
+        return _lut_cache[key]
+
+    lut = np.zeros(1 << 24, dtype=np.uint8)
+
+    step = 16
+    g, b = np.meshgrid(np.arange(256, dtype=np.uint8),
+                       np.arange(256, dtype=np.uint8), indexing="ij")
+    block = np.empty((step, 65536, 3), dtype=np.uint8)
+    block[..., 1] = g.ravel()
+    block[..., 2] = b.ravel()
+
+    for r0 in range(0, 256, step):
+        block[..., 0] = np.arange(r0, r0 + step, dtype=np.uint8)[:, None]
+        hsv = cv2.cvtColor(block, cv2.COLOR_RGB2HSV)
+        lut_block = lut[r0 << 16:(r0 + step) << 16].reshape(step, 65536)
+        for class_id, _, lower, upper, _ in classes:
+            lut_block[cv2.inRange(hsv, np.array(lower), np.array(upper)) > 0] = class_id
+
+    _lut_cache[key] = lut
+    return lut
+
+
+def reference_mask(rgb, classes=LANE_CLASSES):
+
+    # Per-frame HSV pipeline, kept to check MaskEngine against it
+    hsv = cv2.cvtColor(rgb, cv2.COLOR_RGB2HSV)
+    mask_c = np.zeros(rgb.shape[:2], np.uint8)
+    mask_rgb = np.zeros_like(rgb)
+    for class_id, _, lower, upper, color in classes:
+        mask_c[cv2.inRange(hsv, np.array(lower), np.array(upper)) > 0] = class_id
+    for class_id, _, _, _, color in classes:
+        mask_rgb[mask_c == class_id] = color
+    return mask_c, mask_rgb
+
+
+class MaskEngine:
+
+    # Lane mask generation with precomputed lookup tables. Output buffers are
+    # allocated once per frame shape and reused, so the arrays returned are
+    # overwritten by the next call: copy them if they must be kept.
+
+    def __init__ (self, classes=LANE_CLASSES, lut=None):
+
+        # lut: a table already built for these classes (e.g. in shared memory)
+        self.classes = classes
+        self.lut = build_class_lut(classes) if lut is None else lut
+
+        # Class id -> colour, one 256 entries table per channel for cv2.LUT
+        self.palette = np.zeros((256, 3), dtype=np.uint8)
+        for class_id, _, _, _, color in classes:
+            self.palette[class_id] = color
+        self.channel_luts = [np.ascontiguousarray(self.palette[:, c]) for c in range(3)]
+
+        self.buffers = {}
+
+    def _get_buffers (self, h, w):
+
+        key = (h, w)
+        if key not in self.buffers:
+            bgra = np.empty((h, w, 4), dtype=np.uint8)
+            self.buffers[key] = {
+                "bgra":     bgra,
+                "packed":   bgra.view(np.uint32).reshape(h, w),
+                "index":    np.empty((h, w), dtype=np.intp),
+                "class":    np.empty((h, w), dtype=np.uint8),
+                "channels": [np.empty((h, w), dtype=np.uint8) for _ in range(3)],
+                "rgb":      np.empty((h, w, 3), dtype=np.uint8),
+            }
+        return self.buffers[key]
+
+    def classify (self, image, order="rgb"):
+
+        # image: (H, W, 3) uint8 in "rgb" or "bgr" order. Prefer a contiguous
+        # array, a strided view (e.g. bgr[:, :, ::-1]) is copied by cv2.
+        h, w = image.shape[:2]
+        buf = self._get_buffers(h, w)
+
+        code = cv2.COLOR_RGB2BGRA if order == "rgb" else cv2.COLOR_BGR2BGRA
+        cv2.cvtColor(image, code, dst=buf["bgra"])
+
+        # Little endian BGRA read as uint32 is (A << 24) | (R << 16) | (G << 8) | B
+        np.bitwise_and(buf["packed"], 0xFFFFFF, out=buf["index"], casting="unsafe")
+        np.take(self.lut, buf["index"], out=buf["class"])
+        return buf["class"]
+
+    def colorize (self, class_map):
+
+        h, w = class_map.shape[:2]
+        buf = self._get_buffers(h, w)
+
+        for lut, channel in zip(self.channel_luts, buf["channels"]):
+            cv2.LUT(class_map, lut, dst=channel)
+        cv2.merge(buf["channels"], dst=buf["rgb"])
+        return buf["rgb"]
+
+    def __call__ (self, image, order="rgb"):
+
+        class_map = self.classify(image, order)
+        return class_map, self.colorize(class_map)
+
+    def classify_batch (self, frames, order="rgb"):
+
+        # frames: (N, H, W, 3). The stack is processed as a single tall image.
+        n, h, w = frames.shape[:3]
+        class_map = self.classify(np.ascontiguousarray(frames).reshape(n * h, w, 3), order)
+        return class_map.reshape(n, h, w)
+
+    def colorize_batch (self, class_maps):
+
+        n, h, w = class_maps.shape[:3]
+        return self.colorize(class_maps.reshape(n * h, w)).reshape(n, h, w, 3)
+
+
+if __name__ == "__main__":
+
+    # Check MaskEngine against the HSV pipeline and compare timings:
+    #   python3 mask_engine.py [image.png ...]
+    frames = [cv2.imread(f)[:, :, ::-1].copy() for f in sys.argv[1:]]
+    if not frames:
+        rng = np.random.default_rng(0)
+        frames = [rng.integers(0, 256, (600, 800, 3), dtype=np.uint8)]
+
+    t0 = time.perf_counter()
+    engine = MaskEngine()
+    print(f"[INFO] LUT built in {time.perf_counter() - t0:.3f} s")
+
+    ok = True
+    for rgb in frames:
+        ref_c, ref_rgb = reference_mask(rgb)
+        mask_c, mask_rgb = engine(rgb)
+        batch_c = engine.classify_batch(np.stack([rgb, rgb]))
+        ok = ok and np.array_equal(ref_c, mask_c) and np.array_equal(ref_rgb, mask_rgb)
+        ok = ok and np.array_equal(batch_c[0], ref_c) and np.array_equal(batch_c[1], ref_c)
+
+        bgr = np.ascontiguousarray(rgb[:, :, ::-1])
+        ok = ok and np.array_equal(engine.classify(bgr, order="bgr"), ref_c)
+
+        runs = 50
+        t0 = time.perf_counter()
+        for _ in range(runs):
+            reference_mask(rgb)
+        t_ref = (time.perf_counter() - t0) / runs
+
+        t0 = time.perf_counter()
+        for _ in range(runs):
+            engine(bgr, order="bgr")
+        t_lut = (time.perf_counter() - t0) / runs
+
+        print(f"  - {rgb.shape[1]}x{rgb.shape[0]}: HSV {t_ref * 1000:.2f} ms, "
+              f"LUT {t_lut * 1000:.2f} ms ({t_ref / t_lut:.1f}x)")
+
+    print("[INFO] Same output as the HSV pipeline" if ok else "[ERROR] Output differs from the HSV pipeline")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+#
+#
+#  Copyright (C) URJC DeepRacer
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+#  Author : Roberto Calvo Palomino <roberto.calvo at urjc dot es
+#           Sergio Robledo <s.robledo.2021 at alumnos dot urjc dot es>
+
+# Timing of the recorder / replay stages (fixed bucket histograms), counters
+# and gauges, written as JSON and Prometheus text. Everything goes to the
+# module registry, disabled by default: until enable() is called, timers and
+# counters do nothing.
+#
+#   import metrics
+#   with metrics.timer("mask"):
+#       ...
+#   metrics.inc("samples_saved")
+#   metrics.set_gauge("frames_dropped", 3, view="car")
+
+import os
+import re
+import json
+import time
+import bisect
+import threading
+
+
+# Upper bounds of the histogram buckets, in seconds (and +Inf)
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+JSON_FILENAME = "metrics.json"
+PROMETHEUS_FILENAME = "metrics.prom"
+
+
+def _metric_name (name):
+
+    # Prometheus names only take [a-zA-Z0-9_:]
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", name)
+
+
+def _label_value (value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _series (name, labels):
+
+    # Name and labels of a series as in the Prometheus text format, also the
+    # key of the series in the JSON report, e.g. frames_dropped{view="car"}
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{_label_value(v)}"' for k, v in labels) + "}"
+
+
+class Histogram:
+
+    def __init__ (self, buckets=BUCKETS):
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe (self, value):
+
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile (self, q):
+
+        # Upper bound of the bucket holding the q quantile
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        total = 0
+        for bound, n in zip(self.buckets, self.counts):
+            total += n
+            if total >= target:
+                return bound
+        return self.max
+
+    def to_dict (self):
+
+        return {"count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else 0.0,
+                "max": self.max,
+                "p50": self.quantile(0.5),
+                "p99": self.quantile(0.99),
+                "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], self.counts))}
+
+
+class _Timer:
+
+    def __init__ (self, registry, stage):
+        self.registry = registry
+        self.stage = stage
+
+    def __enter__ (self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__ (self, *exc):
+        self.registry.observe(self.stage, time.perf_counter() - self.t0)
+        return False
+
+
+class _NoTimer:
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+class Registry:
+
+    def __init__ (self, prefix="carla"):
+
+        self.prefix = prefix
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.collectors = []
+        self.start = time.time()
+
+        self.report_thread = None
+        self.report_stop = threading.Event()
+
+    def enable (self):
+
+        self.enabled = True
+        self.start = time.time()
+
+    def reset (self):
+
+        # Disabled and empty, as at start (e.g. between runs in one process)
+        self.stop_reports()
+        with self.lock:
+            self.enabled = False
+            self.histograms = {}
+            self.counters = {}
+            self.gauges = {}
+            self.collectors = []
+        self.start = time.time()
+
+    def timer (self, stage):
+
+        # Context manager timing a block into the histogram of stage
+        if not self.enabled:
+            return _NO_TIMER
+        return _Timer(self, stage)
+
+    def observe (self, stage, seconds):
+
+        if not self.enabled:
+            return
+        with self.lock:
+            hist = self.histograms.get(stage)
+            if hist is None:
+                hist = self.histograms[stage] = Histogram()
+            hist.observe(seconds)
+
+    def inc (self, name, n=1):
+
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set_gauge (self, name, value, **labels):
+
+        # labels tell apart the series of one gauge, e.g. view="car"
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[_series(name, sorted(labels.items()))] = value
+
+    def add_collector (self, collector):
+
+        # collector() is called before each report, to set gauges from state
+        # kept elsewhere (e.g. frame ring counters)
+        self.collectors.append(collector)
+
+    def to_dict (self):
+
+        for collector in list(self.collectors):
+            try:
+                collector()
+            except Exception as e:
+                print(f"[WARN] Metrics collector: {e}")
+
+        with self.lock:
+            uptime = time.time() - self.start
+            return {"timestamp": time.time(),
+                    "uptime_s": uptime,
+                    "stages": {name: h.to_dict() for name, h in sorted(self.histograms.items())},
+                    "counters": dict(sorted(self.counters.items())),
+                    "rates": {name: value / uptime if uptime > 0 else 0.0
+                              for name, value in sorted(self.counters.items())},
+                    "gauges": dict(sorted(self.gauges.items()))}
+
+    def to_prometheus (self, data=None):
+
+        data = data or self.to_dict()
+        p = self.prefix
+        lines = [f"# TYPE {p}_stage_seconds histogram"]
+        for stage, h in data["stages"].items():
+            total = 0
+            stage = _label_value(stage)
+            for bound, n in h["buckets"].items():
+                total += n
+                lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {total}')
+            lines.append(f'{p}_stage_seconds_sum{{stage="{stage}"}} {h["sum"]:.9f}')
+            lines.append(f'{p}_stage_seconds_count{{stage="{stage}"}} {h["count"]}')
+
+        for name, value in data["counters"].items():
+            name = _metric_name(name)
+            lines.append(f"# TYPE {p}_{name}_total counter")
+            lines.append(f"{p}_{name}_total {value}")
+
+        # One TYPE line per gauge, then its series (keys are name{labels})
+        typed = set()
+        for series, value in data["gauges"].items():
+            name, _, labels = series.partition("{")
+            name = _metric_name(name)
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {p}_{name} gauge")
+            lines.append(f"{p}_{name}{'{' + labels if labels else ''} {value}")
+
+        lines.append(f"# TYPE {p}_uptime_seconds gauge")
+        lines.append(f"{p}_uptime_seconds {data['uptime_s']:.3f}")
+        return "\n".join(lines) + "\n"
+
+    def write (self, path):
+
+        # metrics.json and metrics.prom in path, replaced atomically
+        if not self.enabled:
+            return
+        os.makedirs(path, exist_ok=True)
+        data = self.to_dict()
+        for filename, text in ((JSON_FILENAME, json.dumps(data, indent=2)),
+                               (PROMETHEUS_FILENAME, self.to_prometheus(data))):
+            tmp = os.path.join(path, f".{filename}.tmp")
+            with open(tmp, "w") as f:
+                f.write(text)
+            os.replace(tmp, os.path.join(path, filename))
+
+    def start_reports (self, path, interval=10.0):
+
+        # Writes the reports every interval seconds until stop_reports()
+        if not self.enabled or self.report_thread is not None:
+            return
+
+        def report_loop():
+            while not self.report_stop.wait(interval):
+                try:
+                    self.write(path)
+                except Exception as e:
+                    print(f"[WARN] Unable to write metrics: {e}")
+
+        self.report_stop.clear()
+        self.report_thread = threading.Thread(target=report_loop, name="MetricsReport", daemon=True)
+        self.report_thread.start()
+
+    def stop_reports (self, path=None):
+
+        # Stops the periodic reports and writes the last one
+        if self.report_thread is not None:
+            self.report_stop.set()
+            self.report_thread.join()
+            self.report_thread = None
+        if path is not None:
+            self.write(path)
+
+
+registry = Registry()
+
+enable = registry.enable
+reset = registry.reset
+timer = registry.timer
+observe = registry.observe
+inc = registry.inc
+set_gauge = registry.set_gauge
+add_collector = registry.add_collector
+write = registry.write
+start_reports = registry.start_reports
+stop_reports = registry.stop_reports
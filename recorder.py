@@ -24,29 +24,43 @@
 
 import os
 import sys
-import csv
 import time
 import argparse
+import signal
 import numpy as np
 
 import carla
+from telemetry import TelemetryRecorder
+import metrics
 import pygame
 import random
 
 
 RATE_CONTROL_LOOP = 30
 VEHICLE_MODEL = "model3"
-CSV_FILENAME = "data.csv"
 
 last_time = None
 count = 0
 
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
 def game_loop(args):
 
+    # Stop cleanly on SIGTERM (batch schedulers) as on Ctrl+C
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+
+    if args.metrics:
+        metrics.enable()
+        metrics.start_reports(args.metrics, args.metrics_interval)
+
     pygame.init()
-    pygame.display.set_caption("CARLA recorder")
     display_width, display_height = 800, 600
-    screen = pygame.display.set_mode((display_width, display_height))
+    screen = None
+    if not args.headless:
+        pygame.display.set_caption("CARLA recorder")
+        screen = pygame.display.set_mode((display_width, display_height))
 
     client = carla.Client('localhost', args.port)
     client.set_timeout(10.0)
@@ -56,12 +70,6 @@ def game_loop(args):
     log_path = args.log_path + "/" + str(int(time.time())) + "_" + args.town + "/"
     os.makedirs(log_path, exist_ok=True)
 
-    # Speed CSV settings    
-    csv_file_path = log_path + CSV_FILENAME
-    csv_fh = open(csv_file_path, "w", newline="")
-    csv_writer = csv.writer(csv_fh)
-    csv_writer.writerow(["sim_time", "speed_m_s"])
-
     blueprint_library = world.get_blueprint_library()
 
     # Select vehicle
@@ -83,7 +91,10 @@ def game_loop(args):
             spawn_point.rotation
         )
         motorcycle = world.try_spawn_actor(moto_bp, moto_transform)
-        motorcycle.set_autopilot(True, tm_port)
+        if motorcycle is not None:
+            motorcycle.set_autopilot(True, tm_port)
+        else:
+            print("[WARN] Unable to spawn the bicycle")
 
     # Enable autopilot
     vehicle.set_autopilot(True, tm_port)
@@ -95,6 +106,18 @@ def game_loop(args):
     print(log_filename)
     client.start_recorder(log_filename, True)
 
+    # Start time at 0 for the speed csv
+    snapshot = world.get_snapshot()
+    t0 = snapshot.timestamp.elapsed_seconds
+
+    # Telemetry of the tracked actors, from the snapshot of every server frame
+    # (telemetry.bin, and optionally telemetry.csv and data.csv)
+    tracked = {"ego": vehicle.id}
+    if args.extra_actor and motorcycle is not None:
+        tracked["bike"] = motorcycle.id
+    telemetry = TelemetryRecorder(log_path, tracked, t0=t0, ego_role="ego",
+                                  csv_export=args.telemetry_csv)
+
     # Camera RGB
     camera_bp = blueprint_library.find('sensor.camera.rgb')
     camera_bp.set_attribute("image_size_x", str(display_width))
@@ -102,56 +125,58 @@ def game_loop(args):
     camera_bp.set_attribute("fov", "90")
 
     camera_transform = carla.Transform(carla.Location(x=0, z=1.7))
-    camera = world.spawn_actor(camera_bp, camera_transform, attach_to=vehicle)
 
-    image_surface = None
+    # The callback only keeps the last image, it is converted to a surface
+    # in the loop when the window is updated
+    last_image = None
 
     def process_image(image):
-        nonlocal image_surface
-        array = np.frombuffer(image.raw_data, dtype=np.uint8)
-        array = np.reshape(array, (image.height, image.width, 4))
-        array = array[:, :, :3]
-        array = array[:, :, ::-1]
-        image_surface = pygame.surfarray.make_surface(array.swapaxes(0, 1))
+        nonlocal last_image
+        last_image = image
     
-    camera.listen(lambda img: process_image(img))
+    camera = None
+    if screen is not None:
+        camera = world.spawn_actor(camera_bp, camera_transform, attach_to=vehicle)
+        camera.listen(lambda img: process_image(img))
+
+    loop_count = 0
 
     clock = pygame.time.Clock()
 
 
-    # Measure the execution rate (Hz) in the server
+    # Save the telemetry and measure the execution rate (Hz) in the server
     def on_tick(snapshot):
+        with metrics.timer("on_tick"):
+            telemetry.on_tick(snapshot)
         fps_server = 1.0 / snapshot.timestamp.delta_seconds
+        metrics.inc("server_frames")
+        metrics.set_gauge("server_fps", round(fps_server, 3))
         print(f"Frame {snapshot.frame} | Server ~{fps_server:.1f} Hz  ", end="\r")
 
     callback_id = world.on_tick(on_tick)
 
-    # Start time at 0 for the speed csv
-    snapshot = world.get_snapshot()               
-    t0 = snapshot.timestamp.elapsed_seconds
-
     try:
         while True:
             
-            rel_time = world.get_snapshot().timestamp.elapsed_seconds - t0
-            # Get vehicle speed
-            raw_vel = vehicle.get_velocity()
-
             # rate of this control loop
             clock.tick(RATE_CONTROL_LOOP)
             
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    raise KeyboardInterrupt
-
-            if image_surface is not None:
-                screen.blit(image_surface, (0, 0))
-
-            pygame.display.flip()
-
-            
-            speed = float(np.linalg.norm([raw_vel.x, raw_vel.y, raw_vel.z]))
-            csv_writer.writerow([f"{rel_time:.6f}", f"{speed:.6f}"])
+            loop_count += 1
+            if screen is not None:
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT:
+                        raise KeyboardInterrupt
+
+                image = last_image
+                if image is not None and loop_count % args.preview_every == 0:
+                    with metrics.timer("preview"):
+                        array = np.frombuffer(image.raw_data, dtype=np.uint8)
+                        array = np.reshape(array, (image.height, image.width, 4))
+                        array = array[:, :, :3]
+                        array = array[:, :, ::-1]
+                        screen.blit(pygame.surfarray.make_surface(array.swapaxes(0, 1)), (0, 0))
+
+                        pygame.display.flip()
 
     except KeyboardInterrupt:
         print("Exit...")
@@ -172,8 +197,10 @@ def game_loop(args):
         if args.extra_actor and motorcycle is not None:
             motorcycle.destroy()
 
-        csv_fh.flush()
-        csv_fh.close()
+        telemetry.close()
+
+        if args.metrics:
+            metrics.stop_reports(args.metrics)
 
         pygame.quit()
         sys.exit()
@@ -198,7 +225,23 @@ if __name__ == '__main__':
     parser.add_argument("--extra_actor", "--carla-extra-actor", action="store_true",
                         help="Spawn an additional actor in front of the ego-vehicle")
 
+    parser.add_argument("--telemetry_csv", action="store_true",
+                        help="Also write the telemetry as text (telemetry.csv and data.csv)")
+
+    parser.add_argument("--metrics", type=str, default=None,
+                        help="Directory where timing and counter reports (metrics.json, metrics.prom) are written")
+
+    parser.add_argument("--metrics_interval", type=float, default=10.0,
+                        help="Seconds between metrics reports during the recording")
+
+    parser.add_argument("--headless", action="store_true",
+                        help="Do not open any window nor spawn the preview camera (no display needed)")
+
+    parser.add_argument("--preview_every", type=int, default=1,
+                        help="Update the window only every N iterations")
+
     args = parser.parse_args()
+    args.preview_every = max(1, args.preview_every)
 
     try:
         game_loop(args)
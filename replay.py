@@ -27,19 +27,31 @@ import sys
 import time
 import os
 import argparse
+import signal
 import csv
-import cv2
 from pathlib import Path
 
-import queue
-from queue import Queue
-
-from dataset_manager import DatasetSaver
+from telemetry import load_speed_aligner
+from carla_log import log_info
+from replay_segments import write_segment_info
+from dataset_manager import DatasetSaver, MASK_FORMATS
+from mask_engine import MaskEngine
+from frame_ring import FrameRing, POLICIES
+from frame_filter import RedundantFrameFilter
+from dataset_pipeline import DatasetPipeline
+import metrics
 
 RATE_CONTROL_LOOP = 30
 
 
 def get_log_duration(client, log_file):
+
+    # From the log itself (see carla_log.py), the server is only asked if
+    # the file cannot be parsed
+    info = log_info(log_file)
+    if info is not None and info["frames"] > 0:
+        return info["duration"]
+
     import re           
     info = client.show_recorder_file_info(log_file, False)  
     # Look at for Duration: 12.34 s"
@@ -48,12 +60,166 @@ def get_log_duration(client, log_file):
         raise RuntimeError("Duration time cannot be read!")
     return float(match.group(1))
 
-def replay_loop(args, view="car"):
+# Short names for the actors of recorder.py
+VIEWS = {"car": "vehicle.tesla.model3", "bike": "vehicle.diamondback.century"}
+
+# Telemetry role (recorder.py) of each view, for the speed of the dataset
+VIEW_ROLES = {"car": "ego", "vehicle.tesla.model3": "ego",
+              "bike": "bike", "vehicle.diamondback.century": "bike"}
+
+# Seconds of simulation between speed alignment reports
+ALIGN_REPORT_PERIOD = 10.0
+
+
+class ViewCapture:
+
+    # Cameras attached to one actor of the replay, with their own frame ring.
+    # The images of all the cameras of a simulation frame share a ring slot,
+    # which is handed to the loop when complete.
+
+    def __init__(self, world, vehicle, name, width, height, segmented=False,
+                 ring_slots=8, ring_policy="drop_oldest"):
+
+        self.vehicle = vehicle
+        self.name = name
+        self.dataset = None
+        self.pipeline = None
+        self.speed = None
+        self.frame_filter = None
+
+        blueprint_library = world.get_blueprint_library()
+        camera_transform = carla.Transform(carla.Location(x=0.8, z=1.7))
+
+        camera_bp = blueprint_library.find("sensor.camera.rgb")
+        camera_bp.set_attribute("image_size_x", str(width))
+        camera_bp.set_attribute("image_size_y", str(height))
+        camera_bp.set_attribute("fov", "90")
+        self.camera = world.spawn_actor(camera_bp, camera_transform, attach_to=vehicle)
+
+        # Semantic segmentation camera at the same place as the RGB one
+        self.seg_camera = None
+        if segmented:
+            seg_bp = blueprint_library.find("sensor.camera.semantic_segmentation")
+            seg_bp.set_attribute("image_size_x", str(width))
+            seg_bp.set_attribute("image_size_y", str(height))
+            seg_bp.set_attribute("fov", "90")
+            self.seg_camera = world.spawn_actor(seg_bp, camera_transform, attach_to=vehicle)
+
+        kinds = {"rgb": (height, width, 3)}
+        if self.seg_camera is not None:
+            kinds["segmented"] = (height, width)
+        self.ring = FrameRing(kinds, slots=ring_slots, policy=ring_policy)
+
+        self.camera.listen(lambda img: self._process_image(img))
+        if self.seg_camera is not None:
+            self.seg_camera.listen(lambda img: self._process_segmentation(img))
+
+    def _process_image(self, image):
+        # Copied from the raw buffer straight into a ring slot
+        with metrics.timer("sensor_callback"):
+            bgra = np.frombuffer(image.raw_data, dtype=np.uint8)
+            bgra = np.reshape(bgra, (image.height, image.width, 4))
+            self.ring.write(image.frame, image.timestamp, "rgb", bgra[:, :, :3])
+
+    def _process_segmentation(self, image):
+        # The semantic tag of each pixel is in the red channel
+        with metrics.timer("sensor_callback"):
+            bgra = np.frombuffer(image.raw_data, dtype=np.uint8)
+            bgra = np.reshape(bgra, (image.height, image.width, 4))
+            self.ring.write(image.frame, image.timestamp, "segmented", bgra[:, :, 2])
+
+    def collect_metrics(self):
+        # Frame ring counters as gauges of the metrics reports
+        for name, value in self.ring.stats().items():
+            metrics.set_gauge(f"frames_{name}", value, view=self.name)
+        if self.frame_filter is not None:
+            for name, value in self.frame_filter.stats().items():
+                metrics.set_gauge(f"samples_{name}", value, view=self.name)
+
+    def get_nowait(self):
+        return self.ring.get_nowait()
+
+    def wait_frame(self, frame_id, timeout=5.0):
+        # Blocks until the images of frame_id arrive (sync mode)
+        return self.ring.wait_frame(frame_id, timeout)
+
+    def release(self, item):
+        # The ring slot of item can be reused
+        self.ring.release(item)
+
+    def destroy(self):
+        for camera in (self.camera, self.seg_camera):
+            if camera is not None:
+                camera.stop()
+                camera.destroy()
+        self.ring.close()
+        self.vehicle.destroy()
+
+
+def report_speed_alignment(captures, rel_time=None):
+
+    # Time difference between dataset samples and the recorded speed
+    for capture in captures:
+        if capture.speed is None:
+            continue
+        count, mean, worst = capture.speed.stats()
+        if rel_time is not None:
+            print(f"[INFO] {rel_time:.0f} s, speed alignment ({capture.name}): "
+                  f"{count} samples, avg {mean:.4f} s, max {worst:.4f} s")
+        else:
+            print(f"[INFO] Speed alignment ({capture.name})")
+            print(f"  - Nº samples:        {count}")
+            print(f"  - Avg time diff:     {mean:.4f} s")
+            print(f"  - Max time diff:     {worst:.4f} s")
+
+
+def find_view_actor(world, view):
+
+    # view: a short name of VIEWS or an actor filter (e.g. vehicle.tesla.model3)
+    actors = world.get_actors().filter(VIEWS.get(view, view))
+    if not actors:
+        return None
+    return actors[0]  # first vehicle is ego
+
+
+def view_dataset_path(base_path, view, views):
+
+    # With a single view the dataset goes straight to base_path, with several
+    # views each one gets its own directory
+    if len(views) == 1:
+        return base_path
+    name = view.split(".")[-1].replace("*", "")
+    return os.path.join(base_path, name) + os.sep
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def replay_loop(args, views=("car",)):
+
+    views = list(views)
+
+    # Stop cleanly on SIGTERM (batch schedulers) as on Ctrl+C
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+
+    if args.metrics:
+        metrics.enable()
+        metrics.start_reports(args.metrics, args.metrics_interval)
 
     pygame.init()
-    pygame.display.set_caption(f"CARLA Replay - Replay view {view} ")
     display_width, display_height = 800, 600
-    screen = pygame.display.set_mode((display_width, display_height))
+    screen = None
+    if not args.headless:
+        pygame.display.set_caption(f"CARLA Replay - Replay view {', '.join(views)} ")
+        screen = pygame.display.set_mode((display_width, display_height))
+
+    def _check_quit():
+        if screen is None:
+            return
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                raise KeyboardInterrupt
 
     client = carla.Client('localhost', args.port)  
     client.set_timeout(10.0)
@@ -72,152 +238,278 @@ def replay_loop(args, view="car"):
     log_filename = str(p)
     print(f'Using log file {log_filename}')
 
-    duration = get_log_duration(client, log_filename)
-    duration = duration + world.get_snapshot().timestamp.elapsed_seconds
-    print(f"Replaying: {log_filename}, duration: {duration:.2f} s")
-
-    dataset = None
-    if args.generate_dataset_path is not None:        
-        dataset = DatasetSaver(args.generate_dataset_path)
-    
-    client.replay_file(log_filename, 0, 0, 0)
-
-    blueprint_library = world.get_blueprint_library()
+    # Window of the log to replay (times of the log). The warm-up before
+    # start is replayed but not saved.
+    log_duration = get_log_duration(client, log_filename)
+    if args.start >= log_duration:
+        raise RuntimeError(f"--start {args.start} is after the end of the log ({log_duration:.2f} s)")
+    log_end = log_duration if args.duration <= 0 else min(log_duration, args.start + args.duration)
+    replay_start = max(0.0, args.start - args.warmup)
+    windowed = args.start > 0 or args.duration > 0
+    print(f"Replaying: {log_filename}, from {args.start:.2f} s to {log_end:.2f} s "
+          f"(warm-up from {replay_start:.2f} s)")
+
+    # Outputs requested, only those are computed and saved
+    dataset_types = set(args.dataset_types)
+    if "all" in dataset_types:
+        dataset_types = {"rgb", "mask", "segmented"}
+
+    generate_dataset = args.generate_dataset_path is not None
+    mask_engine = None
+    if generate_dataset and "mask" in dataset_types and args.workers == 0:
+        mask_engine = MaskEngine()
     
-    actors = None
+    # Nobody would tick a synchronous world after an error in the setup:
+    # restore it and free the cameras (and datasets) built so far
+    original_settings = None
+    captures = []
+    try:
+        # Synchronous mode: the world only advances when we tick it, one fixed
+        # step each time, so every simulation frame is captured
+        if args.sync:
+            original_settings = world.get_settings()
+            settings = world.get_settings()
+            settings.synchronous_mode = True
+            settings.fixed_delta_seconds = 1.0 / args.sync_fps
+            world.apply_settings(settings)
+
+        client.replay_file(log_filename, replay_start, 0 if args.duration <= 0 else log_end - replay_start, 0)
+
+        if args.sync:
+            # Actors of the log are spawned on the next tick
+            world.tick()
+
+        # Dataset times start here, when the log starts playing, as the recorder
+        # telemetry starts when the recording does
+        t0_sim = world.get_snapshot().timestamp.elapsed_seconds
+        duration = t0_sim + log_end - replay_start
+
+        # One capture (cameras + dataset) per point of view
+        for view in views:
+            vehicle = find_view_actor(world, view)
+            if vehicle is None:
+                print(f"[ERROR] No actor found for view {view}")
+                continue
+            print(f"Using ego con id={vehicle.id}, type={vehicle.type_id} (view {view})")
+
+            capture = ViewCapture(world, vehicle, view, display_width, display_height,
+                                  segmented=generate_dataset and "segmented" in dataset_types,
+                                  ring_slots=args.ring_slots, ring_policy=args.ring_policy)
+            captures.append(capture)
+            metrics.add_collector(capture.collect_metrics)
+            if generate_dataset:
+                capture.dataset = DatasetSaver(view_dataset_path(args.generate_dataset_path, view, views),
+                                               writer_threads=args.writer_threads,
+                                               max_pending=args.writer_queue,
+                                               flush_rows=args.metadata_flush_rows,
+                                               sidecar=args.metadata_sidecar,
+                                               storage=args.storage,
+                                               shard_size=args.shard_size,
+                                               dataset_types=dataset_types,
+                                               mask_format=args.mask_format)
+
+                if windowed:
+                    write_segment_info(capture.dataset.dataset_path, log_filename, args.start, log_end,
+                                       args.start - replay_start)
+
+                # Redundant samples (e.g. stopped at a light) are not saved
+                if args.skip_redundant > 0:
+                    capture.frame_filter = RedundantFrameFilter(threshold=args.skip_redundant,
+                                                                min_interval=args.skip_redundant_interval)
+
+                # Masks and encoding in worker processes
+                if args.workers > 0:
+                    capture.pipeline = DatasetPipeline(capture.dataset, (display_height, display_width),
+                                                       workers=args.workers)
+
+                # Recorded speed of this actor, filled in as samples are saved
+                role = VIEW_ROLES.get(view)
+                capture.speed = load_speed_aligner(args.log_path, role) if role else None
+                if capture.speed is None:
+                    print(f"[WARN] No recorded speed for view {view}, speed will be 0")
+
+        if not captures:
+            raise RuntimeError("No vehicles found in the replay")
+    except BaseException:
+        if original_settings is not None:
+            world.apply_settings(original_settings)
+        for capture in captures:
+            capture.destroy()
+            if capture.pipeline is not None:
+                capture.pipeline.close()
+            if capture.dataset is not None:
+                capture.dataset.close()
+        if args.metrics:
+            metrics.stop_reports(args.metrics)
+        raise
 
-    if (view == "car"):
-        actors = world.get_actors().filter("vehicle.tesla.model3")
-    elif (view == "bike"):
-        actors = world.get_actors().filter("vehicle.diamondback.century")
+    clock = pygame.time.Clock()
 
-    if not actors:
-        raise RuntimeError("No vehicles found in the replay")
+    next_align_report = replay_start + ALIGN_REPORT_PERIOD
 
-    vehicle = actors[0]  # first vehicle is ego
-    print(f"Using ego con id={vehicle.id}, type={vehicle.type_id}")
-    
-    camera_bp = blueprint_library.find("sensor.camera.rgb")
-    camera_bp.set_attribute("image_size_x", str(display_width))
-    camera_bp.set_attribute("image_size_y", str(display_height))
-    camera_bp.set_attribute("fov", "90")
-
-    camera_transform = carla.Transform(carla.Location(x=0.8, z=1.7))
-    camera = world.spawn_actor(camera_bp, camera_transform, attach_to=vehicle)
-
-    frame_q = Queue(maxsize=1)   # save (rgb, bgr, (w, h))
-
-    def _safe_put(q: Queue, item):
-        try:
-            q.put_nowait(item)
-        except queue.Full:
-            try:
-                q.get_nowait()
-            except queue.Empty:
-                pass
-            q.put_nowait(item)
-
-    def process_image(image):
-        bgra = np.frombuffer(image.raw_data, dtype=np.uint8)
-        bgra = np.reshape(bgra, (image.height, image.width, 4))
-        bgr  = bgra[:, :, :3].copy()
-        rgb  = bgr[:, :, ::-1]
-        _safe_put(frame_q, (rgb, bgr, (image.width, image.height)))
-
-    camera.listen(lambda img: process_image(img))
+    # Exit code, so batch scripts can tell failed replays
+    exit_code = 0
 
-    clock = pygame.time.Clock()
-
-    # Start at a relative time 0.0 to syncronize with speed csv
-    t0_sim = 0.0
+    # The window is only updated every preview_every frames
+    frames_received = 0
 
     try:
         while True:            
             
-            clock.tick(RATE_CONTROL_LOOP)
-
-            snapshot = world.get_snapshot()  
-            sim_time = snapshot.timestamp.elapsed_seconds                      
-            
-            if sim_time >= duration:
-                print("Replay finished")
-                break
-
-            try:
-                rgb, bgr, (w, h) = frame_q.get_nowait()
-            except queue.Empty:
-             
-                for e in pygame.event.get():
-                    if e.type == pygame.QUIT:
-                        raise KeyboardInterrupt
-                continue
-
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    raise KeyboardInterrupt
-
-            # Get relative time for speedcsv/replay sync
-            if t0_sim == 0.0:
-                t0_sim = sim_time
-
-            rel_time = sim_time - t0_sim
-
-            
-            #if image_surface is not None:
-            surface = pygame.surfarray.make_surface(rgb.swapaxes(0, 1))
-            screen.blit(surface, (0, 0))
-
-            pygame.display.flip()
-
-            if dataset is not None:
-                # Generate dataset
-                hsv = cv2.cvtColor(rgb, cv2.COLOR_RGB2HSV)
-                mask_y = cv2.inRange(hsv, np.array([18, 50, 150]), np.array([40, 255, 255]))
-                mask_w = cv2.inRange(hsv, np.array([0, 0, 200]),  np.array([180, 30, 255]))
-                mask_c = np.zeros(mask_w.shape, np.uint8); mask_c[mask_w>0]=1; mask_c[mask_y>0]=2
-                mask_rgb = np.zeros_like(rgb); mask_rgb[mask_c==1]=[255,255,255]; mask_rgb[mask_c==2]=[255,255,0]
-
-                # You can get the controls of the vehicule at each snapshot
-                # ctrl = vehicle.get_control()
-                # print(ctrl.throttle, ctrl.steer, ctrl.brake)
-
-
-                ctrl = vehicle.get_control()
-                throttle = float(ctrl.throttle)
-                steer    = max(-1.0, min(1.0, float(ctrl.steer)))
-                brake    = float(ctrl.brake)
-                speed = 0.0
-
-                dataset.save_sample(rel_time, bgr, mask_rgb, throttle, steer, brake, speed)
-
+            if args.sync:
+                # As fast as the loop can consume frames, none is missed
+                with metrics.timer("rpc_tick"):
+                    frame_id = world.tick()
+                with metrics.timer("frame_wait"):
+                    items = [c.wait_frame(frame_id) for c in captures]
+                received = [item for item in items if item is not None]
+                if len(received) < len(items):
+                    print(f"[WARN] No image received for frame {frame_id}")
+                if not received:
+                    if world.get_snapshot().timestamp.elapsed_seconds >= duration:
+                        print("Replay finished")
+                        break
+                    continue
+
+                sim_time = received[0].timestamp
+
+                if sim_time >= duration:
+                    print("Replay finished")
+                    break
+            else:
+                with metrics.timer("rpc_get_snapshot"):
+                    snapshot = world.get_snapshot()  
+                sim_time = snapshot.timestamp.elapsed_seconds                      
+                
+                if sim_time >= duration:
+                    print("Replay finished")
+                    break
+
+                # Frames waiting in the rings are taken without delay, the
+                # loop only sleeps when there is none
+                items = [c.get_nowait() for c in captures]
+                if all(item is None for item in items):
+                 
+                    clock.tick(RATE_CONTROL_LOOP)
+                    _check_quit()
+                    continue
+
+            _check_quit()
+            frames_received += 1
+
+            # Time of the log, the same clock as the recorder telemetry
+            rel_time = sim_time - t0_sim + replay_start
+
+            if rel_time >= next_align_report:
+                next_align_report += ALIGN_REPORT_PERIOD
+                report_speed_alignment(captures, rel_time)
+
+            for n, (capture, item) in enumerate(zip(captures, items)):
+                if item is None:
+                    continue
+
+                # Views of the ring slot, valid until it is released
+                bgr = item.images["rgb"]
+                segmented = item.images.get("segmented")
+
+                # Time of the image itself, the snapshot may be a frame ahead
+                sample_time = item.timestamp - t0_sim + replay_start
+
+                # Frames of the warm-up are not saved
+                if sample_time < args.start:
+                    metrics.inc("warmup_frames")
+                    continue
+
+                # The window shows the first view
+                if n == 0 and screen is not None and frames_received % args.preview_every == 0:
+                    with metrics.timer("preview"):
+                        rgb = bgr[:, :, ::-1]
+                        surface = pygame.surfarray.make_surface(rgb.swapaxes(0, 1))
+                        screen.blit(surface, (0, 0))
+
+                        pygame.display.flip()
+
+                dataset = capture.dataset
+                if dataset is not None:
+                    # You can get the controls of the vehicule at each snapshot
+                    with metrics.timer("rpc_get_control"):
+                        ctrl = capture.vehicle.get_control()
+                    throttle = float(ctrl.throttle)
+                    steer    = max(-1.0, min(1.0, float(ctrl.steer)))
+                    brake    = float(ctrl.brake)
+
+                    if capture.frame_filter is not None:
+                        with metrics.timer("frame_filter"):
+                            keep = capture.frame_filter.keep(sample_time, bgr, throttle, steer, brake)
+                        if not keep:
+                            metrics.inc("redundant_samples")
+                            continue
+
+                    speed = capture.speed.speed_at(sample_time) if capture.speed is not None else 0.0
+
+                    metrics.inc("samples")
+
+                    if capture.pipeline is not None:
+                        with metrics.timer("pipeline_submit"):
+                            capture.pipeline.submit(sample_time, bgr, throttle, steer, brake, speed,
+                                                    segmented=segmented)
+                        continue
+
+                    # Generate dataset (white lanes = 1, yellow lanes = 2)
+                    # The dataset stores the class ids in its mask format
+                    mask = None
+                    if mask_engine is not None:
+                        with metrics.timer("mask"):
+                            mask = mask_engine.classify(bgr, order="bgr")
+
+                    with metrics.timer("save_sample"):
+                        dataset.save_sample(sample_time, bgr, mask, throttle, steer, brake, speed,
+                                            segmented=segmented)
+
+            # The dataset has copied or written the images, the slots can be reused
+            for capture, item in zip(captures, items):
+                if item is not None:
+                    capture.release(item)
 
     except KeyboardInterrupt:
         print("Exit...")
     except Exception as e:
         print(e)
+        exit_code = 1
     finally:
-        if camera is not None:
-            camera.stop()
-            camera.destroy()
+        if original_settings is not None:
+            world.apply_settings(original_settings)
 
-        vehicle.destroy()
+        for capture in captures:
+            capture.destroy()
         
-        if dataset is not None:
-
-            # Takes both dataset and speed CSV files and do the matching
-            path = Path(args.log_path)
-            logs = list(path.glob("*.csv"))    
-            if (len(logs) == 0):
-                print(f"Error, no data csv file found in {args.log_path}")
-                exit(-1) 
-
-            csv_data_filename = str(logs[0])
-
-            dataset.adjust_speed(csv_data_filename)
+        # Wait for pending image writes
+        for capture in captures:
+            if capture.pipeline is not None:
+                capture.pipeline.close()
+            if capture.dataset is not None:
+                capture.dataset.close()
+
+        report_speed_alignment(captures)
+
+        # Frames lost between the cameras and the dataset
+        for capture in captures:
+            st = capture.ring.stats()
+            print(f"[INFO] Frames ({capture.name}): {st['received']} received, {st['consumed']} consumed, "
+                  f"{st['dropped']} dropped, {st['gaps']} never received")
+            if capture.frame_filter is not None:
+                st = capture.frame_filter.stats()
+                total = max(1, st["kept"] + st["skipped"])
+                print(f"[INFO] Samples ({capture.name}): {st['kept']} kept, {st['skipped']} redundant "
+                      f"skipped ({100.0 * st['skipped'] / total:.1f}%)")
+
+        if args.metrics:
+            metrics.stop_reports(args.metrics)
+            print(f"[INFO] Metrics written to {args.metrics}")
 
 
         pygame.quit()
-        sys.exit()
+        sys.exit(exit_code)
 
 
 if __name__ == "__main__":
@@ -241,14 +533,92 @@ if __name__ == "__main__":
                         "--dataset_types", "--carla-dataset-types",
                         nargs="+",
                         choices=["rgb", "mask", "segmented", "all"],
-                        default=["all"],
+                        default=["rgb", "mask"],
                         metavar="TYPE",
                         help=(
                             "Types of frames to export. Options: rgb, mask, segmented, all. "
-                            "Example: --dataset_types rgb mask"
+                            "Example: --dataset_types rgb mask (default)"
                         )
                     )
-    args = parser.parse_args()
+
+    parser.add_argument("--sync", action="store_true",
+                        help="Replay in synchronous mode, as fast as frames are processed, capturing every frame")
+
+    parser.add_argument("--sync_fps", type=float, default=RATE_CONTROL_LOOP,
+                        help="Simulation steps per second in synchronous mode (rate of the recording)")
+
+    parser.add_argument("--writer_threads", type=int, default=0,
+                        help="Number of threads encoding dataset images in background (0 = write in the replay loop)")
+
+    parser.add_argument("--writer_queue", type=int, default=32,
+                        help="Maximum number of samples waiting to be written before the replay loop blocks")
+
+    parser.add_argument("--metadata_flush_rows", type=int, default=256,
+                        help="Number of dataset rows buffered before they are written to dataset.csv")
+
+    parser.add_argument("--metadata_sidecar", action="store_true",
+                        help="Also save the dataset metadata as typed numpy columns in dataset.npz")
+
+    parser.add_argument("--storage", choices=["png", "tar", "raw"], default="png",
+                        help=("How dataset images are stored: one PNG file per image, packed in tar shards, "
+                              "or uncompressed in memory-mapped arrays (masks as class ids)"))
+
+    parser.add_argument("--shard_size", type=int, default=1000,
+                        help="Number of samples in each tar shard (--storage tar)")
+
+    parser.add_argument("--skip_redundant", type=float, default=0.0, metavar="THRESHOLD",
+                        help=("Skip samples whose frame (downsampled to 64x48 gray) differs from the last "
+                              "saved one by less than THRESHOLD (mean absolute difference, 0-255, e.g. 2) "
+                              "and whose controls are unchanged. 0 saves every sample (default)"))
+
+    parser.add_argument("--skip_redundant_interval", type=float, default=1.0,
+                        help="With --skip_redundant, save at least one sample every this many seconds")
+
+    parser.add_argument("--mask_format", choices=MASK_FORMATS, default="palette",
+                        help=("How lane masks are stored: palettized PNG of class ids, single channel "
+                              "class ids, or RGB colour images. Raw storage always keeps class ids"))
 
     # Use "bike" or "car" to choose from where point of view you want to replay de simulation
-    replay_loop(args, "car")
+    parser.add_argument("--views", type=str, nargs="+", default=["car"],
+                        help=("Points of view to capture in the same replay: car, bike or actor filters "
+                              "(e.g. vehicle.tesla.model3). Each view gets its own dataset"))
+
+    parser.add_argument("--start", type=float, default=0.0,
+                        help="Replay from this time of the log (s)")
+
+    parser.add_argument("--duration", type=float, default=0.0,
+                        help="Seconds of the log to replay from --start (0 = until the end)")
+
+    parser.add_argument("--warmup", type=float, default=0.0,
+                        help="Seconds replayed before --start whose frames are not saved "
+                             "(the actors settle after the replayer jumps in the log)")
+
+    parser.add_argument("--ring_slots", type=int, default=8,
+                        help="Frames that can wait between the cameras and the replay loop")
+
+    parser.add_argument("--ring_policy", type=str, choices=POLICIES, default="drop_oldest",
+                        help="When the loop is slower than the cameras: drop the oldest frame "
+                             "or make the cameras wait (block, lossless)")
+
+    parser.add_argument("--headless", action="store_true",
+                        help="Do not open any window (no display needed)")
+
+    parser.add_argument("--preview_every", type=int, default=1,
+                        help="Update the window only every N frames")
+
+    parser.add_argument("--metrics", type=str, default=None,
+                        help="Directory where timing and counter reports (metrics.json, metrics.prom) are written")
+
+    parser.add_argument("--metrics_interval", type=float, default=10.0,
+                        help="Seconds between metrics reports during the replay")
+
+    parser.add_argument("--workers", type=int, default=0,
+                        help=("Worker processes computing masks and encoding images (png or tar "
+                              "storage), for each view. 0 does it in the replay process"))
+
+    args = parser.parse_args()
+    args.preview_every = max(1, args.preview_every)
+    if args.workers > 0 and args.storage == "raw":
+        parser.error("--workers needs png or tar storage")
+
+    replay_loop(args, args.views)
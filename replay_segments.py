@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+#
+#
+#  Copyright (C) URJC DeepRacer
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+#  Author : Roberto Calvo Palomino <roberto.calvo at urjc dot es
+#           Sergio Robledo <s.robledo.2021 at alumnos dot urjc dot es>
+
+# Replays a long log in time windows (segments) on several servers, then
+# merges the datasets of the segments into one.
+#
+# Each segment is replayed from a few seconds before its start (warm-up,
+# actors settle after the replayer jumps in the log) and the frames of the
+# warm-up are discarded, see replay.py --start --duration --warmup. Dataset
+# timestamps are times of the log, so the segments do not overlap once the
+# warm-up is gone, and replay.py writes the window in segment.json.
+#
+#   python3 replay_segments.py plan logs/1763717922_Town04/ --segment_length 600
+#   python3 replay_segments.py merge --output /data/merged/ /data/seg_000/ /data/seg_001/ ...
+
+import os
+import sys
+import csv
+import json
+import math
+import time
+import shutil
+import argparse
+import collections
+
+from dataset_manager import IMAGE_TYPES, CLASSES_FILENAME, MetadataSink, dataset_columns
+from dataset_storage import (SHARDS_FOLDERNAME, RAW_FOLDERNAME, ShardReader, RawFrameReader,
+                             open_storage)
+
+
+SEGMENT_FILENAME = "segment.json"
+
+# Warm-up replayed before each segment and discarded (s)
+DEFAULT_WARMUP = 5.0
+
+# Window of a log: start and duration (0 = until the end of the log) in
+# seconds of the log, and warm-up replayed before start
+Segment = collections.namedtuple("Segment", ["log", "index", "start", "duration", "warmup"])
+
+
+def plan_segments (log, log_duration, segment_length, warmup=DEFAULT_WARMUP):
+
+    # Splits a log in segments of about segment_length seconds (all of the
+    # same length). The last one goes until the end of the log.
+    count = max(1, math.ceil(log_duration / segment_length - 1e-6)) if segment_length > 0 else 1
+    length = log_duration / count
+    segments = []
+    for i in range(count):
+        start = round(i * length, 3)
+        duration = round(length, 3) if i < count - 1 else 0.0
+        segments.append(Segment(log, i, start, duration, min(warmup, start)))
+    return segments
+
+
+def segment_key (segment):
+    return f"{segment.log}#{segment.index:03d}"
+
+
+def segment_args (segment):
+
+    # Arguments of replay.py for a segment
+    return ["--start", str(segment.start), "--duration", str(segment.duration),
+            "--warmup", str(segment.warmup)]
+
+
+def write_segment_info (dataset_path, log, start, end, warmup):
+
+    # Window of the samples of a dataset (times of the log)
+    with open(os.path.join(dataset_path, SEGMENT_FILENAME), "w") as f:
+        json.dump({"log": log, "start": start, "end": end, "warmup": warmup}, f, indent=2)
+
+
+def read_segment_info (dataset_path):
+
+    filename = os.path.join(dataset_path, SEGMENT_FILENAME)
+    if not os.path.isfile(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+
+def find_datasets (path):
+
+    # {path relative to path: dataset directory} of the datasets (directories
+    # with a dataset.csv) under path, e.g. {"car": ".../car/1763718805717_dataset"}.
+    # Several datasets for one view (e.g. left by a failed replay) cannot be
+    # told apart: ValueError.
+    found = collections.defaultdict(list)
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        if "dataset.csv" in files:
+            found[os.path.relpath(os.path.dirname(root), path)].append(root)
+            dirs[:] = []
+
+    for view, roots in found.items():
+        if len(roots) > 1:
+            raise ValueError(f"several datasets in {os.path.dirname(roots[0])} "
+                             f"({', '.join(os.path.basename(r) for r in roots)}), remove the incomplete ones")
+    return {view: roots[0] for view, roots in found.items()}
+
+
+def dataset_storage_kind (dataset_path):
+
+    if os.path.isdir(os.path.join(dataset_path, SHARDS_FOLDERNAME)):
+        return "tar"
+    if os.path.isdir(os.path.join(dataset_path, RAW_FOLDERNAME)):
+        return "raw"
+    return "png"
+
+
+def _segment_order (dataset_path):
+
+    # Datasets are merged in log time order
+    info = read_segment_info(dataset_path)
+    if info is not None:
+        return info["start"]
+    with open(os.path.join(dataset_path, "dataset.csv"), newline="") as f:
+        for row in csv.DictReader(f):
+            return float(row["timestamp"])
+    return float("inf")
+
+
+def merge_datasets (dataset_paths, output_path, move=False, shard_size=1000):
+
+    # Merges the datasets of the segments of a log (in any order) in a new
+    # dataset under output_path, numbered from 0 in time order. Samples out
+    # of the window of their segment, or not after the previous sample, are
+    # dropped. Images are copied (moved with move=True, png only) without
+    # encoding them again. Returns the merged dataset directory.
+    dataset_paths = sorted(dataset_paths, key=_segment_order)
+    if not dataset_paths:
+        raise ValueError("no dataset to merge")
+
+    kinds = {dataset_storage_kind(p) for p in dataset_paths}
+    if len(kinds) > 1:
+        raise ValueError(f"datasets with different storage: {', '.join(sorted(kinds))}")
+    kind = kinds.pop()
+
+    with open(os.path.join(dataset_paths[0], "dataset.csv"), newline="") as f:
+        header = next(csv.reader(f))
+    image_types = [t for t in IMAGE_TYPES if f"{t}_path" in header]
+
+    dataset_path = os.path.join(output_path, str(int(time.time() * 1000)) + "_dataset")
+    os.makedirs(dataset_path, exist_ok=True)
+    if kind == "png":
+        for image_type in image_types:
+            os.makedirs(os.path.join(dataset_path, image_type), exist_ok=True)
+    storage = open_storage(dataset_path, kind, shard_size) if kind != "png" else None
+
+    # Masks are copied as they are: same class table
+    classes_filename = os.path.join(dataset_paths[0], CLASSES_FILENAME)
+    if os.path.isfile(classes_filename):
+        shutil.copyfile(classes_filename, os.path.join(dataset_path, CLASSES_FILENAME))
+
+    sidecar = all(os.path.isfile(os.path.join(p, "dataset.npz")) for p in dataset_paths)
+    metadata = MetadataSink(os.path.join(dataset_path, "dataset.csv"), dataset_columns(image_types),
+                            sidecar_filename=os.path.join(dataset_path, "dataset.npz") if sidecar else None)
+
+    index = 0
+    dropped = 0
+    missing = 0
+    last_time = -float("inf")
+
+    try:
+        for path in dataset_paths:
+            info = read_segment_info(path)
+            start = info["start"] if info is not None else -float("inf")
+            end = info["end"] if info is not None else float("inf")
+            reader = ShardReader(path) if kind == "tar" else RawFrameReader(path) if kind == "raw" else None
+
+            with open(os.path.join(path, "dataset.csv"), newline="") as f:
+                for row in csv.DictReader(f):
+                    timestamp = float(row["timestamp"])
+                    if not (start <= timestamp < end) or timestamp <= last_time:
+                        dropped += 1
+                        continue
+
+                    sources = [row[f"{t}_path"].lstrip("/") for t in image_types]
+                    targets = [f"{t}/{t}_{index:08d}.png" for t in image_types]
+
+                    if kind == "png":
+                        if not all(os.path.isfile(os.path.join(path, s)) for s in sources):
+                            missing += 1
+                            continue
+                        for source, target in zip(sources, targets):
+                            copy = shutil.move if move else shutil.copyfile
+                            copy(os.path.join(path, source), os.path.join(dataset_path, target))
+                    else:
+                        images = [reader.read_bytes(s) if kind == "tar" else reader.read(s) for s in sources]
+                        if any(image is None for image in images):
+                            missing += 1
+                            continue
+                        storage.write_sample(index, list(zip(targets, images)))
+
+                    metadata.append(*[f"/{t}" for t in targets], timestamp, float(row["throttle"]),
+                                    float(row["steer"]), float(row["brake"]), float(row["speed"]))
+                    last_time = timestamp
+                    index += 1
+
+            if reader is not None:
+                reader.close()
+    finally:
+        if storage is not None:
+            storage.close()
+        metadata.close()
+
+    print(f"[INFO] Merged {len(dataset_paths)} segments in {dataset_path}")
+    print(f"  - Nº samples:        {index}")
+    print(f"  - Out of window:     {dropped}")
+    if missing:
+        print(f"[WARN] {missing} samples without their images were left out")
+    return dataset_path
+
+
+def merge_segments (segment_paths, output_path, move=False):
+
+    # Segment outputs of replay.py (--generate_dataset_path of each segment),
+    # with one dataset or one per view: each view is merged on its own
+    views = collections.defaultdict(list)
+    for segment_path in segment_paths:
+        for view, dataset_path in find_datasets(segment_path).items():
+            views[view].append(dataset_path)
+
+    merged = {}
+    for view, dataset_paths in sorted(views.items()):
+        if len(dataset_paths) < len(segment_paths):
+            print(f"[WARN] View {view}: {len(segment_paths) - len(dataset_paths)} segments without dataset")
+        merged[view] = merge_datasets(dataset_paths, os.path.normpath(os.path.join(output_path, view)),
+                                      move=move)
+    return merged
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Replay a log in segments and merge their datasets")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    plan = subparsers.add_parser("plan", help="Print the replay.py arguments of each segment of a log")
+    plan.add_argument("log_path", type=str, help="Log directory (or .log file)")
+    plan.add_argument("--segment_length", type=float, required=True, help="Seconds of log per segment")
+    plan.add_argument("--warmup", type=float, default=DEFAULT_WARMUP,
+                      help="Seconds replayed before each segment and discarded")
+
+    merge = subparsers.add_parser("merge", help="Merge the datasets of the segments of a log")
+    merge.add_argument("segments", type=str, nargs="+",
+                       help="Dataset paths of the segments (--generate_dataset_path of replay.py)")
+    merge.add_argument("--output", type=str, required=True, help="Directory of the merged dataset")
+    merge.add_argument("--move", action="store_true", help="Move the images instead of copying them")
+
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        from carla_log import log_info, index_directory
+
+        if os.path.isdir(args.log_path):
+            infos = list(index_directory(args.log_path).values())
+            info = infos[0] if infos else None
+        else:
+            info = log_info(args.log_path)
+        if info is None:
+            print(f"[ERROR] Unable to read the log duration of {args.log_path}")
+            sys.exit(1)
+
+        for segment in plan_segments(args.log_path, info["duration"], args.segment_length, args.warmup):
+            print(f"python3 replay.py --log_path {args.log_path} {' '.join(segment_args(segment))}")
+    else:
+        try:
+            merge_segments(args.segments, args.output, move=args.move)
+        except ValueError as e:
+            print(f"[ERROR] {e}")
+            sys.exit(1)
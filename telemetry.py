@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+#
+#
+#  Copyright (C) URJC DeepRacer
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+#  Author : Roberto Calvo Palomino <roberto.calvo at urjc dot es
+#           Sergio Robledo <s.robledo.2021 at alumnos dot urjc dot es>
+
+# Telemetry of the recorded actors, read from the world snapshot of every
+# server frame (world.on_tick), so no extra RPC is needed per sample.
+# The callback only queues the values, a writer thread writes them to disk.
+#
+# telemetry.bin is a stream of fixed size records (TELEMETRY_DTYPE) after a
+# small header: TELEMETRY_MAGIC, uint32 version, uint32 length of a JSON
+# document (record dtype, roles, t0) padded to 64 bytes. Records are only
+# appended, so after a crash the file is valid up to the last whole record.
+#
+#   python3 telemetry.py logs/1763717922_Town04/telemetry.bin --csv
+
+import os
+import sys
+import csv
+import json
+import math
+import queue
+import struct
+import argparse
+import threading
+import time
+
+import numpy as np
+
+import metrics
+
+
+TELEMETRY_FILENAME = "telemetry.csv"
+TELEMETRY_BIN_FILENAME = "telemetry.bin"
+SPEED_FILENAME = "data.csv"
+
+TELEMETRY_MAGIC = b"CARLATLM"
+TELEMETRY_VERSION = 1
+
+TELEMETRY_COLUMNS = ["frame", "sim_time", "role", "actor_id",
+                     "x", "y", "z", "pitch", "yaw", "roll",
+                     "vx", "vy", "vz", "ax", "ay", "az", "speed"]
+
+SPEED_COLUMNS = ["sim_time", "speed_m_s"]
+
+TELEMETRY_DTYPE = np.dtype([("frame", "<u8"), ("sim_time", "<f8"), ("role", "u1"), ("actor_id", "<u4")]
+                           + [(name, "<f4") for name in TELEMETRY_COLUMNS[4:]])
+
+_HEADER_PREFIX = struct.Struct("<8sII")
+
+
+def _read_header (fh):
+
+    # Returns (header dict, offset of the first record)
+    prefix = fh.read(_HEADER_PREFIX.size)
+    if len(prefix) < _HEADER_PREFIX.size:
+        raise ValueError("telemetry header truncated")
+    magic, version, length = _HEADER_PREFIX.unpack(prefix)
+    if magic != TELEMETRY_MAGIC:
+        raise ValueError("not a telemetry file")
+    if version != TELEMETRY_VERSION:
+        raise ValueError(f"unsupported telemetry version {version}")
+
+    data = fh.read(length)
+    if len(data) < length:
+        raise ValueError("telemetry header truncated")
+    return json.loads(data), _HEADER_PREFIX.size + length
+
+
+def _header_dtype (header):
+
+    return np.dtype([tuple(field) for field in header["dtype"]])
+
+
+class TelemetryFile:
+
+    # Appends records in chunks of chunk_rows. If the file already exists
+    # (e.g. the recorder was restarted) the records are appended after the
+    # last whole one, a partial record left by a crash is dropped.
+
+    def __init__ (self, filename, roles, t0=0.0, chunk_rows=1024):
+
+        self.filename = filename
+        self.roles = list(roles)
+        self.role_ids = {role: i for i, role in enumerate(self.roles)}
+        self.buffer = np.zeros(max(1, chunk_rows), dtype=TELEMETRY_DTYPE)
+        self.pending = 0
+
+        if os.path.isfile(filename) and os.path.getsize(filename) > 0:
+            self.fh = open(filename, "r+b")
+            header, offset = _read_header(self.fh)
+            if _header_dtype(header) != TELEMETRY_DTYPE or header["roles"] != self.roles:
+                self.fh.close()
+                raise ValueError(f"{filename} was written with other records or roles")
+            size = os.path.getsize(filename)
+            whole = offset + (size - offset) // TELEMETRY_DTYPE.itemsize * TELEMETRY_DTYPE.itemsize
+            if whole != size:
+                print(f"[WARN] {filename}: dropping {size - whole} bytes of a partial record")
+            self.fh.truncate(whole)
+            self.fh.seek(whole)
+        else:
+            header = json.dumps({"dtype": TELEMETRY_DTYPE.descr, "roles": self.roles, "t0": t0}).encode()
+            header += b" " * (-(_HEADER_PREFIX.size + len(header)) % 64)
+            self.fh = open(filename, "wb")
+            self.fh.write(_HEADER_PREFIX.pack(TELEMETRY_MAGIC, TELEMETRY_VERSION, len(header)))
+            self.fh.write(header)
+            self.fh.flush()
+
+    def append (self, frame, sim_time, role, actor_id, values):
+
+        # values: x, y, z, pitch, yaw, roll, vx, vy, vz, ax, ay, az, speed
+        self.buffer[self.pending] = (frame, sim_time, self.role_ids[role], actor_id) + tuple(values)
+        self.pending += 1
+        if self.pending == len(self.buffer):
+            self.flush()
+
+    def flush (self):
+
+        if self.pending == 0:
+            return
+        self.fh.write(self.buffer[:self.pending].tobytes())
+        self.fh.flush()
+        self.pending = 0
+
+    def close (self):
+
+        if self.fh is None:
+            return
+        self.flush()
+        self.fh.close()
+        self.fh = None
+
+
+def load_telemetry (filename):
+
+    # Returns (header, records). records is a read-only np.memmap of the
+    # whole records in the file (a trailing partial record is ignored).
+    with open(filename, "rb") as fh:
+        header, offset = _read_header(fh)
+
+    dtype = _header_dtype(header)
+    count = (os.path.getsize(filename) - offset) // dtype.itemsize
+    if count == 0:
+        return header, np.empty(0, dtype=dtype)
+    return header, np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=(count,))
+
+
+def role_records (header, records, role):
+
+    # Records of one role, e.g. role_records(header, records, "ego")
+    if role not in header["roles"]:
+        return records[:0]
+    return records[records["role"] == header["roles"].index(role)]
+
+
+def export_csv (filename, log_path, ego_role="ego"):
+
+    # telemetry.bin -> telemetry.csv and data.csv (ego speed) in log_path
+    header, records = load_telemetry(filename)
+    roles = np.array(header["roles"], dtype=object)
+
+    with open(os.path.join(log_path, TELEMETRY_FILENAME), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(TELEMETRY_COLUMNS)
+        for start in range(0, len(records), 65536):
+            chunk = records[start:start + 65536]
+            cols = [chunk["frame"].tolist(), np.char.mod("%.6f", chunk["sim_time"]).tolist(),
+                    roles[chunk["role"]].tolist(), chunk["actor_id"].tolist()]
+            cols += [np.char.mod("%.6f", chunk[name]).tolist() for name in TELEMETRY_COLUMNS[4:]]
+            writer.writerows(zip(*cols))
+
+    ego = role_records(header, records, ego_role)
+    with open(os.path.join(log_path, SPEED_FILENAME), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(SPEED_COLUMNS)
+        writer.writerows(zip(np.char.mod("%.6f", ego["sim_time"]).tolist(),
+                             np.char.mod("%.6f", ego["speed"]).tolist()))
+
+    return len(records)
+
+
+class TelemetryRecorder:
+
+    # actors: {role: actor id}, e.g. {"ego": vehicle.id, "bike": bike.id}.
+    # Records go to telemetry.bin. With csv_export they are also written as
+    # text, telemetry.csv and data.csv (sim_time, speed_m_s of ego_role).
+    # sim_time is relative to t0 (elapsed_seconds), frames before it are skipped.
+
+    def __init__ (self, log_path, actors, t0=0.0, ego_role="ego", flush_rows=256, flush_interval=1.0,
+                  csv_export=False):
+
+        self.actors = dict(actors)
+        self.t0 = t0
+        self.ego_role = ego_role
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+
+        self.q = queue.Queue()
+        self.frames = 0
+        self.missing = 0
+        self.rows = 0
+
+        self.file = TelemetryFile(log_path + TELEMETRY_BIN_FILENAME, list(self.actors), t0=t0,
+                                  chunk_rows=flush_rows)
+
+        self.telemetry_fh = None
+        self.speed_fh = None
+        if csv_export:
+            self.telemetry_fh = open(log_path + TELEMETRY_FILENAME, "w", newline="")
+            self.telemetry_writer = csv.writer(self.telemetry_fh)
+            self.telemetry_writer.writerow(TELEMETRY_COLUMNS)
+
+            self.speed_fh = open(log_path + SPEED_FILENAME, "w", newline="")
+            self.speed_writer = csv.writer(self.speed_fh)
+            self.speed_writer.writerow(SPEED_COLUMNS)
+
+        self.thread = threading.Thread(target=self._writer_worker, name="TelemetryWriter", daemon=True)
+        self.thread.start()
+
+    def on_tick (self, snapshot):
+
+        # Runs in the CARLA callback thread: read the snapshot and queue it
+        sim_time = snapshot.timestamp.elapsed_seconds - self.t0
+        if sim_time < 0.0:
+            return
+
+        samples = []
+        for role, actor_id in self.actors.items():
+            actor = snapshot.find(actor_id)
+            if actor is None:
+                self.missing += 1
+                continue
+            t = actor.get_transform()
+            v = actor.get_velocity()
+            a = actor.get_acceleration()
+            samples.append((role, actor_id,
+                            t.location.x, t.location.y, t.location.z,
+                            t.rotation.pitch, t.rotation.yaw, t.rotation.roll,
+                            v.x, v.y, v.z, a.x, a.y, a.z))
+
+        self.frames += 1
+        self.q.put((snapshot.frame, sim_time, samples))
+        metrics.set_gauge("telemetry_queue", self.q.qsize())
+
+    def _writer_worker (self):
+
+        pending = 0
+        last_flush = time.monotonic()
+        while True:
+            item = self.q.get()
+            if item is None:
+                break
+
+            t0 = time.perf_counter()
+            frame, sim_time, samples = item
+            for sample in samples:
+                vx, vy, vz = sample[8:11]
+                speed = math.sqrt(vx * vx + vy * vy + vz * vz)
+                self.file.append(frame, sim_time, sample[0], sample[1], sample[2:] + (speed,))
+
+                if self.telemetry_fh is not None:
+                    self.telemetry_writer.writerow([frame, f"{sim_time:.6f}", sample[0], sample[1]]
+                                                   + [f"{value:.6f}" for value in sample[2:]]
+                                                   + [f"{speed:.6f}"])
+                    if sample[0] == self.ego_role:
+                        self.speed_writer.writerow([f"{sim_time:.6f}", f"{speed:.6f}"])
+                self.rows += 1
+            metrics.observe("telemetry_write", time.perf_counter() - t0)
+            metrics.inc("telemetry_frames")
+
+            # Flush in batches, or every flush_interval seconds
+            pending += 1
+            now = time.monotonic()
+            if pending >= self.flush_rows or now - last_flush >= self.flush_interval:
+                self.file.flush()
+                if self.telemetry_fh is not None:
+                    self.telemetry_fh.flush()
+                    self.speed_fh.flush()
+                pending = 0
+                last_flush = now
+
+    def close (self):
+
+        # Writes what is still queued
+        if self.thread is not None:
+            self.q.put(None)
+            self.thread.join()
+            self.thread = None
+
+        self.file.close()
+        if self.telemetry_fh is not None:
+            self.telemetry_fh.close()
+            self.speed_fh.close()
+
+        print(f"[INFO] Telemetry: {self.frames} frames, {self.rows} rows, {self.missing} actors not found")
+
+
+class SpeedAligner:
+
+    # Recorded speed at the replay times, nearest sample in time. Times are
+    # relative to the start of the recording (t0 of TelemetryRecorder) on one
+    # side and to the start of the replay on the other. Replay times grow, so
+    # a cursor only moves forward and each lookup is O(1) amortized.
+
+    def __init__ (self, times, speeds):
+
+        order = np.argsort(np.asarray(times, dtype=np.float64), kind="stable")
+        self.times = np.asarray(times, dtype=np.float64)[order].tolist()
+        self.speeds = np.asarray(speeds, dtype=np.float64)[order].tolist()
+        if not self.times:
+            raise ValueError("no speed samples")
+
+        self.cursor = 0
+        self.count = 0
+        self.error_sum = 0.0
+        self.error_max = 0.0
+
+    def speed_at (self, t):
+
+        times = self.times
+        i = self.cursor
+        if t < times[i]:
+            # Time went back (should not happen), search again
+            i = max(0, int(np.searchsorted(times, t, side="right")) - 1)
+        while i + 1 < len(times) and times[i + 1] <= t:
+            i += 1
+        self.cursor = i
+
+        if i + 1 < len(times) and times[i + 1] - t < t - times[i]:
+            i += 1
+
+        error = abs(times[i] - t)
+        self.count += 1
+        self.error_sum += error
+        if error > self.error_max:
+            self.error_max = error
+        return self.speeds[i]
+
+    def stats (self):
+
+        # (number of lookups, mean and max time difference in seconds)
+        mean = self.error_sum / self.count if self.count else 0.0
+        return self.count, mean, self.error_max
+
+
+def load_speed_aligner (log_path, role="ego"):
+
+    # SpeedAligner for one actor of a recorded log: telemetry.bin, or data.csv
+    # of older logs (ego only). None if there is no speed for that actor.
+    filename = os.path.join(log_path, TELEMETRY_BIN_FILENAME)
+    if os.path.isfile(filename):
+        header, records = load_telemetry(filename)
+        records = role_records(header, records, role)
+        if len(records) == 0:
+            return None
+        # float32 values rounded as they were written in the CSV
+        return SpeedAligner(records["sim_time"], np.round(records["speed"].astype(np.float64), 6))
+
+    filename = os.path.join(log_path, SPEED_FILENAME)
+    if role != "ego" or not os.path.isfile(filename):
+        return None
+
+    times, speeds = [], []
+    with open(filename, newline="") as f:
+        for row in csv.DictReader(f):
+            try:
+                times.append(float(row["sim_time"]))
+                speeds.append(float(row["speed_m_s"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+    if not times:
+        return None
+    return SpeedAligner(times, speeds)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Telemetry file info and CSV export")
+
+    parser.add_argument("filename", type=str,
+                        help="telemetry.bin written by recorder.py")
+
+    parser.add_argument("--csv", action="store_true",
+                        help="Export telemetry.csv and data.csv next to the file")
+
+    args = parser.parse_args()
+
+    try:
+        header, records = load_telemetry(args.filename)
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] {args.filename}: {e}")
+        sys.exit(1)
+
+    print(f"[INFO] {args.filename}")
+    print(f"  - Nº records:  {len(records)}")
+    print(f"  - Roles:       {', '.join(header['roles'])}")
+    if len(records) > 0:
+        print(f"  - Frames:      {records['frame'][0]} - {records['frame'][-1]}")
+        print(f"  - Sim time:    {records['sim_time'][0]:.3f} - {records['sim_time'][-1]:.3f} s")
+
+    if args.csv:
+        n = export_csv(args.filename, os.path.dirname(os.path.abspath(args.filename)))
+        print(f"[INFO] {n} records exported")
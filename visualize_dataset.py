@@ -20,14 +20,22 @@
 
 
 import os
-import time
+import io
 import pandas as pd
 import pygame
-import matplotlib.pyplot as plt
 import matplotlib.backends.backend_agg as agg
+from matplotlib.figure import Figure
 import argparse
 import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+
+from dataset_manager import read_class_table
+from dataset_storage import SHARDS_FOLDERNAME, RAW_FOLDERNAME, ShardReader, RawFrameReader
+from mask_engine import LANE_CLASSES, SEMANTIC_PALETTE
 
 
 def parse_args():
@@ -39,6 +47,30 @@ def parse_args():
         required=True,
         help="Path to the dataset directory"
     )
+    parser.add_argument(
+        "--fps",
+        type=float,
+        default=30,
+        help="Playback rate in frames per second (0 = as fast as possible)"
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=32,
+        help="Number of frames decoded ahead of the current one"
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=512,
+        help="Number of decoded frames kept in memory"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of threads decoding images"
+    )
     
     if len(sys.argv) == 1:
         parser.print_help()
@@ -47,46 +79,207 @@ def parse_args():
     return parser.parse_args()
 
 
-# Plots for throttle, steer, speed 
-def render_plot(df, index, window=50):
-    start = max(0, index - window)
-    data_slice = df[start:index + 1]
-
-    fig, axs = plt.subplots(2, 2, figsize=(10, 8))
-    fig.tight_layout(pad=2.0)
-
-    timestamps = data_slice['timestamp']
-
-    axs[0, 0].plot(timestamps, data_slice['throttle'], color='green')
-    axs[0, 0].set_title("Throttle [0,1]")
-    axs[0, 0].set_xlim(timestamps.min(), timestamps.max())
-    axs[0, 0].set_ylim(0.0, 1.1)
-
-    axs[0, 1].plot(timestamps, data_slice['steer'], color='blue')
-    axs[0, 1].set_title("Steer [-1,1]")
-    axs[0, 1].set_xlim(timestamps.min(), timestamps.max())
-    axs[0, 1].set_ylim(-1.1, 1.1)
-
-    axs[1, 0].plot(timestamps, data_slice['brake'], color='red')
-    axs[1, 0].set_title("Brake [0,1]")
-    axs[1, 0].set_xlim(timestamps.min(), timestamps.max())
-    axs[1, 0].set_ylim(0.0, 1.0)
-
-    axs[1, 1].plot(timestamps, data_slice['speed'], color='orange')
-    axs[1, 1].set_title("Speed (m/s)")
-    axs[1, 1].set_xlim(timestamps.min(), timestamps.max())
-    axs[1, 1].set_ylim(0, 35)
-   
-
-
-    canvas = agg.FigureCanvasAgg(fig)
-    canvas.draw()
-    renderer = canvas.get_renderer()
-    raw_data = renderer.buffer_rgba()
-    size = canvas.get_width_height()
-    surf = pygame.image.frombuffer(raw_data, size, "RGBA")
-    plt.close(fig)
-    return surf
+# Class id -> colour, for single channel images (lane class ids, semantic tags)
+def class_palette(colors):
+    palette = [(0, 0, 0)] * 256
+    palette[:len(colors)] = colors
+    return palette
+
+
+LANE_PALETTE = class_palette([(0, 0, 0)] * 256)
+for _class_id, _, _, _, _color in LANE_CLASSES:
+    LANE_PALETTE[_class_id] = _color
+PALETTES = {"mask": LANE_PALETTE, "segmented": class_palette(SEMANTIC_PALETTE)}
+
+
+# Palettes of the dataset, from the class table it was saved with
+# (classes.json), the default ones for older datasets
+def load_palettes(base_path):
+    table = read_class_table(base_path)
+    if table is None:
+        return PALETTES
+    palettes = dict(PALETTES)
+    for image_type, entry in table.items():
+        colors = [(0, 0, 0)] * (max(c["id"] for c in entry["classes"]) + 1)
+        for c in entry["classes"]:
+            colors[c["id"]] = tuple(c["color"])
+        palettes[image_type] = class_palette(colors)
+    return palettes
+
+
+def _apply_palette(surface, palette):
+    # Single channel images are loaded as 8 bit surfaces, colourised with the palette
+    if surface is not None and palette is not None and surface.get_bitsize() == 8:
+        surface.set_palette(palette)
+    return surface
+
+
+# Load dataset images as pygame surfaces, from PNG files, tar shards or raw
+# frames. Returns None when the image is not found.
+def open_image_loader(base_path):
+
+    if os.path.isdir(os.path.join(base_path, RAW_FOLDERNAME)):
+        reader = RawFrameReader(base_path)
+
+        def load(rel_path, palette=None):
+            frame = reader.read(rel_path)
+            if frame is None:
+                return None
+            if frame.ndim == 2:
+                return _apply_palette(pygame.surfarray.make_surface(frame.T), palette)
+            # Frames are stored as BGR
+            return pygame.surfarray.make_surface(frame[:, :, ::-1].swapaxes(0, 1))
+
+        return load
+
+    if os.path.isdir(os.path.join(base_path, SHARDS_FOLDERNAME)):
+        reader = ShardReader(base_path)
+
+        def load(rel_path, palette=None):
+            data = reader.read_bytes(rel_path)
+            if data is None:
+                return None
+            return _apply_palette(pygame.image.load(io.BytesIO(data), rel_path), palette)
+
+        return load
+
+    def load(rel_path, palette=None):
+        try:
+            surface = pygame.image.load(os.path.join(base_path, rel_path.lstrip("/")))
+        except (FileNotFoundError, pygame.error):
+            return None
+        return _apply_palette(surface, palette)
+
+    return load
+
+
+# Decodes the next frames in worker threads and keeps the decoded ones in a
+# LRU cache keyed by frame index, so playback and seeking back rarely wait
+# for the disk.
+class FramePrefetcher:
+
+    def __init__(self, load_image, rgb_paths, mask_paths, ahead=32, cache_size=512, workers=4,
+                 mask_palette=None):
+        self.load_image = load_image
+        self.rgb_paths = rgb_paths
+        self.mask_paths = mask_paths
+        self.mask_palette = mask_palette
+        self.ahead = ahead
+        self.cache_size = max(cache_size, ahead + 1)
+
+        self.cache = OrderedDict()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers))
+
+    def _load(self, index):
+        rgb = self.load_image(self.rgb_paths[index]) if self.rgb_paths is not None else None
+        mask = self.load_image(self.mask_paths[index], self.mask_palette) if self.mask_paths is not None else None
+        return (rgb, mask, False)
+
+    def _store(self, index, frame):
+        with self.lock:
+            self.pending.discard(index)
+            self.cache[index] = frame
+            self.cache.move_to_end(index)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def _worker(self, index):
+        try:
+            frame = self._load(index)
+        except Exception as e:
+            print(f"[WARN] Unable to load frame {index}: {e}")
+            with self.lock:
+                self.pending.discard(index)
+            return
+        self._store(index, frame)
+
+    def prefetch(self, index):
+        paths = self.rgb_paths if self.rgb_paths is not None else self.mask_paths
+        last = min(len(paths), index + 1 + self.ahead)
+        with self.lock:
+            todo = [i for i in range(index + 1, last)
+                    if i not in self.cache and i not in self.pending]
+            self.pending.update(todo)
+        for i in todo:
+            self.executor.submit(self._worker, i)
+
+    def get(self, index):
+        # (rgb, mask) surfaces, None for the images not found
+        with self.lock:
+            frame = self.cache.get(index)
+            if frame is not None:
+                self.cache.move_to_end(index)
+
+        if frame is None:
+            frame = self._load(index)
+
+        # Conversion to the display format must run on the render thread
+        if not frame[2]:
+            frame = tuple(img.convert_alpha() if img is not None else None
+                          for img in frame[:2]) + (True,)
+            self._store(index, frame)
+
+        self.prefetch(index)
+        return frame[:2]
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Plots for throttle, steer, speed.
+# The figure is created and drawn once; each frame only the lines are updated
+# (set_data) and redrawn over the saved background. The x axis is the time
+# relative to the current frame, so the axes never change.
+class PlotPanel:
+
+    # (column, title, colour, y limits)
+    TRACES = [("throttle", "Throttle [0,1]", "green",  (0.0, 1.1)),
+              ("steer",    "Steer [-1,1]",   "blue",   (-1.1, 1.1)),
+              ("brake",    "Brake [0,1]",    "red",    (0.0, 1.0)),
+              ("speed",    "Speed (m/s)",    "orange", (0, 35))]
+
+    def __init__(self, df, window=50):
+        self.window = window
+        self.timestamps = df['timestamp'].to_numpy(dtype=float)
+        self.values = [df[col].to_numpy(dtype=float) for col, _, _, _ in self.TRACES]
+
+        dt = np.diff(self.timestamps)
+        dt = np.median(dt) if len(dt) > 0 and np.median(dt) > 0 else 1.0 / 30
+        span = window * dt
+
+        self.fig = Figure(figsize=(10, 8))
+        axs = self.fig.subplots(2, 2).ravel()
+        self.fig.tight_layout(pad=2.0)
+
+        self.lines = []
+        for ax, (_, title, color, ylim) in zip(axs, self.TRACES):
+            line, = ax.plot([], [], color=color, animated=True)
+            ax.set_title(title)
+            ax.set_xlim(-span, 0.0)
+            ax.set_ylim(*ylim)
+            self.lines.append((ax, line))
+
+        self.canvas = agg.FigureCanvasAgg(self.fig)
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+
+        # The surface shares memory with the Agg buffer, it is updated in place
+        renderer = self.canvas.get_renderer()
+        self.surface = pygame.image.frombuffer(renderer.buffer_rgba(),
+                                               self.canvas.get_width_height(), "RGBA")
+
+    def render(self, index):
+        start = max(0, index - self.window)
+        t = self.timestamps[start:index + 1] - self.timestamps[index]
+
+        self.canvas.restore_region(self.background)
+        for (ax, line), values in zip(self.lines, self.values):
+            line.set_data(t, values[start:index + 1])
+            ax.draw_artist(line)
+
+        return self.surface
 
 
 def main():
@@ -99,6 +292,19 @@ def main():
         sys.exit(1)
 
     df = pd.read_csv(CSV_PATH)
+    load_image = open_image_loader(BASE_PATH)
+
+    # Columns extracted once. The second image is the lane mask, or the
+    # semantic segmentation when the dataset has no lane masks.
+    timestamps = df['timestamp'].to_numpy(dtype=float)
+    rgb_paths  = df['rgb_path'].to_numpy() if 'rgb_path' in df else None
+    mask_type  = 'mask' if 'mask_path' in df else 'segmented'
+    mask_paths = df[f'{mask_type}_path'].to_numpy() if f'{mask_type}_path' in df else None
+
+    plot = PlotPanel(df)
+    frames = FramePrefetcher(load_image, rgb_paths, mask_paths,
+                             ahead=args.prefetch, cache_size=args.cache_size,
+                             workers=args.workers, mask_palette=load_palettes(BASE_PATH)[mask_type])
 
     pygame.init()
     screen = pygame.display.set_mode((1900, 1000))
@@ -108,50 +314,102 @@ def main():
     font_big = pygame.font.SysFont(None, 48)
     clock = pygame.time.Clock()
 
-    index = 0
-    running = True
+    # Controls: SPACE pause, LEFT/RIGHT one frame, UP/DOWN 10 seconds,
+    # HOME/END, +/- playback speed, click or drag on the timeline to scrub,
+    # ESC/Q quit
+    timeline = pygame.Rect(50, 975, 1800, 12)
+    last = len(df) - 1
+    fps = args.fps if args.fps > 0 else 30
+
+    position = 0.0
+    speed = 1.0
+    paused = False
+    scrubbing = False
+    running = len(df) > 0
 
-    while running and index < len(df):
+    def seek(value):
+        return float(min(max(value, 0), last))
+
+    def timeline_index(x):
+        return seek(round((x - timeline.x) / timeline.width * last))
+
+    while running:
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
-
-        row = df.loc[index]
-        plot_surface = render_plot(df, index)
+            elif event.type == pygame.KEYDOWN:
+                if event.key in (pygame.K_ESCAPE, pygame.K_q):
+                    running = False
+                elif event.key == pygame.K_SPACE:
+                    paused = not paused
+                elif event.key == pygame.K_RIGHT:
+                    position = seek(int(position) + 1)
+                elif event.key == pygame.K_LEFT:
+                    position = seek(int(position) - 1)
+                elif event.key == pygame.K_UP:
+                    position = seek(position + 10 * fps)
+                elif event.key == pygame.K_DOWN:
+                    position = seek(position - 10 * fps)
+                elif event.key == pygame.K_HOME:
+                    position = 0.0
+                elif event.key == pygame.K_END:
+                    position = float(last)
+                elif event.key in (pygame.K_PLUS, pygame.K_EQUALS, pygame.K_KP_PLUS):
+                    speed = min(speed * 2, 16.0)
+                elif event.key in (pygame.K_MINUS, pygame.K_KP_MINUS):
+                    speed = max(speed / 2, 0.125)
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                if timeline.inflate(0, 20).collidepoint(event.pos):
+                    scrubbing = True
+                    position = timeline_index(event.pos[0])
+            elif event.type == pygame.MOUSEBUTTONUP and event.button == 1:
+                scrubbing = False
+            elif event.type == pygame.MOUSEMOTION and scrubbing:
+                position = timeline_index(event.pos[0])
+
+        index = int(position)
+        plot_surface = plot.render(index)
 
         screen.fill((20, 20, 20))
         screen.blit(plot_surface, (800, 100)) 
 
         # Header
-        txt = f"Frame: {index} | Timestamp: {int(row['timestamp'])}"
+        state = "PAUSED" if paused else f"x{speed:g}"
+        txt = f"Frame: {index} | Timestamp: {int(timestamps[index])} | {state}"
         text_surf = font.render(txt, True, (255, 255, 255))
         screen.blit(text_surf, (50, 10))
 
-        # Load images 
-        rgb_rel  = row.iloc[0]
-        mask_rel = row.iloc[1]
+        # Images (decoded ahead by the prefetcher)
+        rgb_rel  = rgb_paths[index] if rgb_paths is not None else "no rgb images"
+        mask_rel = mask_paths[index] if mask_paths is not None else "no mask images"
+        img_rgb, img_mask = frames.get(index)
 
-        imagen_rgb_path  = os.path.join(BASE_PATH, rgb_rel.lstrip("/"))
-        imagen_mask_path = os.path.join(BASE_PATH, mask_rel.lstrip("/"))
-
-        if os.path.isfile(imagen_rgb_path):
-            img_rgb = pygame.image.load(imagen_rgb_path).convert_alpha()
+        if img_rgb is not None:
             screen.blit(img_rgb, (0, 40))
         else:
-            warn = font.render(f"RGB not found: {imagen_rgb_path}", True, (255, 100, 100))
+            warn = font.render(f"RGB not found: {rgb_rel}", True, (255, 100, 100))
             screen.blit(warn, (0, 40))
 
-        if os.path.isfile(imagen_mask_path):
-            img_mask = pygame.image.load(imagen_mask_path).convert_alpha()
+        if img_mask is not None:
             screen.blit(img_mask, (0, 500))
         else:
-            warn = font.render(f"Mask not found: {imagen_mask_path}", True, (255, 100, 100))
+            warn = font.render(f"Mask not found: {mask_rel}", True, (255, 100, 100))
             screen.blit(warn, (0, 500))
 
+        # Timeline
+        pygame.draw.rect(screen, (80, 80, 80), timeline)
+        marker_x = timeline.x + int(timeline.width * index / max(last, 1))
+        pygame.draw.rect(screen, (255, 200, 0), (marker_x - 3, timeline.y - 4, 6, timeline.height + 8))
+
         pygame.display.flip()
-        time.sleep(1/1000)
-        index += 1
+        clock.tick(args.fps)
+
+        if not paused and not scrubbing:
+            position = seek(position + speed)
+            if index == last:
+                paused = True
 
+    frames.close()
     pygame.quit()
 
 